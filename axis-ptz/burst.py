@@ -0,0 +1,216 @@
+"""
+Capture scheduling around the best part of a pass
+
+A fixed capture period spends as many frames on an aircraft far away, small
+in the frame, as on the same aircraft overhead. The scheduler predicts the
+pass from the aircraft's position and velocity (straight, at a constant
+speed and vertical rate, as the pointing does) and captures in a burst
+while the aircraft is nearly as close as it gets, so nearly as large in the
+frame, and around its peak elevation, and only now and then elsewhere.
+Every pass has a budget of frames and bytes, and the sparse captures may
+only use a share of them, so the burst is never starved by the approach. A
+burst longer than its share of the budget at the burst period allows, a
+high or slow pass, is spread out over its length.
+"""
+
+import math
+import threading
+from typing import *
+
+import numpy as np
+
+# Seconds between captures around closest approach and peak elevation
+BURST_PERIOD = 0.2
+# Seconds between captures elsewhere in the pass
+SPARSE_PERIOD = 5.0
+# Seconds either side of closest approach and peak elevation captured in a burst, at least
+BURST_WINDOW = 3.0
+# Captured in a burst while the distance is within this ratio of the closest distance
+BURST_RATIO = 1.25
+# Frames a pass may use
+FRAME_BUDGET = 100
+# Bytes a pass may use
+BYTE_BUDGET = 50000000
+# Share of the budgets the captures outside the bursts may use
+SPARSE_SHARE = 0.25
+# Seconds an aircraft can go untracked before tracking it again starts a new pass
+PASS_GAP = 600.0
+# Passes kept for their counts
+PASSES_KEPT = 100
+# Seconds before and after the position the pass is predicted over
+HORIZON = 600.0
+# Seconds between the predicted positions searched for the peak elevation
+STEP = 0.5
+
+
+class Pass(NamedTuple):
+    """The best part of a pass, in seconds from the time of the position it was predicted from"""
+
+    closest: float  # Closest approach, negative once passed
+    peak: float  # Peak elevation
+    near: float  # Half the time the distance is within BURST_RATIO of the closest distance
+
+
+def predict_pass(
+    r_ENz: np.ndarray,
+    v_ENz: np.ndarray,
+    ratio: float = BURST_RATIO,
+    horizon: float = HORIZON,
+) -> Pass:
+    """When a straight pass is closest to the camera, and highest above its horizon
+
+    Arguments:
+        r_ENz {np.ndarray} -- Position of the aircraft relative to the camera, east, north and up [m]
+        v_ENz {np.ndarray} -- Velocity of the aircraft, east, north and up [m/s]
+
+    Keyword Arguments:
+        ratio {float} -- Ratio of the closest distance the aircraft is near within (default: {1.25})
+        horizon {float} -- Seconds before and after the position to look in (default: {600.0})
+
+    Returns:
+        Pass -- Times of closest approach and peak elevation, and how long the aircraft is near
+    """
+    speed2 = float(np.dot(v_ENz, v_ENz))
+    if speed2 == 0.0:
+        return Pass(0.0, 0.0, 0.0)
+    t_closest = min(horizon, max(-horizon, -float(np.dot(r_ENz, v_ENz)) / speed2))
+    closest = float(np.linalg.norm(r_ENz + v_ENz * t_closest))
+    t = np.arange(-horizon, horizon + STEP, STEP)
+    east = r_ENz[0] + v_ENz[0] * t
+    north = r_ENz[1] + v_ENz[1] * t
+    up = r_ENz[2] + v_ENz[2] * t
+    t_peak = float(t[np.argmax(np.arctan2(up, np.hypot(east, north)))])
+    # The distance is sqrt(closest^2 + speed^2 (t - t_closest)^2) on a straight line
+    near = closest * math.sqrt(ratio * ratio - 1.0) / math.sqrt(speed2)
+    return Pass(t_closest, t_peak, near)
+
+
+class CaptureScheduler:
+    """Decides when to capture an aircraft, pass by pass"""
+
+    def __init__(
+        self,
+        burst_period: float = BURST_PERIOD,
+        sparse_period: float = SPARSE_PERIOD,
+        burst_window: float = BURST_WINDOW,
+        frame_budget: int = FRAME_BUDGET,
+        byte_budget: int = BYTE_BUDGET,
+        sparse_share: float = SPARSE_SHARE,
+    ):
+        """Start without a pass
+
+        Keyword Arguments:
+            burst_period {float} -- Seconds between captures in a burst (default: {0.2})
+            sparse_period {float} -- Seconds between captures outside the bursts (default: {5.0})
+            burst_window {float} -- Seconds either side of closest approach and peak elevation in the burst (default: {3.0})
+            frame_budget {int} -- Frames a pass may use (default: {100})
+            byte_budget {int} -- Bytes a pass may use (default: {50000000})
+            sparse_share {float} -- Share of the frames and bytes the captures outside the bursts may use (default: {0.25})
+        """
+        self.burst_period = burst_period
+        self.sparse_period = sparse_period
+        self.burst_window = burst_window
+        self.frame_budget = frame_budget
+        self.byte_budget = byte_budget
+        self.sparse_budget = int(math.ceil(frame_budget * sparse_share))
+        self.burst_budget = frame_budget - self.sparse_budget
+        self.sparse_bytes = byte_budget * sparse_share
+        self.lock = threading.Lock()
+        self.icao24 = None
+        self.last = None
+        self.period = burst_period  # Seconds between captures at the last call to due()
+        self.passes = {}  # Frames, burst frames and bytes of the recent passes, by icao24
+
+    def _pass(self, icao24: str, now: float = None) -> Dict[str, int]:
+        counts = self.passes.get(icao24)
+        if counts is None or (
+            now is not None
+            and counts["seen"] is not None
+            and now - counts["seen"] > PASS_GAP
+        ):
+            self.passes.pop(icao24, None)
+            if len(self.passes) >= PASSES_KEPT:
+                del self.passes[next(iter(self.passes))]
+            counts = {"frames": 0, "burst": 0, "bytes": 0, "skipped": 0, "seen": now}
+            self.passes[icao24] = counts
+        if now is not None:
+            counts["seen"] = now
+        return counts
+
+    def due(self, icao24: str, now: float, t: float, prediction: Pass) -> bool:
+        """Whether to capture the aircraft now, counted against its pass if so
+
+        Arguments:
+            icao24 {str} -- The aircraft being tracked
+            now {float} -- time.monotonic()
+            t {float} -- Seconds from the time of the position the pass was predicted from to when the image would be taken
+            prediction {Pass} -- The pass of the aircraft
+
+        Returns:
+            bool -- Whether to capture
+        """
+        with self.lock:
+            if icao24 != self.icao24:
+                self.icao24 = icao24
+                self.last = None
+            counts = self._pass(icao24, now)
+            around_closest = max(self.burst_window, prediction.near)
+            burst = (
+                abs(t - prediction.closest) <= around_closest
+                or abs(t - prediction.peak) <= self.burst_window
+            )
+            if burst:
+                # Spread the burst's share of the frames over all of it
+                period = max(self.burst_period, 2.0 * around_closest / max(1, self.burst_budget))
+            else:
+                period = self.sparse_period
+            self.period = period
+            if self.last is not None and now - self.last < period:
+                return False
+            self.last = now
+            if (
+                counts["frames"] >= self.frame_budget
+                or counts["bytes"] >= self.byte_budget
+                or not burst
+                and (
+                    counts["frames"] - counts["burst"] >= self.sparse_budget
+                    or counts["bytes"] >= self.sparse_bytes
+                )
+            ):
+                counts["skipped"] += 1
+                return False
+            counts["frames"] += 1
+            if burst:
+                counts["burst"] += 1
+            return True
+
+    def next_due(self, now: float) -> float:
+        """When to ask due() again, at the latest
+
+        The period can shorten before the last one is over, when the
+        aircraft gets near, so it is asked again at least every burst
+        period.
+
+        Arguments:
+            now {float} -- time.monotonic()
+
+        Returns:
+            float -- time.monotonic() to ask at
+        """
+        with self.lock:
+            if self.last is None:
+                return now
+            return min(self.last + self.period, now + self.burst_period)
+
+    def record(self, icao24: str, size: int):
+        """Count the bytes of a saved image against its pass"""
+        with self.lock:
+            self._pass(icao24)["bytes"] += size
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Frames, burst frames, bytes and captures skipped over budget, of the recent passes"""
+        with self.lock:
+            return {
+                icao24: {name: counts[name] for name in ("frames", "burst", "bytes", "skipped")}
+                for icao24, counts in self.passes.items()
+            }
@@ -2,29 +2,37 @@
 
 
 import argparse
-from datetime import datetime, timedelta
+from datetime import datetime
 from distutils.util import strtobool
 import errno
+import itertools
 import json
 from json.decoder import JSONDecodeError
 import math
 import os
 import random
-import requests
 import sys
 import threading
 import time
 
 import logging
-import logging.config  # This gets rid of the annoying log messages from Vapix_Control
+import logging.config  # This gets rid of the annoying log messages from the libraries
 import coloredlogs
 
 import numpy as np
-from requests.auth import HTTPDigestAuth
 import paho.mqtt.client as mqtt
-from sensecam_control import vapix_control  # , vapix_config
 
+import burst
+import capture
+from config_store import CameraConfig, ConfigStore, TripodFrameStore
+import lead
+import mjpeg
+import schedule
+import sun
+import telemetry
 import utils
+import vapix
+import velocity
 
 # Logging configuration
 logging.config.dictConfig(
@@ -33,9 +41,6 @@ logging.config.dictConfig(
         "disable_existing_loggers": True,
     }
 )
-logging.getLogger("vapix_control.py").setLevel(logging.WARNING)
-logging.getLogger("vapix_control").setLevel(logging.WARNING)
-logging.getLogger("sensecam_control").setLevel(logging.WARNING)
 root_logger = logging.getLogger()
 if not root_logger.handlers:
     ch = logging.StreamHandler()
@@ -50,19 +55,22 @@ logger.setLevel(logging.INFO)
 ID = str(random.randint(1, 100001))
 args = None
 camera = None
-cameraBearingCorrection = 0
 cameraConfig = None
-cameraZoom = None
-cameraMoveSpeed = None
-cameraDelay = None
-cameraLead = 0
-inhibitPhotos = False
-capturePeriod = 1000  # milliseconds
+vapix_client = None  # Keep-alive session to the camera, shared by PTZ and capture
+capture_pipeline = None  # Takes and saves the images triggered by the move loop
+mjpeg_grabber = None  # Keeps the latest frames of the MJPEG stream, in the mjpeg capture mode
+capture_scheduler = None  # Captures in bursts around closest approach, None to capture every capturePeriod
+velocity_control = None  # Points the camera with continuous moves, None to send absolute moves
+move_lag = capture.Lag()  # How late the PTZ commands are sent
+move_schedule = schedule.DeadlineScheduler()  # Sleeps the move loop until its next deadline or message
+pointing_telemetry = None  # Compares the position of the camera with the commands, None when not queried
+lead_calibration = None  # Calibrates camera_lead from the pointing error, None to use the configured one
 active = False
 Active = True
 
 object_topic = None
 flight_topic = None
+preposition_topic = None
 config_topic = "skyscan/config/json"
 
 bearing = 0  # this is an angle
@@ -75,20 +83,28 @@ angularVelocityHorizontal = 0  # in meters
 angularVelocityVertical = 0  # in meters
 planeTrack = 0  # This is the direction that the plane is moving in
 
-camera_roll = 0
-camera_pitch = 0
-camera_yaw = 0
-
 currentPlane = None
-camera_altitude = None
-camera_latitude = None
-camera_longitude = None
+capture_sequence = itertools.count()  # Numbers the captures, so ones in the same millisecond get their own file
+preposition = None  # Where the tracker expects the next aircraft to become trackable
+
+# Runtime configuration, swapped atomically by the MQTT callback
+config_store = ConfigStore(CameraConfig())
+tripod_frames = TripodFrameStore()  # Frame of the tripod, recomputed when an EGI update moves it
+sun_position = sun.Sun()  # Position of the sun, computed once a second
 
-camera_lead = None
 include_age = strtobool(os.getenv("INCLUDE_AGE", "True"))
 
+# Seconds between logging the network and disk time of the requests to the camera, and the move and capture lag
+VAPIX_STATS_INTERVAL = 60
+
+# Seconds the move loop sleeps for at most without a deadline, in case something changed without a message
+IDLE_WAIT = 1.0
+
+# Distance the predicted entry point has to move before the camera is parked again
+PREPOSITION_TOLERANCE = 100  # [m]
+
 def calculate_bearing_correction(b):
-    return (b + cameraBearingCorrection) % 360
+    return (b + config_store.get().cameraBearingCorrection) % 360
 
 def _format_file_save_filepath(file_extension: str = None):
     """
@@ -110,13 +126,18 @@ def _format_file_save_filepath(file_extension: str = None):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise  # This was not a "directory exist" error..
-    filepath = "{}/{}_{}_{}_{}_{}".format(
+    # Bursts capture several times a second from nearly the same place, so
+    # the time is to the millisecond and every capture is numbered
+    now = datetime.now()
+    filepath = "{}/{}_{}_{}_{}_{}-{:03d}_{}".format(
         captureDir,
         currentPlane["icao24"],
         int(bearing),
         int(elevation),
         int(distance3d),
-        datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
+        now.strftime("%Y-%m-%d-%H-%M-%S"),
+        now.microsecond // 1000,
+        next(capture_sequence),
     )
 
     if file_extension is not None:
@@ -147,62 +168,28 @@ def get_jpeg_request():  # 5.2.4.1
         overlay_image: Enable/disable overlay image.(0 = disable, 1 = enable)
         overlay_position:The x and y coordinates defining the position of the overlay image.
         (<int>x<int>)
+    The parameters sent are vapix.JPEG_PAYLOAD.
     Returns:
-        Success ('image save' and save the image in the file folder) or Failure (Error and
-        description).
+        A dictionary with the network and disk time of the capture in seconds, None if no image was saved.
     """
-    payload = {
-        "resolution": "1920x1080",
-        "compression": 5,
-        "camera": 1,
-    }
-    global args
-
-    url = "http://" + args.axis_ip + "/axis-cgi/jpg/image.cgi"
-    start_time = datetime.now()
-    try:
-        resp = requests.get(
-            url,
-            auth=HTTPDigestAuth(args.axis_username, args.axis_password),
-            params=payload,
-            timeout=0.5,
-        )
-    except requests.exceptions.Timeout:
-        logging.info("🚨 Images capture request timed out 🚨  ")
-        return
-
-    disk_time = datetime.now()
-    if resp.status_code == 200:
-        filename = _format_file_save_filepath(file_extension=".jpg")
-
-        # Original
-        with open(filename, "wb") as var:
-            var.write(resp.content)
-
-        # Non-Blocking
-        # fd = os.open(filename, os.O_CREAT | os.O_WRONLY | os.O_NONBLOCK)
-        # os.write(fd, resp.content)
-        # os.close(fd)
-
-        # Blocking
-
-        # fd = os.open(filename, os.O_CREAT | os.O_WRONLY)
-        # os.write(fd, resp.content)
-        # os.close(fd)
-    else:
-        logging.error(
-            "Unable to fetch image: {}\tstatus: {}".format(url, resp.status_code)
-        )
-
-    end_time = datetime.now()
-    net_time_diff = disk_time - start_time
-    disk_time_diff = end_time - disk_time
-    if disk_time_diff.total_seconds() > 0.1:
+    image, net_time = vapix_client.jpeg(vapix.JPEG_PAYLOAD)
+    if image is None:
+        return None
+
+    disk_start = time.monotonic()
+    filename = _format_file_save_filepath(file_extension=".jpg")
+    with open(filename, "wb") as var:
+        var.write(image)
+    disk_time = time.monotonic() - disk_start
+    vapix_client.record_disk("jpeg", disk_time)
+
+    if disk_time > 0.1:
         logging.info(
-            "🚨  Image Capture Timeout  🚨  Net time: {}  \tDisk time: {}".format(
-                net_time_diff, disk_time_diff
+            "🚨  Image Capture Timeout  🚨  Net time: {:.3f}  \tDisk time: {:.3f}".format(
+                net_time, disk_time
             )
         )
+    return {"network": net_time, "disk": disk_time}
 
 
 def get_bmp_request():  # 5.2.4.1
@@ -234,10 +221,7 @@ def get_bmp_request():  # 5.2.4.1
         "resolution": "1920x1080",
         "camera": 1,
     }
-    url = "http://" + args.axis_ip + "/axis-cgi/bitmap/image.bmp"
-    resp = requests.get(
-        url, auth=HTTPDigestAuth(args.axis_username, args.axis_password), params=payload
-    )
+    resp = vapix_client.bmp(payload)
 
     if resp.status_code == 200:
         filename = _format_file_save_filepath(file_extension=".bmp")
@@ -387,10 +371,57 @@ def compute_rotations(e_E_XYZ, e_N_XYZ, e_z_XYZ, alpha, beta, gamma, rho, tau):
     return q_alpha, q_beta, q_gamma, E_XYZ_to_uvw, q_rho, q_tau, E_XYZ_to_rst
 
 
+def compute_E_XYZ_to_rst(E_XYZ_to_uvw, rho, tau):
+    """Compute the rotation from the XYZ to the rst (camera fixed)
+    coordinate system in closed form, given the rotation to the uvw
+    (camera housing fixed) coordinate system, as computed by
+    compute_rotations.
+
+    Parameters
+    ----------
+    E_XYZ_to_uvw : numpy.ndarray
+        Orthogonal transformation matrix from XYZ to uvw
+    rho : float
+        Pan angle about -t axis [deg]
+    tau : float
+        Tilt angle about w axis [deg]
+
+    Returns
+    -------
+    E_XYZ_to_rst : numpy.ndarray
+        Orthogonal transformation matrix from XYZ to rst
+    """
+    # Unit vectors of the rst coordinate system in the uvw coordinate
+    # system, after panning about -w, then tilting about the panned u
+    # axis
+    c_rho = math.cos(math.radians(rho))
+    s_rho = math.sin(math.radians(rho))
+    c_tau = math.cos(math.radians(tau))
+    s_tau = math.sin(math.radians(tau))
+    E_uvw_to_rst = np.array(
+        [
+            [c_rho, -s_rho, 0.0],
+            [c_tau * s_rho, c_tau * c_rho, s_tau],
+            [-s_tau * s_rho, -s_tau * c_rho, c_tau],
+        ]
+    )
+    return np.matmul(E_uvw_to_rst, E_XYZ_to_uvw)
+
+
 def calculateCameraPositionB(
-    r_XYZ_t, E_XYZ_to_ENz, e_E_XYZ, e_N_XYZ, e_z_XYZ, alpha, beta, gamma, E_XYZ_to_uvw
+    r_XYZ_t,
+    E_XYZ_to_ENz,
+    e_E_XYZ,
+    e_N_XYZ,
+    e_z_XYZ,
+    alpha,
+    beta,
+    gamma,
+    E_XYZ_to_uvw,
+    camera_lead=None,
 ):
-    """Calculates camera pointing at a specified lead time."""
+    """Calculates camera pointing at a specified lead time, the
+    configured camera lead unless one is given."""
     # Define global variables
     # TODO: Eliminate use of global variables
     global distance3d
@@ -402,6 +433,11 @@ def calculateCameraPositionB(
     global cameraPan
     global cameraTilt
 
+    # Use a single configuration snapshot for the whole computation
+    config = config_store.get()
+    if camera_lead is None:
+        camera_lead = config.camera_lead
+
     # Assign position and velocity of the aircraft
     a_varphi = currentPlane["lat"]  # [deg]
     a_lambda = currentPlane["lon"]  # [deg]
@@ -423,8 +459,8 @@ def calculateCameraPositionB(
         a_lead = camera_lead  # [s]
 
     # Assign position of the tripod
-    t_varphi = camera_latitude  # [deg]
-    t_lambda = camera_longitude  # [deg]
+    t_varphi = config.camera_latitude  # [deg]
+    t_lambda = config.camera_longitude  # [deg]
 
     # Compute position in the XYZ coordinate system of the aircraft
     # relative to the tripod at time zero, the observation time
@@ -463,8 +499,10 @@ def calculateCameraPositionB(
         a_lambda,
     )  # [m]
 
-    # Compute the bearing from north of the aircraft from the tripod
+    # Compute the bearing from north, and the elevation above the
+    # horizon, of the aircraft from the tripod
     bearing = math.degrees(math.atan2(r_ENz_a_1_t[0], r_ENz_a_1_t[1]))
+    elevation = math.degrees(math.atan2(r_ENz_a_1_t[2], utils.norm(r_ENz_a_1_t[0:2])))
 
     # Compute pan and tilt to point the camera at the aircraft
     r_uvw_a_1_t = np.matmul(E_XYZ_to_uvw, r_XYZ_a_1_t)
@@ -478,9 +516,7 @@ def calculateCameraPositionB(
     # Compute position and velocity in the rst coordinate system of
     # the aircraft relative to the tripod at time zero after pointing
     # the camera at the aircraft
-    _, _, _, _, q_rho, q_tau, E_XYZ_to_rst = compute_rotations(
-        e_E_XYZ, e_N_XYZ, e_z_XYZ, alpha, beta, gamma, rho, tau
-    )
+    E_XYZ_to_rst = compute_E_XYZ_to_rst(E_XYZ_to_uvw, rho, tau)
     r_rst_a_0_t = np.matmul(E_XYZ_to_rst, r_XYZ_a_0_t)
     v_rst_a_0_t = np.matmul(E_XYZ_to_rst, v_XYZ_a_0_t)
 
@@ -491,6 +527,42 @@ def calculateCameraPositionB(
     angularVelocityVertical = math.degrees(omega[0])
 
 
+def calculateCameraPositionPreposition(r_XYZ_t, E_XYZ_to_uvw, point):
+    """Calculates camera pointing at a pre-position point."""
+    # Compute position in the XYZ coordinate system of the point
+    # relative to the tripod, and in the uvw coordinate system
+    r_XYZ_p_t = utils.compute_r_XYZ(point["lon"], point["lat"], point["altitude"]) - r_XYZ_t
+    r_uvw_p_t = np.matmul(E_XYZ_to_uvw, r_XYZ_p_t)
+
+    # Compute pan and tilt to point the camera at the point
+    rho = math.degrees(math.atan2(r_uvw_p_t[0], r_uvw_p_t[1]))  # [deg]
+    tau = math.degrees(math.atan2(r_uvw_p_t[2], utils.norm(r_uvw_p_t[0:2])))  # [deg]
+    return rho, tau
+
+
+def calculatePass(r_XYZ_t, E_XYZ_to_ENz):
+    """Calculates when the current plane is closest to the camera, and
+    highest above its horizon, in seconds from the time of its position,
+    which is returned too, and how long it is nearly as close."""
+    a_datetime = utils.convert_time(currentPlane["latLonTime"])
+    r_ENz_a_0_t = np.matmul(
+        E_XYZ_to_ENz,
+        utils.compute_r_XYZ(
+            currentPlane["lon"], currentPlane["lat"], currentPlane["altitude"]
+        )
+        - r_XYZ_t,
+    )
+    a_track = math.radians(currentPlane["track"])
+    v_ENz_a_0_t = np.array(
+        [
+            currentPlane["groundSpeed"] * math.sin(a_track),
+            currentPlane["groundSpeed"] * math.cos(a_track),
+            currentPlane["verticalRate"],
+        ]
+    )
+    return burst.predict_pass(r_ENz_a_0_t, v_ENz_a_0_t), a_datetime
+
+
 def calculateCameraPositionA():
     global cameraPan
     global cameraTilt
@@ -501,7 +573,12 @@ def calculateCameraPositionA():
     global angularVelocityVertical
     global elevation
 
-    (lat, lon, alt) = utils.calc_travel_3d(currentPlane, camera_lead, include_age=include_age)
+    config = config_store.get()
+    camera_latitude = config.camera_latitude
+    camera_longitude = config.camera_longitude
+    camera_altitude = config.camera_altitude
+
+    (lat, lon, alt) = utils.calc_travel_3d(currentPlane, config.camera_lead, include_age=include_age)
     distance3d = utils.coordinate_distance_3d(
         camera_latitude, camera_longitude, camera_altitude, lat, lon, alt
     )
@@ -535,20 +612,22 @@ def get_json_request():
         A dictionary containing the contents os the JSON metadata file.  
     """
     image_filepath = _format_file_save_filepath(file_extension=".jpg")
+    config = config_store.get()
 
     file_content_dictionary = {
         "timestamp": datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
         "imagefile": image_filepath,
         "camera": {
             "bearing": bearing,
-            "zoom": cameraZoom,
+            "zoom": config.cameraZoom,
             "pan": cameraPan,
             "tilt": cameraTilt,
-            "lat": camera_latitude,
-            "long": camera_longitude,
-            "alt": camera_altitude
+            "lat": config.camera_latitude,
+            "long": config.camera_longitude,
+            "alt": config.camera_altitude
         },
         "aircraft": {
+            "icao24": currentPlane["icao24"],
             "lat": currentPlane["lat"],
             "long": currentPlane["lon"],
             "alt": currentPlane["altitude"]
@@ -559,37 +638,116 @@ def get_json_request():
 
 
 def moveCamera(ip, username, password, mqtt_client):
+    global capture_pipeline
 
     movePeriod = 100  # milliseconds
-    moveTimeout = datetime.now()
-    captureTimeout = datetime.now()
-    camera = vapix_control.CameraControl(ip, username, password)
+    next_move = None  # time.monotonic() of the next move, None while not tracking
+    next_capture = None  # time.monotonic() of the next capture, or check for one
+    camera = vapix_client or vapix.VapixClient(ip, username, password)
+
+    if mjpeg_grabber is not None:
+        def fetch(due):
+            # The frame of the stream received nearest to when the image was due
+            frame = mjpeg_grabber.frame_at(due)
+            if frame is None:
+                logging.info("🚨 No MJPEG frame for the capture 🚨  ")
+                return None, {}
+            return frame.data, {"frame": frame.monotonic - due, "frameTime": frame.time}
+    else:
+        def fetch(due):
+            image, network = camera.jpeg(vapix.JPEG_PAYLOAD)
+            return image, {"network": network}
+
+    def published(metadata):
+        if capture_scheduler is not None:
+            capture_scheduler.record(
+                metadata["aircraft"]["icao24"], metadata["imagebytes"]
+            )
+        mqtt_client.publish(publish_topic, json.dumps(metadata), 0, False)
 
-    # Assign position of the tripod
-    t_varphi = camera_latitude  # [deg]
-    t_lambda = camera_longitude  # [deg]
-    t_h = camera_altitude  # [m]
+    # Images are taken and saved off this thread, so pointing never waits on them
+    capture_pipeline = capture.CapturePipeline(
+        fetch,
+        published,
+        lambda seconds: camera.record_disk("jpeg", seconds),
+    )
+
+    def trigger_capture(config):
+        # Stamped now, taken cameraDelay later by the capture pipeline
+        capture_metadata = get_json_request()
+        capture_pipeline.trigger(
+            capture_metadata["imagefile"],
+            capture_metadata,
+            config.cameraDelay or 0.0,
+        )
+
+    # Plane the pass was last predicted for
+    pass_plane = None
 
-    # Compute orthogonal transformation matrix from geocentric to
-    # topocentric coordinates, and position in the XYZ coordinate
-    # system of the tripod
-    E_XYZ_to_ENz, e_E_XYZ, e_N_XYZ, e_z_XYZ = utils.compute_E(t_lambda, t_varphi)
-    r_XYZ_t = utils.compute_r_XYZ(t_lambda, t_varphi, t_h)
+    # Frame of the tripod the derived state below was computed in
+    tripod_frame = None
+
+    # Orientation of the housing the rotations were computed for, which
+    # only need to be recomputed when it changes, not on every
+    # configuration message
+    rotations_orientation = None
+
+    # Set while the aircraft is too close to the sun to point at
+    sun_deferred = False
+
+    # Pre-position the camera was last parked at
+    parked = None
 
     while True:
-        # Compute the rotations from the XYZ coordinate system to the uvw
-        # (camera housing fixed) coordinate system
-        alpha = camera_yaw   # [deg]
-        beta = camera_pitch  # [deg]
-        gamma = camera_roll  # [deg]
-        q_alpha, q_beta, q_gamma, E_XYZ_to_uvw, _, _, _ = compute_rotations(
-            e_E_XYZ, e_N_XYZ, e_z_XYZ, alpha, beta, gamma, 0.0, 0.0
-        )
+        config = config_store.get()
+        frame = tripod_frames.get(config)
+        if frame is not tripod_frame:
+            if tripod_frame is not None:
+                logging.info(
+                    "[TRIPOD]\tMoved to Lat: {:.6f} \tLon: {:.6f} \tAlt: {:.1f}".format(
+                        frame.latitude, frame.longitude, frame.altitude
+                    )
+                )
+            # Assign orthogonal transformation matrix from geocentric to
+            # topocentric coordinates, and position in the XYZ coordinate
+            # system of the tripod
+            E_XYZ_to_ENz = frame.E_XYZ_to_ENz
+            e_E_XYZ, e_N_XYZ, e_z_XYZ = frame.e_E_XYZ, frame.e_N_XYZ, frame.e_z_XYZ
+            r_XYZ_t = frame.r_XYZ_t
+            tripod_frame = frame
+            # The housing rotation and the pass are relative to the tripod
+            rotations_orientation = None
+            pass_plane = None
+        orientation = (config.camera_yaw, config.camera_pitch, config.camera_roll)
+        if orientation != rotations_orientation:
+            # Compute the rotations from the XYZ coordinate system to the uvw
+            # (camera housing fixed) coordinate system
+            alpha, beta, gamma = orientation  # [deg]
+            q_alpha, q_beta, q_gamma, E_XYZ_to_uvw, _, _, _ = compute_rotations(
+                e_E_XYZ, e_N_XYZ, e_z_XYZ, alpha, beta, gamma, 0.0, 0.0
+            )
+            rotations_orientation = orientation
         if active:
             if not "icao24" in currentPlane:
                 logging.info(" 🚨 Active but Current Plane is not set")
+                # Nothing to point at until the next flight message
+                next_move = next_capture = None
+                move_schedule.wait(time.monotonic() + IDLE_WAIT)
                 continue
-            if moveTimeout <= datetime.now():
+            now = time.monotonic()
+            if next_move is None:
+                next_move = next_capture = now
+            if next_move <= now:
+                move_lag.add(now - next_move)
+                # The camera leaves the pre-position, park it again after the pass
+                parked = None
+                if lead_calibration is not None:
+                    # Calibrated for the angular rate of the aircraft at the last move
+                    camera_lead = lead_calibration.lead(
+                        math.hypot(angularVelocityHorizontal, angularVelocityVertical)
+                    )
+                else:
+                    camera_lead = config.camera_lead
                 calculateCameraPositionB(
                     r_XYZ_t,
                     E_XYZ_to_ENz,
@@ -600,110 +758,210 @@ def moveCamera(ip, username, password, mqtt_client):
                     beta,
                     gamma,
                     E_XYZ_to_uvw,
+                    camera_lead,
                 )
-                camera.absolute_move(cameraPan, cameraTilt, cameraZoom, cameraMoveSpeed)
+                if sun_position.is_excluded(
+                    bearing,
+                    elevation,
+                    config.camera_latitude,
+                    config.camera_longitude,
+                    time.time(),
+                    config.sun_exclusion,
+                ):
+                    # Hold the current position until the aircraft is clear of the sun
+                    if velocity_control is not None:
+                        velocity_control.stop()
+                    if not sun_deferred:
+                        logging.info(
+                            " ☀️ Aircraft within {} degrees of the sun, holding position".format(
+                                config.sun_exclusion
+                            )
+                        )
+                        sun_deferred = True
+                else:
+                    if sun_deferred:
+                        logging.info(" ☀️ Aircraft clear of the sun, resuming")
+                        sun_deferred = False
+                    pan_rate, tilt_rate = velocity.pan_tilt_rates(
+                        angularVelocityHorizontal, angularVelocityVertical, cameraTilt
+                    )
+                    if pointing_telemetry is not None:
+                        # The pointing is for the time of the position plus the lead
+                        ahead = camera_lead
+                        if not include_age:
+                            ahead -= (
+                                datetime.utcnow() - utils.convert_time(currentPlane["latLonTime"])
+                            ).total_seconds()
+                        pointing_telemetry.predicted(
+                            time.monotonic() + ahead,
+                            cameraPan,
+                            cameraTilt,
+                            pan_rate,
+                            tilt_rate,
+                            lead=camera_lead,
+                        )
+                    if velocity_control is not None:
+                        command = velocity_control.track(
+                            time.monotonic(),
+                            cameraPan,
+                            cameraTilt,
+                            pan_rate,
+                            tilt_rate,
+                            config.cameraZoom,
+                            config.cameraMoveSpeed,
+                        )
+                        if command == "absolute" and pointing_telemetry is not None:
+                            pointing_telemetry.commanded(velocity_control.pan, velocity_control.tilt)
+                    else:
+                        camera.absolute_move(
+                            cameraPan, cameraTilt, config.cameraZoom, config.cameraMoveSpeed
+                        )
+                        if pointing_telemetry is not None:
+                            pointing_telemetry.commanded(cameraPan, cameraTilt)
                 # logging.info("Moving to Pan: {} Tilt: {}".format(cameraPan, cameraTilt))
-                moveTimeout = moveTimeout + timedelta(milliseconds=movePeriod)
-                if moveTimeout <= datetime.now():
-                    lag = datetime.now() - moveTimeout
+                next_move += movePeriod / 1000.0
+                if next_move <= time.monotonic():
+                    lag = time.monotonic() - next_move
                     logging.info(
-                        " 🚨 Move execution time was greater that Move Period - lag: {}".format(
+                        " 🚨 Move execution time was greater that Move Period - lag: {:.3f}s".format(
                             lag
                         )
                     )
-                    moveTimeout = datetime.now() + timedelta(milliseconds=movePeriod)
-
-            if not inhibitPhotos:
-                if captureTimeout <= datetime.now():
-                    time.sleep(cameraDelay)
-                    get_jpeg_request()
-                    capture_metadata = get_json_request()
-                    mqtt_client.publish(
-                        publish_topic,
-                        json.dumps(capture_metadata),
-                        0,
-                        False
-                    )
-                    captureTimeout = captureTimeout + timedelta(
-                        milliseconds=capturePeriod
+                    next_move = time.monotonic() + movePeriod / 1000.0
+
+            deadline = next_move
+            if not config.inhibitPhotos and not sun_deferred:
+                if capture_scheduler is not None and next_capture <= time.monotonic():
+                    if currentPlane is not pass_plane:
+                        prediction, position_time = calculatePass(
+                            r_XYZ_t, E_XYZ_to_ENz
+                        )
+                        pass_plane = currentPlane
+                    # Seconds from the position to when the image would be taken
+                    t = (datetime.utcnow() - position_time).total_seconds() + (
+                        config.cameraDelay or 0.0
                     )
-                    if captureTimeout <= datetime.now():
-                        lag = datetime.now() - captureTimeout
+                    if capture_scheduler.due(
+                        currentPlane["icao24"],
+                        time.monotonic(),
+                        t,
+                        prediction,
+                    ):
+                        trigger_capture(config)
+                    next_capture = capture_scheduler.next_due(time.monotonic())
+                elif capture_scheduler is None and next_capture <= time.monotonic():
+                    trigger_capture(config)
+                    next_capture += config.capturePeriod / 1000.0
+                    if next_capture <= time.monotonic():
+                        lag = time.monotonic() - next_capture
                         logging.info(
-                            " 🚨 Capture execution time was greater that Capture Period - lag: {}".format(
+                            " 🚨 Capture trigger was later than Capture Period - lag: {:.3f}s".format(
                                 lag
                             )
                         )
-                        captureTimeout = datetime.now() + timedelta(
-                            milliseconds=capturePeriod
-                        )
-            delay = 0.005
-            time.sleep(delay)
+                        next_capture = time.monotonic() + config.capturePeriod / 1000.0
+                deadline = min(deadline, next_capture)
+            # Sleep until the next move or capture, or a message
+            move_schedule.wait(deadline)
         else:
-            delay = 1
-            time.sleep(delay)
+            next_move = next_capture = None
+            if velocity_control is not None:
+                # Stop the continuous move the aircraft was tracked with
+                velocity_control.stop()
+            # Park where the next aircraft is expected to show up, so it
+            # can be photographed without slewing across the sky first
+            waiting = preposition
+            if waiting is not None and waiting is not parked:
+                pan, tilt = calculateCameraPositionPreposition(
+                    r_XYZ_t, E_XYZ_to_uvw, waiting
+                )
+                camera.absolute_move(
+                    pan, tilt, config.cameraZoom, config.cameraMoveSpeed
+                )
+                if pointing_telemetry is not None:
+                    pointing_telemetry.commanded(pan, tilt)
+                logging.info(
+                    "{}\t[PARKING]\tPan: {:.1f} \tTilt: {:.1f} \tIn: {:.0f}s".format(
+                        waiting["icao24"], pan, tilt, waiting["time"] - time.time()
+                    )
+                )
+                parked = waiting
+            # Sleep until a message, the next aircraft or a pre-position
+            move_schedule.wait(time.monotonic() + IDLE_WAIT)
 
 
 def update_config(config):
-    global cameraZoom
-    global cameraMoveSpeed
-    global cameraDelay
-    global cameraPan
-    global camera_lead
-    global camera_longitude
-    global camera_latitude
-    global camera_altitude
-    global cameraBearingCorrection
-    global inhibitPhotos
-    global capturePeriod
-    global camera_roll
-    global camera_pitch
-    global camera_yaw
+    changes = {}
 
     if "cameraZoom" in config:
-        cameraZoom = int(config["cameraZoom"])
-        logging.info("Setting Camera Zoom to: {}".format(cameraZoom))
+        changes["cameraZoom"] = int(config["cameraZoom"])
+        logging.info("Setting Camera Zoom to: {}".format(changes["cameraZoom"]))
     if "cameraDelay" in config:
-        cameraDelay = float(config["cameraDelay"])
-        logging.info("Setting Camera Delay to: {}".format(cameraDelay))
+        changes["cameraDelay"] = float(config["cameraDelay"])
+        logging.info("Setting Camera Delay to: {}".format(changes["cameraDelay"]))
     if "cameraMoveSpeed" in config:
-        cameraMoveSpeed = int(config["cameraMoveSpeed"])
-        logging.info("Setting Camera Move Speed to: {}".format(cameraMoveSpeed))
+        changes["cameraMoveSpeed"] = int(config["cameraMoveSpeed"])
+        logging.info(
+            "Setting Camera Move Speed to: {}".format(changes["cameraMoveSpeed"])
+        )
     if "cameraLead" in config:
-        camera_lead = float(config["cameraLead"])
-        logging.info("Setting Camera Lead to: {}".format(camera_lead))
+        changes["camera_lead"] = float(config["cameraLead"])
+        logging.info("Setting Camera Lead to: {}".format(changes["camera_lead"]))
     if "cameraAltitude" in config:
-        camera_altitude = float(config["cameraAltitude"])
-        logging.info("Setting Camera Altitude to: {}".format(camera_altitude))
+        changes["camera_altitude"] = float(config["cameraAltitude"])
+        logging.info(
+            "Setting Camera Altitude to: {}".format(changes["camera_altitude"])
+        )
     if "cameraLatitude" in config:
-        camera_latitude = float(config["cameraLatitude"])
-        logging.info("Setting Camera Latitude to: {}".format(camera_latitude))
+        changes["camera_latitude"] = float(config["cameraLatitude"])
+        logging.info(
+            "Setting Camera Latitude to: {}".format(changes["camera_latitude"])
+        )
     if "cameraLongitude" in config:
-        camera_longitude = float(config["cameraLongitude"])
-        logging.info("Setting Camera Longitude to: {}".format(camera_longitude))
+        changes["camera_longitude"] = float(config["cameraLongitude"])
+        logging.info(
+            "Setting Camera Longitude to: {}".format(changes["camera_longitude"])
+        )
     if "cameraBearingCorrection" in config:
-        cameraBearingCorrection = float(config["cameraBearingCorrection"])
+        changes["cameraBearingCorrection"] = float(config["cameraBearingCorrection"])
         logging.info(
-            "Setting Camera Bearing Correction to: {}".format(cameraBearingCorrection)
+            "Setting Camera Bearing Correction to: {}".format(
+                changes["cameraBearingCorrection"]
+            )
         )
     if "inhibitPhotos" in config:
-        inhibitPhotos = bool(config["inhibitPhotos"])
-        if inhibitPhotos:
+        changes["inhibitPhotos"] = bool(config["inhibitPhotos"])
+        if changes["inhibitPhotos"]:
             logging.info("Setting Camera to inhibit photos")
         else:
             logging.info("Setting Camera to save photos")
     if "capturePeriod" in config:
-        capturePeriod = float(config["capturePeriod"])
-        logging.info("Setting Camera Capture Period (sec) to: {}".format(capturePeriod))
+        changes["capturePeriod"] = float(config["capturePeriod"])
+        logging.info(
+            "Setting Camera Capture Period (sec) to: {}".format(
+                changes["capturePeriod"]
+            )
+        )
+    if "sunExclusion" in config:
+        changes["sun_exclusion"] = float(config["sunExclusion"])
+        logging.info("Setting Sun Exclusion to: {}".format(changes["sun_exclusion"]))
     if "cameraRoll" in config:
-        camera_roll = float(config["cameraRoll"])
-        logging.info("Setting Camera Roll Angle to: {}".format(camera_roll))
+        changes["camera_roll"] = float(config["cameraRoll"])
+        logging.info("Setting Camera Roll Angle to: {}".format(changes["camera_roll"]))
     if "cameraPitch" in config:
-        camera_pitch = float(config["cameraPitch"])
-        logging.info("Setting Camera Pitch Angle to: {}".format(camera_pitch))
+        changes["camera_pitch"] = float(config["cameraPitch"])
+        logging.info(
+            "Setting Camera Pitch Angle to: {}".format(changes["camera_pitch"])
+        )
     if "cameraYaw" in config:
-        camera_yaw = float(config["cameraYaw"])
-        logging.info("Setting Camera Yaw Angle to: {}".format(camera_yaw))
+        changes["camera_yaw"] = float(config["cameraYaw"])
+        logging.info("Setting Camera Yaw Angle to: {}".format(changes["camera_yaw"]))
+
+    # Swap all of the changes in at once so readers never see half an update
+    config_store.update(**changes)
+    if lead_calibration is not None and "camera_lead" in changes:
+        # Calibrate from the lead set by hand again
+        lead_calibration.reset(changes["camera_lead"])
 
 
 #############################################
@@ -721,12 +979,7 @@ def on_message(client, userdata, message):
 def on_message_impl(client, userdata, message):
     global currentPlane
     global object_timeout
-    global camera_longitude
-    global camera_latitude
-    global camera_altitude
-    global camera_roll
-    global camera_pitch
-    global camera_yaw
+    global preposition
 
     global active
 
@@ -773,23 +1026,40 @@ def on_message_impl(client, userdata, message):
             # It is better to just have the old values for currentPlane in case a message comes in while the
             # moveCamera Thread is running.
             # currentPlane = {}
+    elif message.topic == preposition_topic:
+        # Only park for the aircraft expected first, and only while it is ahead
+        if "icao24" in update and update["time"] > time.time():
+            if preposition is None or not (
+                update["icao24"] == preposition["icao24"]
+                and utils.coordinate_distance(
+                    update["lat"], update["lon"], preposition["lat"], preposition["lon"]
+                )
+                < PREPOSITION_TOLERANCE
+            ):
+                preposition = update
+        else:
+            preposition = None
     elif message.topic == config_topic:
         update_config(update)
         logging.info("Config Message: {}".format(update))
     elif message.topic == "skyscan/egi":
         # logging.info(update)
-        camera_longitude = float(update["long"])
-        camera_latitude = float(update["lat"])
-        camera_altitude = float(update["alt"])
-        camera_roll = float(update["roll"])
-        camera_pitch = float(update["pitch"])
-        camera_yaw = float(update["yaw"])
+        config_store.update(
+            camera_longitude=float(update["long"]),
+            camera_latitude=float(update["lat"]),
+            camera_altitude=float(update["alt"]),
+            camera_roll=float(update["roll"]),
+            camera_pitch=float(update["pitch"]),
+            camera_yaw=float(update["yaw"]),
+        )
     else:
         logging.info(
             "Message: {} Object: {} Flight: {}".format(
                 message.topic, object_topic, flight_topic
             )
         )
+    # Whatever the message changed, the move loop acts on it now
+    move_schedule.wake()
 
 
 def on_disconnect(client, userdata, rc):
@@ -802,23 +1072,20 @@ def main():
     global args
     global logging
     global camera
-    global cameraDelay
-    global cameraMoveSpeed
-    global cameraZoom
     global cameraPan
-    global camera_altitude
-    global camera_latitude
-    global camera_longitude
-    global camera_roll
-    global camera_pitch
-    global camera_yaw
-    global camera_lead
     global cameraConfig
     global flight_topic
     global object_topic
+    global preposition_topic
     global publish_topic
     global logging_directory
     global Active
+    global vapix_client
+    global mjpeg_grabber
+    global capture_scheduler
+    global velocity_control
+    global pointing_telemetry
+    global lead_calibration
 
     parser = argparse.ArgumentParser(description="An MQTT based camera controller")
     parser.add_argument("--lat", type=float, help="Latitude of camera")
@@ -845,6 +1112,11 @@ def main():
         help="MQTT topic to subscribe to",
         default="skyscan/flight/json",
     )
+    parser.add_argument(
+        "--mqtt-preposition-topic",
+        help="MQTT topic with where to wait for the next aircraft, empty to disable",
+        default="skyscan/preposition/json",
+    )
     parser.add_argument(
         "--mqtt-object-topic",
         help="MQTT topic to subscribe to",
@@ -880,6 +1152,12 @@ def main():
         help="The zoom setting for the camera (0-9999)",
         default=9999,
     )
+    parser.add_argument(
+        "--sun-exclusion",
+        type=float,
+        help="Never point the camera within this many degrees of the sun, 0 to disable",
+        default=sun.SUN_EXCLUSION,
+    )
     parser.add_argument(
         "-l",
         "--log-directory",
@@ -899,6 +1177,112 @@ def main():
         help="The topic to publish capture information to",
         default="skyscan/captures/data"
     )
+    parser.add_argument(
+        "--capture-schedule",
+        choices=["burst", "period"],
+        help="Capture in bursts around closest approach and peak elevation, or every capturePeriod",
+        default="burst",
+    )
+    parser.add_argument(
+        "--burst-period",
+        type=float,
+        help="Seconds between captures in a burst",
+        default=burst.BURST_PERIOD,
+    )
+    parser.add_argument(
+        "--sparse-period",
+        type=float,
+        help="Seconds between captures outside the bursts",
+        default=burst.SPARSE_PERIOD,
+    )
+    parser.add_argument(
+        "--burst-window",
+        type=float,
+        help="Seconds either side of closest approach and peak elevation captured in a burst",
+        default=burst.BURST_WINDOW,
+    )
+    parser.add_argument(
+        "--frame-budget",
+        type=int,
+        help="Images taken of an aircraft in a pass, at most",
+        default=burst.FRAME_BUDGET,
+    )
+    parser.add_argument(
+        "--byte-budget",
+        type=float,
+        help="Megabytes of images taken of an aircraft in a pass, at most",
+        default=burst.BYTE_BUDGET / 1e6,
+    )
+    parser.add_argument(
+        "--capture-mode",
+        choices=["image", "mjpeg"],
+        help="Take every image with its own request to the camera, or keep its MJPEG stream open and take the frame nearest to each capture",
+        default="image",
+    )
+    parser.add_argument(
+        "--mjpeg-fps",
+        type=int,
+        help="Frames per second of the MJPEG stream, in the mjpeg capture mode",
+        default=mjpeg.FPS,
+    )
+    parser.add_argument(
+        "--ptz-mode",
+        choices=["absolute", "velocity"],
+        help="Send an absolute move every move period, or move the camera continuously at the rates of the aircraft with absolute moves to correct it",
+        default="absolute",
+    )
+    parser.add_argument(
+        "--max-ptz-rate",
+        type=float,
+        help="Pan and tilt rate of the camera at a continuous move speed of 100 [deg/s], in the velocity PTZ mode",
+        default=velocity.MAX_RATE,
+    )
+    parser.add_argument(
+        "--ptz-deadband",
+        type=float,
+        help="Change in pan or tilt rate [deg/s] below which no continuous move is sent, in the velocity PTZ mode",
+        default=velocity.DEADBAND,
+    )
+    parser.add_argument(
+        "--correction-error",
+        type=float,
+        help="Pointing error [deg] corrected with an absolute move, in the velocity PTZ mode",
+        default=velocity.CORRECTION_ERROR,
+    )
+    parser.add_argument(
+        "--position-rate",
+        type=float,
+        help="Times a second the position of the camera is queried to measure the pointing error, 0 not to query it",
+        default=telemetry.POSITION_RATE,
+    )
+    parser.add_argument(
+        "--telemetry-topic",
+        help="MQTT topic to publish the pointing error and settle time histograms on",
+        default="skyscan/ptz/telemetry",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Port to serve the stats of the camera as JSON on at /metrics, 0 not to serve them",
+        default=0,
+    )
+    parser.add_argument(
+        "--auto-lead",
+        action="store_true",
+        help="Calibrate the camera lead from how far behind the aircraft the queried positions of the camera are, for each class of angular rate",
+    )
+    parser.add_argument(
+        "--lead-smoothing",
+        type=float,
+        help="Weight of a new measurement in the calibrated camera lead, with --auto-lead",
+        default=lead.SMOOTHING,
+    )
+    parser.add_argument(
+        "--max-lead",
+        type=float,
+        help="Largest camera lead [s] calibrated to, with --auto-lead",
+        default=lead.MAX_LEAD,
+    )
     parser.add_argument(
         "-f",
         "--flat-file-structure",
@@ -947,23 +1331,46 @@ def main():
         "---[ Starting %s ]---------------------------------------------" % sys.argv[0]
     )
     # camera = vapix_control.CameraControl(args.axis_ip, args.axis_username, args.axis_password)
-    cameraDelay = args.camera_delay
-    cameraMoveSpeed = args.camera_move_speed
-    cameraZoom = args.camera_zoom
-    camera_longitude = args.lon
-    camera_latitude = args.lat
-    camera_altitude = args.alt  # Altitude is in METERS
-    camera_roll = args.roll
-    camera_pitch = args.pitch
-    camera_yaw = args.yaw  # Altitude is in METERS
-    camera_lead = args.camera_lead
+    config_store.update(
+        cameraDelay=args.camera_delay,
+        cameraMoveSpeed=args.camera_move_speed,
+        cameraZoom=args.camera_zoom,
+        camera_longitude=args.lon,
+        camera_latitude=args.lat,
+        camera_altitude=args.alt,  # Altitude is in METERS
+        camera_roll=args.roll,
+        camera_pitch=args.pitch,
+        camera_yaw=args.yaw,
+        camera_lead=args.camera_lead,
+        sun_exclusion=args.sun_exclusion,
+    )
     # cameraConfig = vapix_config.CameraConfiguration(args.axis_ip, args.axis_username, args.axis_password)
 
     logging_directory = args.log_directory
 
     flight_topic = args.mqtt_flight_topic
     object_topic = args.mqtt_object_topic
+    preposition_topic = args.mqtt_preposition_topic or None
     publish_topic = args.publish_topic
+    vapix_client = vapix.VapixClient(args.axis_ip, args.axis_username, args.axis_password)
+    if args.capture_schedule == "burst":
+        capture_scheduler = burst.CaptureScheduler(
+            burst_period=args.burst_period,
+            sparse_period=args.sparse_period,
+            burst_window=args.burst_window,
+            frame_budget=args.frame_budget,
+            byte_budget=int(args.byte_budget * 1e6),
+        )
+    if args.ptz_mode == "velocity":
+        velocity_control = velocity.VelocityControl(
+            vapix_client,
+            max_rate=args.max_ptz_rate,
+            deadband=args.ptz_deadband,
+            correction_error=args.correction_error,
+        )
+    if args.capture_mode == "mjpeg":
+        mjpeg_grabber = mjpeg.MjpegGrabber(vapix_client, fps=args.mjpeg_fps)
+        mjpeg_grabber.start()
     print(
         "connecting to MQTT broker at "
         + args.mqtt_host
@@ -980,6 +1387,8 @@ def main():
     client.loop_start()  # start the loop
     client.subscribe(flight_topic)
     client.subscribe(object_topic)
+    if preposition_topic:
+        client.subscribe(preposition_topic)
     client.subscribe(config_topic)
     client.subscribe("skyscan/egi")
     client.publish(
@@ -988,6 +1397,42 @@ def main():
         0,
         False,
     )
+    if args.auto_lead:
+        if args.position_rate > 0:
+            lead_calibration = lead.LeadCalibration(
+                args.camera_lead,
+                smoothing=args.lead_smoothing,
+                max_lead=args.max_lead,
+            )
+        else:
+            logging.warning("The camera lead is calibrated from the queried positions, set --position-rate")
+    if args.position_rate > 0:
+        pointing_telemetry = telemetry.PointingTelemetry(
+            vapix_client,
+            rate=args.position_rate,
+            publish=lambda stats: client.publish(
+                args.telemetry_topic, json.dumps(stats), 0, False
+            ),
+            calibration=lead_calibration,
+        )
+        pointing_telemetry.start()
+    if args.metrics_port:
+        sources = {
+            "vapix": vapix_client.stats,
+            "move": move_lag.summary,
+            "wake": move_schedule.stats,
+        }
+        if pointing_telemetry is not None:
+            sources["pointing"] = pointing_telemetry.stats
+        if lead_calibration is not None:
+            sources["lead"] = lead_calibration.stats
+        if velocity_control is not None:
+            sources["ptz"] = velocity_control.stats
+        if mjpeg_grabber is not None:
+            sources["mjpeg"] = mjpeg_grabber.stats
+        # The pipeline is made by the move loop
+        sources["capture"] = lambda: capture_pipeline.stats() if capture_pipeline else None
+        telemetry.MetricsServer(("", args.metrics_port), sources).start()
 
     cameraMove = threading.Thread(
         target=moveCamera,
@@ -1003,6 +1448,7 @@ def main():
     ##                Main Loop                ##
     #############################################
     timeHeartbeat = 0
+    timeVapixStats = time.monotonic() + VAPIX_STATS_INTERVAL
     while Active:
         if timeHeartbeat < time.mktime(time.gmtime()):
             timeHeartbeat = time.mktime(time.gmtime()) + 10
@@ -1017,6 +1463,25 @@ def main():
                     "Thread within Axis-PTZ has failed!  Killing container."
                 )
                 Active = False
+        if timeVapixStats < time.monotonic():
+            timeVapixStats = time.monotonic() + VAPIX_STATS_INTERVAL
+            logging.info("[VAPIX]\t{}".format(json.dumps(vapix_client.stats())))
+            if velocity_control is not None:
+                logging.info("[PTZ]\t{}".format(json.dumps(velocity_control.stats())))
+            if mjpeg_grabber is not None:
+                logging.info("[MJPEG]\t{}".format(json.dumps(mjpeg_grabber.stats())))
+            if pointing_telemetry is not None:
+                logging.info("[POINTING]\t{}".format(json.dumps(pointing_telemetry.stats())))
+            if lead_calibration is not None:
+                logging.info("[LEAD]\t{}".format(json.dumps(lead_calibration.stats())))
+            if capture_pipeline is not None:
+                logging.info(
+                    "[LAG]\tMove: {}\tWake: {}\tCapture: {}".format(
+                        json.dumps(move_lag.summary()),
+                        json.dumps(move_schedule.stats()),
+                        json.dumps(capture_pipeline.stats()),
+                    )
+                )
 
         delay = 0.1
         time.sleep(delay)
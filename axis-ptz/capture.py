@@ -0,0 +1,194 @@
+"""
+Image capture off the thread that points the camera
+
+The move loop only triggers captures: the metadata (camera and aircraft
+position, file name) is stamped at the time of the trigger and the trigger
+is queued, which never blocks. A fetch worker waits out the camera delay
+and takes the image, and a pool of writers saves it and publishes the
+metadata. Pointing and capture no longer wait on each other: a slow camera
+or disk delays the images, not the PTZ commands.
+
+When the camera cannot keep up, the oldest waiting trigger is dropped, as a
+newer one shows the aircraft where it is now. When the disk cannot keep up,
+the fetch worker waits for a free writer, so the images already taken are
+kept.
+"""
+
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+from typing import *
+
+# Triggers waiting for the fetch worker before the oldest is dropped
+TRIGGER_QUEUE_SIZE = 2
+# Images waiting for a writer before the fetch worker waits
+WRITE_QUEUE_SIZE = 8
+# Threads writing images and publishing their metadata
+WRITERS = 2
+# Lags kept to compute percentiles from
+LAG_WINDOW = 256
+
+
+class Lag:
+    """How late a periodic task runs"""
+
+    def __init__(self, window: int = LAG_WINDOW):
+        self.count = 0
+        self.late = 0
+        self.recent = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        """Keep the lag of one run, 0 or less when it was on time"""
+        with self.lock:
+            self.count += 1
+            if seconds > 0.0:
+                self.late += 1
+            self.recent.append(max(0.0, seconds))
+
+    def summary(self) -> Dict[str, Any]:
+        """Runs, late runs, and median, 95th percentile and maximum of the recent lags in seconds"""
+        with self.lock:
+            ordered = sorted(self.recent)
+            summary = {"count": self.count, "late": self.late}
+        if ordered:
+            summary["p50"] = ordered[len(ordered) // 2]
+            summary["p95"] = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            summary["max"] = ordered[-1]
+        return summary
+
+
+class Trigger(NamedTuple):
+    """A capture, as of when it was triggered"""
+
+    due: float  # Monotonic time to take the image at
+    filepath: str  # Where to save it
+    metadata: Dict[str, Any]  # Published once it is saved
+
+
+class CapturePipeline:
+    """Trigger queue, fetch worker and writer pool"""
+
+    def __init__(
+        self,
+        fetch: Callable[[float], Tuple[Optional[bytes], Dict[str, float]]],
+        publish: Callable[[Dict[str, Any]], Any],
+        record_disk: Callable[[float], Any] = None,
+        writers: int = WRITERS,
+        trigger_queue_size: int = TRIGGER_QUEUE_SIZE,
+        write_queue_size: int = WRITE_QUEUE_SIZE,
+    ):
+        """Start the fetch worker and the writers
+
+        Arguments:
+            fetch {Callable[[float], Tuple[Optional[bytes], Dict[str, float]]]} -- Takes an image for the monotonic time it is due, returns it (None if it failed) and its timing
+            publish {Callable[[Dict[str, Any]], Any]} -- Publishes the metadata of a saved image
+
+        Keyword Arguments:
+            record_disk {Callable[[float], Any]} -- Keeps the time it took to save an image (default: {None})
+            writers {int} -- Threads saving images (default: {2})
+            trigger_queue_size {int} -- Triggers waiting before the oldest is dropped (default: {2})
+            write_queue_size {int} -- Images waiting before the fetch worker waits (default: {8})
+        """
+        self.fetch = fetch
+        self.publish = publish
+        self.record_disk = record_disk
+        self.triggers = queue.Queue(maxsize=trigger_queue_size)
+        self.writes = queue.Queue(maxsize=write_queue_size)
+        self.lag = Lag()  # From when an image was due to when it was asked for
+        self.counts = {"triggered": 0, "dropped": 0, "failed": 0, "saved": 0}
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._fetch_loop, daemon=True)]
+        self.threads += [
+            threading.Thread(target=self._write_loop, daemon=True) for _ in range(writers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def trigger(self, filepath: str, metadata: Dict[str, Any], delay: float = 0.0):
+        """Queue a capture, without waiting
+
+        Arguments:
+            filepath {str} -- Where to save the image
+            metadata {Dict[str, Any]} -- Metadata as of now, published once the image is saved
+
+        Keyword Arguments:
+            delay {float} -- Seconds to wait before taking the image, for the camera to settle (default: {0.0})
+        """
+        item = Trigger(time.monotonic() + delay, filepath, metadata)
+        self._count("triggered")
+        while True:
+            try:
+                self.triggers.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.triggers.get_nowait()
+                    self._count("dropped")
+                except queue.Empty:
+                    pass
+
+    def _fetch_loop(self):
+        while True:
+            item = self.triggers.get()
+            if item is None:
+                for _ in self.threads[1:]:
+                    self.writes.put(None)
+                return
+            wait = item.due - time.monotonic()
+            if wait > 0.0:
+                time.sleep(wait)
+            started = time.monotonic()
+            self.lag.add(started - item.due)
+            try:
+                image, fetch_timing = self.fetch(item.due)
+            except Exception as e:
+                logging.error("Unable to take image: {}".format(e))
+                image = None
+            if image is None:
+                self._count("failed")
+                continue
+            timing = dict(fetch_timing, lag=max(0.0, started - item.due))
+            self.writes.put((item, image, timing))
+
+    def _write_loop(self):
+        while True:
+            work = self.writes.get()
+            if work is None:
+                return
+            item, image, timing = work
+            try:
+                start = time.monotonic()
+                os.makedirs(os.path.dirname(item.filepath) or ".", exist_ok=True)
+                with open(item.filepath, "wb") as f:
+                    f.write(image)
+                timing["disk"] = time.monotonic() - start
+                if self.record_disk:
+                    self.record_disk(timing["disk"])
+                self._count("saved")
+                self.publish(dict(item.metadata, timing=timing, imagebytes=len(image)))
+            except Exception as e:
+                self._count("failed")
+                logging.error("Unable to save image {}: {}".format(item.filepath, e))
+
+    def stats(self) -> Dict[str, Any]:
+        """Counts of the captures, capture lag and queue lengths"""
+        with self.lock:
+            stats = dict(self.counts)
+        stats["lag"] = self.lag.summary()
+        stats["waiting"] = self.triggers.qsize()
+        stats["writing"] = self.writes.qsize()
+        return stats
+
+    def close(self, timeout: float = None):
+        """Take and save the captures already triggered, and stop the threads"""
+        self.triggers.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
@@ -0,0 +1,164 @@
+"""Immutable runtime configuration for the camera controller.
+
+The MQTT callback thread receives configuration and EGI updates while
+the move loop is in the middle of pointing computations. Instead of
+rewriting module globals field by field, every update builds a new
+frozen snapshot which is swapped in by reference. Readers grab one
+snapshot per computation, and compare `version` to decide whether
+cached derived state, such as rotation matrices, must be rebuilt.
+
+The topocentric frame of the tripod is derived from its position the
+same way: it is rebuilt once when an EGI update moves the tripod further
+than GPS jitter, and swapped in as a new frozen snapshot.
+"""
+import threading
+from typing import NamedTuple
+
+import numpy as np
+
+import utils
+
+# Distance the tripod has to move from where its frame was computed
+# before the frame is recomputed, so GPS jitter is ignored
+FRAME_THRESHOLD = 5.0  # [m]
+
+
+class CameraConfig(NamedTuple):
+    """A frozen view of the camera controller's runtime configuration."""
+
+    camera_latitude: float = None  # [deg]
+    camera_longitude: float = None  # [deg]
+    camera_altitude: float = None  # [m]
+    camera_roll: float = 0.0  # [deg]
+    camera_pitch: float = 0.0  # [deg]
+    camera_yaw: float = 0.0  # [deg]
+    camera_lead: float = None  # [s]
+    cameraZoom: int = None
+    cameraMoveSpeed: int = None
+    cameraDelay: float = None  # [s]
+    cameraBearingCorrection: float = 0.0  # [deg]
+    inhibitPhotos: bool = False
+    capturePeriod: float = 1000  # [ms]
+    sun_exclusion: float = None  # [deg]
+    version: int = 0
+
+
+class ConfigStore:
+    """Holds the current configuration snapshot.
+
+    Reads are a single reference load and need no lock, writers are
+    serialized so that no update is lost.
+    """
+
+    def __init__(self, config):
+        self._lock = threading.Lock()
+        self._config = config
+
+    def get(self):
+        """Return the current configuration snapshot."""
+        return self._config
+
+    def version(self):
+        """Return the version of the current configuration snapshot."""
+        return self._config.version
+
+    def update(self, **changes):
+        """Swap in a new snapshot with the given fields changed.
+
+        The version is only bumped if a value actually changed, so
+        repeated EGI messages do not invalidate cached state.
+
+        Parameters
+        ----------
+        changes : dict
+            Field names and their new values
+
+        Returns
+        -------
+        CameraConfig
+            The snapshot in effect after the update
+        """
+        with self._lock:
+            current = self._config
+            changed = {k: v for k, v in changes.items() if getattr(current, k) != v}
+            if changed:
+                self._config = current._replace(
+                    version=current.version + 1, **changed
+                )
+            return self._config
+
+
+class TripodFrame(NamedTuple):
+    """A frozen topocentric frame of the tripod, at the position it was
+    computed for."""
+
+    latitude: float  # [deg]
+    longitude: float  # [deg]
+    altitude: float  # [m]
+    E_XYZ_to_ENz: np.ndarray  # From geocentric to topocentric coordinates
+    e_E_XYZ: np.ndarray  # East unit vector
+    e_N_XYZ: np.ndarray  # North unit vector
+    e_z_XYZ: np.ndarray  # Zenith unit vector
+    r_XYZ_t: np.ndarray  # Position of the tripod [m]
+    version: int = 0
+
+
+class TripodFrameStore:
+    """Holds the frame of the tripod, recomputed when the tripod moves.
+
+    The frame is only compared against configuration snapshots with a
+    new version, and only recomputed when the position moved further
+    than the threshold from where the current frame was computed, so
+    small moves add up until they are not ignored any more.
+    """
+
+    def __init__(self, threshold=FRAME_THRESHOLD):
+        self._lock = threading.Lock()
+        self._threshold = threshold
+        # Configuration version last compared, and the frame for it
+        self._cached = (None, None)
+
+    def get(self, config):
+        """Return the frame for the position in a configuration snapshot.
+
+        Parameters
+        ----------
+        config : CameraConfig
+            Snapshot with the position of the tripod
+
+        Returns
+        -------
+        TripodFrame
+            The current frame, a new one if the tripod moved
+        """
+        version, frame = self._cached
+        if version == config.version and frame is not None:
+            return frame
+        with self._lock:
+            version, frame = self._cached
+            if version != config.version or frame is None:
+                r_XYZ_t = utils.compute_r_XYZ(
+                    config.camera_longitude,
+                    config.camera_latitude,
+                    config.camera_altitude,
+                )
+                if (
+                    frame is None
+                    or np.linalg.norm(r_XYZ_t - frame.r_XYZ_t) > self._threshold
+                ):
+                    E_XYZ_to_ENz, e_E_XYZ, e_N_XYZ, e_z_XYZ = utils.compute_E(
+                        config.camera_longitude, config.camera_latitude
+                    )
+                    frame = TripodFrame(
+                        config.camera_latitude,
+                        config.camera_longitude,
+                        config.camera_altitude,
+                        E_XYZ_to_ENz,
+                        e_E_XYZ,
+                        e_N_XYZ,
+                        e_z_XYZ,
+                        r_XYZ_t,
+                        0 if frame is None else frame.version + 1,
+                    )
+                self._cached = (config.version, frame)
+            return frame
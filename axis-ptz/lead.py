@@ -0,0 +1,113 @@
+"""
+Calibration of the camera lead from the measured pointing error
+
+camera_lead is how far ahead of the aircraft the camera is pointed, to
+make up for the age of the position, the time to send the move and the
+time the camera takes to get there. It used to be set by hand at every
+site. With the position of the camera queried (see telemetry.py), every
+position tells how far behind the aircraft, along its motion, the camera
+is in seconds: the lead the pointing was computed with plus that is the
+lead that would have centered it. That is smoothed exponentially, and
+clamped, into a lead for each class of angular rate of the aircraft, as
+a camera that slews to keep up is further behind fast aircraft.
+"""
+
+import bisect
+import math
+import threading
+from typing import *
+
+# Weight of a new measurement in the smoothed lead
+SMOOTHING = 0.05
+# Bounds of the calibrated lead [s]
+MIN_LEAD = 0.0
+MAX_LEAD = 2.0
+# Seconds behind or ahead of the aircraft beyond which the camera is not tracking it, and the measurement is ignored
+MAX_BEHIND = 1.0
+# Upper bounds of the angular rates of the aircraft of the classes calibrated separately [deg/s]
+RATE_CLASSES = (1.0, 3.0, 10.0)
+
+
+class LeadCalibration:
+    """Smoothed lead for each class of angular rate of the aircraft"""
+
+    def __init__(
+        self,
+        lead: float,
+        smoothing: float = SMOOTHING,
+        min_lead: float = MIN_LEAD,
+        max_lead: float = MAX_LEAD,
+        rate_classes: Sequence[float] = RATE_CLASSES,
+    ):
+        """Start every class from the configured lead
+
+        Arguments:
+            lead {float} -- Configured camera lead [s]
+
+        Keyword Arguments:
+            smoothing {float} -- Weight of a new measurement (default: {0.05})
+            min_lead {float} -- Smallest lead calibrated to [s] (default: {0.0})
+            max_lead {float} -- Largest lead calibrated to [s] (default: {2.0})
+            rate_classes {Sequence[float]} -- Upper bounds of the angular rates of the classes, a last class takes the rates above them [deg/s] (default: {(1.0, 3.0, 10.0)})
+        """
+        self.smoothing = smoothing
+        self.min_lead = min_lead
+        self.max_lead = max_lead
+        self.rate_classes = tuple(rate_classes)
+        self.lock = threading.Lock()
+        self.reset(lead)
+
+    def reset(self, lead: float):
+        """Start every class from a lead again, when it is configured
+
+        Arguments:
+            lead {float} -- Configured camera lead [s]
+        """
+        with self.lock:
+            self.configured = lead
+            self.leads = [lead] * (len(self.rate_classes) + 1)
+            self.measurements = [0] * (len(self.rate_classes) + 1)
+            self.ignored = 0
+
+    def lead(self, rate: float) -> float:
+        """Lead to point the camera at an aircraft with
+
+        Arguments:
+            rate {float} -- Angular rate of the aircraft, seen from the camera [deg/s]
+
+        Returns:
+            float -- Calibrated lead [s]
+        """
+        with self.lock:
+            return self.leads[bisect.bisect_left(self.rate_classes, abs(rate))]
+
+    def measured(self, rate: float, lead: float, behind: float):
+        """Move the lead of the class of an aircraft towards the one that would have centered it
+
+        Arguments:
+            rate {float} -- Angular rate of the aircraft, seen from the camera [deg/s]
+            lead {float} -- Lead the pointing was computed with [s]
+            behind {float} -- Seconds the camera was behind the aircraft along its motion, negative ahead of it
+        """
+        with self.lock:
+            if abs(behind) > MAX_BEHIND or math.isnan(behind):
+                self.ignored += 1
+                return
+            index = bisect.bisect_left(self.rate_classes, abs(rate))
+            target = min(self.max_lead, max(self.min_lead, lead + behind))
+            self.leads[index] += self.smoothing * (target - self.leads[index])
+            self.measurements[index] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Configured lead, and lead and measurements of every class"""
+        with self.lock:
+            # The last class has no upper bound
+            bounds = list(self.rate_classes) + [None]
+            return {
+                "configured": self.configured,
+                "ignored": self.ignored,
+                "classes": [
+                    {"rate": bound, "lead": lead, "measurements": measurements}
+                    for bound, lead, measurements in zip(bounds, self.leads, self.measurements)
+                ],
+            }
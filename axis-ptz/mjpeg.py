@@ -0,0 +1,251 @@
+"""
+Streaming capture from the camera's MJPEG stream
+
+Taking every image with its own image.cgi request bounds the capture rate
+by the request latency. The grabber keeps one video.cgi (multipart MJPEG)
+connection open instead, cuts the JPEG frames out of the stream as they
+arrive, and keeps the latest ones in a ring with the time each was
+received. A capture then takes the frame nearest to the time it was due,
+at up to the stream's frame rate and without any more requests to the
+camera.
+
+The scanner works on one buffer that the stream is read into: it looks for
+the part headers from an offset, skips the body with the Content-Length the
+camera sends (or scans for the next boundary when there is none), and only
+copies a frame out when it is complete.
+"""
+
+import collections
+import logging
+import re
+import threading
+import time
+from typing import *
+
+import requests
+
+# Frames kept in the ring
+RING_SIZE = 50
+# Frames per second asked from the camera
+FPS = 10
+# Bytes read from the stream at a time, at most
+READ_SIZE = 65536
+# Seconds to wait before connecting again after the stream fails
+RECONNECT_DELAY = 1.0
+# Seconds a frame can be away from the time it is wanted for
+FRAME_TOLERANCE = 0.5
+
+MJPEG_PAYLOAD = {
+    "resolution": "1920x1080",
+    "compression": 5,
+    "camera": 1,
+}
+
+CONTENT_LENGTH = re.compile(rb"content-length:\s*(\d+)", re.IGNORECASE)
+
+
+class Frame(NamedTuple):
+    """A JPEG frame, with when it was received"""
+
+    monotonic: float  # time.monotonic() when its last byte arrived
+    time: float  # time.time() when its last byte arrived
+    data: bytes
+
+
+class MultipartScanner:
+    """Cuts the parts out of a multipart/x-mixed-replace stream"""
+
+    def __init__(self, boundary: bytes):
+        """Start with an empty buffer
+
+        Arguments:
+            boundary {bytes} -- Boundary of the parts, from the Content-Type of the stream
+        """
+        self.delimiter = b"\r\n--" + boundary
+        self.buffer = bytearray()
+        self.position = 0  # Start of what is not parsed yet
+        self.body = None  # Start of the body of the current part, once its headers are parsed
+        self.length = None  # Content-Length of the current part, None if it has none
+        self.scan = None  # Where to look for the end of a part without Content-Length from
+
+    def feed(self, data) -> List[bytes]:
+        """Add bytes from the stream
+
+        Arguments:
+            data {bytes-like} -- The next bytes of the stream
+
+        Returns:
+            List[bytes] -- The parts completed by them
+        """
+        if not self.buffer:
+            # The first delimiter has no line break before it
+            self.buffer += b"\r\n"
+        self.buffer += data
+        parts = []
+        buffer = self.buffer
+        while True:
+            if self.body is None:
+                start = buffer.find(self.delimiter, self.position)
+                if start < 0:
+                    # Keep what could be the start of a delimiter
+                    self.position = max(self.position, len(buffer) - len(self.delimiter))
+                    break
+                end = buffer.find(b"\r\n\r\n", start)
+                if end < 0:
+                    self.position = start
+                    break
+                match = CONTENT_LENGTH.search(buffer, start, end)
+                self.length = int(match.group(1)) if match else None
+                self.body = end + 4
+                self.scan = self.body
+            if self.length is not None:
+                end = self.body + self.length
+                if len(buffer) < end:
+                    break
+            else:
+                end = buffer.find(self.delimiter, self.scan)
+                if end < 0:
+                    self.scan = max(self.body, len(buffer) - len(self.delimiter))
+                    break
+            parts.append(bytes(memoryview(buffer)[self.body : end]))
+            self.position = end
+            self.body = None
+        if self.position > READ_SIZE:
+            # Drop what has been parsed, now and then rather than on every part
+            del buffer[: self.position]
+            if self.body is not None:
+                self.body -= self.position
+                self.scan -= self.position
+            self.position = 0
+        return parts
+
+
+class MjpegGrabber:
+    """Keeps the MJPEG stream of the camera open and its latest frames in a ring"""
+
+    def __init__(
+        self,
+        client,
+        params: Dict[str, Any] = None,
+        fps: int = FPS,
+        ring_size: int = RING_SIZE,
+    ):
+        """Set up the ring, start() connects
+
+        Arguments:
+            client {vapix.VapixClient} -- Session to the camera
+
+        Keyword Arguments:
+            params {Dict[str, Any]} -- Parameters of video.cgi (default: {MJPEG_PAYLOAD})
+            fps {int} -- Frames per second asked from the camera (default: {10})
+            ring_size {int} -- Frames kept (default: {50})
+        """
+        self.client = client
+        self.params = dict(params or MJPEG_PAYLOAD, fps=fps)
+        self.frames = collections.deque(maxlen=ring_size)
+        self.condition = threading.Condition()
+        self.running = False
+        self.response = None
+        self.thread = None
+        self.counts = {"connections": 0, "frames": 0, "bytes": 0, "errors": 0}
+
+    def start(self):
+        """Connect and grab frames from a daemon thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Close the stream and stop grabbing"""
+        self.running = False
+        response = self.response
+        if response is not None:
+            response.close()
+        if self.thread is not None:
+            self.thread.join(5.0)
+
+    def _run(self):
+        while self.running:
+            try:
+                self._stream()
+            except (requests.exceptions.RequestException, OSError, ValueError) as e:
+                if self.running:
+                    self.counts["errors"] += 1
+                    logging.error("MJPEG stream failed: {}".format(e))
+            if self.running:
+                time.sleep(RECONNECT_DELAY)
+
+    def _stream(self):
+        self.response = self.client.session.get(
+            self.client.base_url + "/axis-cgi/mjpg/video.cgi",
+            params=self.params,
+            stream=True,
+            timeout=(self.client.jpeg_timeout, 5.0),
+        )
+        response = self.response
+        try:
+            if response.status_code != 200:
+                raise ValueError("status {}".format(response.status_code))
+            content_type = response.headers.get("Content-Type", "")
+            match = re.search(r'boundary="?([^";]+)"?', content_type)
+            if not match:
+                raise ValueError("no boundary in {}".format(content_type))
+            scanner = MultipartScanner(match.group(1).encode())
+            self.counts["connections"] += 1
+            raw = response.raw
+            while self.running:
+                data = raw.read1(READ_SIZE)
+                if not data:
+                    raise ValueError("stream ended")
+                parts = scanner.feed(data)
+                if parts:
+                    self._add(parts)
+        finally:
+            response.close()
+            self.response = None
+
+    def _add(self, parts: List[bytes]):
+        monotonic = time.monotonic()
+        now = time.time()
+        with self.condition:
+            for data in parts:
+                self.frames.append(Frame(monotonic, now, data))
+                self.counts["frames"] += 1
+                self.counts["bytes"] += len(data)
+            self.condition.notify_all()
+
+    def latest(self) -> Optional[Frame]:
+        """The last frame received, None before the first"""
+        with self.condition:
+            return self.frames[-1] if self.frames else None
+
+    def frame_at(self, due: float, tolerance: float = FRAME_TOLERANCE) -> Optional[Frame]:
+        """The frame received nearest to a time
+
+        Waits for the first frame after the time, for up to tolerance seconds.
+
+        Arguments:
+            due {float} -- time.monotonic() the frame is wanted for
+
+        Keyword Arguments:
+            tolerance {float} -- Seconds the frame can be away from the time (default: {0.5})
+
+        Returns:
+            Optional[Frame] -- The frame, None if there is none that close (the stream is down)
+        """
+        deadline = due + tolerance
+        with self.condition:
+            while not self.frames or self.frames[-1].monotonic < due:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                self.condition.wait(remaining)
+            if not self.frames:
+                return None
+            frame = min(self.frames, key=lambda frame: abs(frame.monotonic - due))
+        return frame if abs(frame.monotonic - due) <= tolerance else None
+
+    def stats(self) -> Dict[str, Any]:
+        """Counts of connections, frames, bytes and errors, and frames in the ring"""
+        with self.condition:
+            return dict(self.counts, ring=len(self.frames))
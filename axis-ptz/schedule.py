@@ -0,0 +1,59 @@
+"""
+Deadline scheduling of the move loop
+
+The move loop used to poll: it slept 5 ms at a time, or 100 ms while
+idle, and compared wall clock times to see whether a move or a capture
+was due. It spun a core when there was nothing to do at all. It now
+sleeps on a condition variable until the earliest of its deadlines, on
+the monotonic clock, or until a message that changes what it should do
+wakes it. How late it wakes for its deadlines is kept.
+"""
+
+import threading
+import time
+from typing import *
+
+import capture
+
+
+class DeadlineScheduler:
+    """Sleeps until a deadline, or until woken"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.woken = False
+        self.jitter = capture.Lag()  # How late the wake-ups for deadlines are
+
+    def wake(self):
+        """Wake the thread waiting, or the next one to wait, now"""
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def wait(self, deadline: float = None) -> bool:
+        """Sleep until a deadline, or until woken
+
+        Keyword Arguments:
+            deadline {float} -- time.monotonic() to wake at, None to wait until woken (default: {None})
+
+        Returns:
+            bool -- Whether it was woken before the deadline
+        """
+        with self.condition:
+            while not self.woken:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                self.condition.wait(remaining)
+            woken = self.woken
+            self.woken = False
+        if not woken:
+            self.jitter.add(time.monotonic() - deadline)
+        return woken
+
+    def stats(self) -> Dict[str, Any]:
+        """Wake-ups for deadlines, and how late they were"""
+        return self.jitter.summary()
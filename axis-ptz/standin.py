@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the VAPIX CGIs of an Axis camera, to test and measure against
+
+Answers image.cgi with a fixed JPEG, video.cgi with a multipart MJPEG stream
+of it at the fps asked for, ptz.cgi moves with 204 and ptz.cgi position
+queries with where it points, behind digest authentication (MD5, qop=auth)
+like the camera. Absolute moves slew at a fixed rate, and continuous moves
+at their speed times the rate at speed 100. Network delays can be added
+so localhost behaves more like the camera: a round trip before every
+response and another for every new connection (the TCP handshake). Nonces
+expire after a number of uses, like the camera's do.
+
+    ./standin.py --port 8080 --round-trip 0.005 --image-time 0.05
+"""
+
+import argparse
+import hashlib
+import http.server
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from typing import *
+
+REALM = "AXIS_ACCC8E000000"
+BOUNDARY = "myboundary"
+
+
+def md5(text: str) -> str:
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """Threaded HTTP/1.1 server with the camera's credentials and delays"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        username: str = "root",
+        password: str = "pass",
+        round_trip: float = 0.0,
+        image_time: float = 0.0,
+        image_size: int = 300000,
+        nonce_uses: int = 10000,
+        slew_rate: float = 100.0,
+    ):
+        """Bind the server, serve it with serve_forever() or start()
+
+        Keyword Arguments:
+            address {Tuple[str, int]} -- Address to listen on, port 0 for any (default: {("127.0.0.1", 0)})
+            username {str} -- User allowed in (default: {"root"})
+            password {str} -- Password of the user (default: {"pass"})
+            round_trip {float} -- Seconds added before every response, and to every new connection (default: {0.0})
+            image_time {float} -- Seconds it takes the camera to encode an image (default: {0.0})
+            image_size {int} -- Bytes in an image (default: {300000})
+            nonce_uses {int} -- Requests a nonce is good for before it is stale (default: {10000})
+            slew_rate {float} -- Degrees per second of absolute moves, and of continuous moves at speed 100 (default: {100.0})
+        """
+        super().__init__(address, Handler)
+        self.username = username
+        self.password = password
+        self.round_trip = round_trip
+        self.image_time = image_time
+        self.image = b"\xff\xd8" + os.urandom(max(0, image_size - 4)) + b"\xff\xd9"
+        self.nonce_uses = nonce_uses
+        self.nonces = {}
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "challenges": 0, "images": 0, "ptz": 0, "frames": 0, "positions": 0}
+        self.ptz_commands = []
+        self.slew_rate = slew_rate
+        self.position = [0.0, 0.0]  # Pan and tilt [deg]
+        self.target = None  # Pan and tilt of the absolute move in progress
+        self.speeds = (0.0, 0.0)  # Pan and tilt rates of the continuous move in progress [deg/s]
+        self.moved = time.monotonic()  # When the position was last brought up to date
+
+    @property
+    def url(self) -> str:
+        return "{}:{}".format(*self.server_address)
+
+    def start(self) -> threading.Thread:
+        """Serve from a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def move(self, now: float):
+        """Bring the position up to date, called with the lock held"""
+        elapsed = now - self.moved
+        self.moved = now
+        if self.target is not None:
+            for axis in (0, 1):
+                step = self.slew_rate * elapsed
+                error = self.target[axis] - self.position[axis]
+                self.position[axis] = self.target[axis] if abs(error) <= step else self.position[axis] + math.copysign(step, error)
+        else:
+            for axis in (0, 1):
+                self.position[axis] += self.speeds[axis] * elapsed
+
+    def ptz(self, query: Dict[str, List[str]]) -> Optional[bytes]:
+        """Carry out a ptz.cgi command, the answer to a query or None"""
+        with self.lock:
+            self.move(time.monotonic())
+            if query.get("query") == ["position"]:
+                return "pan={:.4f}\r\ntilt={:.4f}\r\nzoom=1\r\n".format(*self.position).encode()
+            if "pan" in query or "tilt" in query:
+                self.target = [float(query.get(name, [self.position[axis]])[0]) for axis, name in enumerate(("pan", "tilt"))]
+            elif "continuouspantiltmove" in query:
+                self.target = None
+                self.speeds = tuple(float(speed) * self.slew_rate / 100.0 for speed in query["continuouspantiltmove"][0].split(","))
+            return None
+
+    def new_nonce(self) -> str:
+        nonce = os.urandom(16).hex()
+        with self.lock:
+            self.nonces[nonce] = 0
+        return nonce
+
+    def check(self, method: str, header: str) -> Tuple[bool, bool]:
+        """Whether an Authorization header is valid, and whether its nonce is stale"""
+        if not header or not header.startswith("Digest "):
+            return False, False
+        fields = {
+            name: quoted or bare
+            for name, quoted, bare in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', header)
+        }
+        nonce = fields.get("nonce")
+        with self.lock:
+            if nonce not in self.nonces:
+                return False, False
+            self.nonces[nonce] += 1
+            if self.nonces[nonce] > self.nonce_uses:
+                del self.nonces[nonce]
+                return False, True
+        ha1 = md5("{}:{}:{}".format(self.username, REALM, self.password))
+        ha2 = md5("{}:{}".format(method, fields.get("uri")))
+        expected = md5(
+            "{}:{}:{}:{}:{}:{}".format(
+                ha1, nonce, fields.get("nc"), fields.get("cnonce"), fields.get("qop"), ha2
+            )
+        )
+        return fields.get("username") == self.username and fields.get("response") == expected, False
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+        time.sleep(self.server.round_trip)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status: int, body: bytes = b"", headers: Dict[str, str] = {}):
+        time.sleep(self.server.round_trip)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        valid, stale = self.server.check("GET", self.headers.get("Authorization"))
+        if not valid:
+            self.server.count("challenges")
+            challenge = 'Digest realm="{}", nonce="{}", algorithm=MD5, qop="auth"'.format(
+                REALM, self.server.new_nonce()
+            )
+            if stale:
+                challenge += ", stale=true"
+            self.send(401, b"", {"WWW-Authenticate": challenge})
+        elif self.path.startswith("/axis-cgi/jpg/image.cgi"):
+            time.sleep(self.server.image_time)
+            self.server.count("images")
+            self.send(200, self.server.image, {"Content-Type": "image/jpeg"})
+        elif self.path.startswith("/axis-cgi/mjpg/video.cgi"):
+            self.stream()
+        elif self.path.startswith("/axis-cgi/com/ptz.cgi"):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            answer = self.server.ptz(query)
+            if answer is not None:
+                self.server.count("positions")
+                self.send(200, answer, {"Content-Type": "text/plain"})
+                return
+            self.server.count("ptz")
+            with self.server.lock:
+                self.server.ptz_commands.append(self.path)
+            self.send(204)
+        else:
+            self.send(404)
+
+    def stream(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        period = 1.0 / float(query.get("fps", ["10"])[0])
+        time.sleep(self.server.round_trip)
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary={}".format(BOUNDARY))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        image = self.server.image
+        head = "--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n".format(
+            BOUNDARY, len(image)
+        ).encode()
+        next_frame = time.monotonic()
+        try:
+            while True:
+                next_frame += period
+                time.sleep(max(0.0, next_frame - time.monotonic()))
+                self.wfile.write(head + image + b"\r\n")
+                self.wfile.flush()
+                self.server.count("frames")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for the VAPIX CGIs of an Axis camera")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("-u", "--username", default="root")
+    parser.add_argument("-p", "--password", default="pass")
+    parser.add_argument("--round-trip", type=float, help="seconds added before every response and every new connection", default=0.0)
+    parser.add_argument("--image-time", type=float, help="seconds to encode an image", default=0.0)
+    parser.add_argument("--image-size", type=int, help="bytes in an image", default=300000)
+    parser.add_argument("--slew-rate", type=float, help="degrees per second of the moves", default=100.0)
+    args = parser.parse_args()
+    server = StandIn(
+        (args.host, args.port),
+        args.username,
+        args.password,
+        round_trip=args.round_trip,
+        image_time=args.image_time,
+        image_size=args.image_size,
+        slew_rate=args.slew_rate,
+    )
+    print("Serving on http://{}".format(server.url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Position of the sun, so the camera is never pointed into it
+
+Implements the NOAA solar position equations (the ones behind the NOAA Solar
+Calculator spreadsheet, after Meeus' Astronomical Algorithms), which are good
+to about a hundredth of a degree for the years 1800-2100. This is computed
+locally with numpy, so it works offline and on arrays of times. The position
+for the current second is cached, so checking a target against the sun costs
+a few multiplications.
+"""
+
+import math
+import threading
+from typing import *
+
+import numpy as np
+
+# Default half-angle of the cone around the sun that is never pointed into
+SUN_EXCLUSION = 10.0  # [deg]
+
+
+def solar_position(lat: float, lon: float, t) -> Tuple[Any, Any]:
+    """Azimuth and elevation of the sun
+
+    Arguments:
+        lat {float} -- Latitude of the observer
+        lon {float} -- Longitude of the observer
+        t {float or np.ndarray} -- Time(s) in seconds since the epoch
+
+    Returns:
+        Tuple -- Azimuth (degrees clockwise from true north) and elevation (degrees,
+                 corrected for atmospheric refraction), with the same shape as `t`
+    """
+    t = np.asarray(t, dtype=np.float64)
+    jc = (t / 86400.0 + 2440587.5 - 2451545.0) / 36525.0  # Julian century
+    mean_long = np.radians((280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360)
+    mean_anom = np.radians(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    center = (
+        np.sin(mean_anom) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+        + np.sin(2 * mean_anom) * (0.019993 - 0.000101 * jc)
+        + np.sin(3 * mean_anom) * 0.000289
+    )
+    omega = np.radians(125.04 - 1934.136 * jc)
+    app_long = np.radians(
+        np.degrees(mean_long) + center - 0.00569 - 0.00478 * np.sin(omega)
+    )
+    mean_obliq = (
+        23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    )
+    obliq = np.radians(mean_obliq + 0.00256 * np.cos(omega))
+    decl = np.arcsin(np.sin(obliq) * np.sin(app_long))
+
+    y = np.tan(obliq / 2) ** 2
+    eq_time = 4 * np.degrees(
+        y * np.sin(2 * mean_long)
+        - 2 * eccent * np.sin(mean_anom)
+        + 4 * eccent * y * np.sin(mean_anom) * np.cos(2 * mean_long)
+        - 0.5 * y * y * np.sin(4 * mean_long)
+        - 1.25 * eccent * eccent * np.sin(2 * mean_anom)
+    )  # [min]
+    true_solar_time = ((t % 86400.0) / 60.0 + eq_time + 4 * lon) % 1440  # [min]
+    hour_angle = np.radians(true_solar_time / 4 - 180)
+
+    rlat = math.radians(lat)
+    cos_zenith = np.clip(
+        math.sin(rlat) * np.sin(decl)
+        + math.cos(rlat) * np.cos(decl) * np.cos(hour_angle),
+        -1,
+        1,
+    )
+    zenith = np.arccos(cos_zenith)
+    elevation = 90 - np.degrees(zenith)
+
+    # Atmospheric refraction lifts the sun near the horizon
+    te = np.tan(np.radians(np.clip(elevation, -89.9, 89.9)))
+    refraction = (
+        np.select(
+            [elevation > 85, elevation > 5, elevation > -0.575],
+            [
+                0.0,
+                58.1 / te - 0.07 / te**3 + 0.000086 / te**5,
+                1735
+                + elevation
+                * (
+                    -518.2
+                    + elevation * (103.4 + elevation * (-12.79 + elevation * 0.711))
+                ),
+            ],
+            -20.772 / te,
+        )
+        / 3600
+    )
+    elevation = elevation + refraction
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cos_az = np.clip(
+            (math.sin(rlat) * cos_zenith - np.sin(decl))
+            / (math.cos(rlat) * np.sin(zenith)),
+            -1,
+            1,
+        )
+    az = np.degrees(np.arccos(cos_az))
+    azimuth = np.where(hour_angle > 0, (az + 180) % 360, (540 - az) % 360)
+    if azimuth.ndim == 0:
+        return (float(azimuth), float(elevation))
+    return (azimuth, elevation)
+
+
+def separation(
+    azimuth1: float, elevation1: float, azimuth2: float, elevation2: float
+) -> float:
+    """Angle between two directions
+
+    Arguments:
+        azimuth1 {float} -- Azimuth of the first direction in degrees
+        elevation1 {float} -- Elevation of the first direction in degrees
+        azimuth2 {float} -- Azimuth of the second direction in degrees
+        elevation2 {float} -- Elevation of the second direction in degrees
+
+    Returns:
+        float -- Angle in degrees
+    """
+    e1 = math.radians(elevation1)
+    e2 = math.radians(elevation2)
+    c = math.sin(e1) * math.sin(e2) + math.cos(e1) * math.cos(e2) * math.cos(
+        math.radians(azimuth1 - azimuth2)
+    )
+    return math.degrees(math.acos(max(-1.0, min(1.0, c))))
+
+
+class Sun(object):
+    """
+    Position of the sun for one observer, computed at most once a second
+    """
+
+    __key: Tuple = None
+    __position: Tuple[float, float] = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+
+    def position(self, lat: float, lon: float, now: float) -> Tuple[float, float]:
+        """Azimuth and elevation of the sun in the current second
+
+        Arguments:
+            lat {float} -- Latitude of the observer
+            lon {float} -- Longitude of the observer
+            now {float} -- Time in seconds since the epoch
+
+        Returns:
+            Tuple[float, float] -- Azimuth and elevation in degrees
+        """
+        key = (int(now), lat, lon)
+        cached = self.__key, self.__position
+        if cached[0] == key:
+            return cached[1]
+        with self.__lock:
+            position = solar_position(lat, lon, key[0] + 0.5)
+            self.__key, self.__position = key, position
+        return position
+
+    def is_excluded(
+        self,
+        azimuth: float,
+        elevation: float,
+        lat: float,
+        lon: float,
+        now: float,
+        cone: float,
+    ) -> bool:
+        """Is a direction within the exclusion cone around the sun
+
+        Arguments:
+            azimuth {float} -- Azimuth of the direction in degrees
+            elevation {float} -- Elevation of the direction in degrees
+            lat {float} -- Latitude of the observer
+            lon {float} -- Longitude of the observer
+            now {float} -- Time in seconds since the epoch
+            cone {float} -- Half-angle of the exclusion cone in degrees, None or 0 to disable
+
+        Returns:
+            bool -- True if the camera should not be pointed there
+        """
+        if not cone:
+            return False
+        sun_azimuth, sun_elevation = self.position(lat, lon, now)
+        # Cheap way out for the sun being well away in elevation alone, like at night
+        if abs(elevation - sun_elevation) >= cone:
+            return False
+        return separation(azimuth, elevation, sun_azimuth, sun_elevation) < cone
@@ -0,0 +1,351 @@
+"""
+Pointing telemetry from the position of the camera
+
+The move loop sends the camera where the aircraft is predicted to be, and
+never hears where it went. A poller queries the position of the camera
+(ptz.cgi?query=position) a few times a second, timestamps it at the middle
+of the request, and compares it with:
+
+- the last position the camera was commanded to, the error the camera
+  itself adds, in degrees;
+- the pointing predicted for that time, where the aircraft is, extrapolated
+  from the last prediction at its rates, in degrees, and along the motion
+  of the aircraft in seconds: how far behind the aircraft the camera is,
+  what camera_lead should make up for;
+- and it times every command until the camera gets within a tolerance of
+  where it was sent, interpolating between two positions.
+
+The histograms are published over MQTT every so often, and can be served
+as JSON at /metrics with the other stats of the controller.
+"""
+
+import bisect
+import collections
+import http.server
+import json
+import logging
+import math
+import threading
+import time
+from typing import *
+
+# Times a second the position of the camera is queried
+POSITION_RATE = 2.0
+# Seconds between publishing the histograms
+PUBLISH_INTERVAL = 10.0
+# Distance from a commanded position the camera has got there within [deg]
+SETTLE_TOLERANCE = 0.2
+# Seconds a command is timed for before it is counted as never settled
+SETTLE_TIMEOUT = 5.0
+# Commands timed at once, at most
+SETTLE_PENDING = 100
+# Seconds a prediction is compared with the positions for, after it was made
+PREDICTION_AGE = 1.0
+# Angular rate of the aircraft below which how far behind it the camera is is not computed [deg/s]
+MIN_RATE = 0.5
+
+# Upper bounds of the buckets of the pointing errors [deg]
+ERROR_BOUNDS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+# Upper bounds of the buckets of how far behind the aircraft the camera is [s]
+BEHIND_BOUNDS = (-1.0, -0.5, -0.2, -0.1, -0.05, 0.0, 0.05, 0.1, 0.2, 0.5, 1.0)
+# Upper bounds of the buckets of the command to settle latencies [s]
+SETTLE_BOUNDS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def distance(pan_1: float, tilt_1: float, pan_2: float, tilt_2: float) -> float:
+    """Angle between two pointings, for small angles [deg]"""
+    pan = (pan_2 - pan_1 + 180.0) % 360.0 - 180.0
+    return math.hypot(pan * math.cos(math.radians(tilt_1)), tilt_2 - tilt_1)
+
+
+class Histogram:
+    """Counts of values in fixed buckets"""
+
+    def __init__(self, bounds: Sequence[float]):
+        """Start empty
+
+        Arguments:
+            bounds {Sequence[float]} -- Upper bounds of the buckets, increasing, a last bucket takes the values above them
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value: float):
+        """Count a value in the first bucket whose bound it is not above"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def summary(self) -> Dict[str, Any]:
+        """Bounds and counts of the buckets, count, sum and mean of the values"""
+        return {
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+        }
+
+
+class Prediction(NamedTuple):
+    """Pointing at the aircraft, as predicted by the move loop"""
+
+    made: float  # time.monotonic() it was made at
+    when: float  # time.monotonic() it is for
+    pan: float  # [deg]
+    tilt: float  # [deg]
+    pan_rate: float  # [deg/s]
+    tilt_rate: float  # [deg/s]
+    lead: float = None  # camera_lead it was computed with [s]
+
+
+class PointingTelemetry:
+    """Queries the position of the camera and compares it with the commands and predictions"""
+
+    def __init__(
+        self,
+        client,
+        rate: float = POSITION_RATE,
+        publish: Callable[[Dict[str, Any]], Any] = None,
+        publish_interval: float = PUBLISH_INTERVAL,
+        settle_tolerance: float = SETTLE_TOLERANCE,
+        calibration=None,
+    ):
+        """Start without positions, start() queries them
+
+        Arguments:
+            client {vapix.VapixClient} -- Session to the camera
+
+        Keyword Arguments:
+            rate {float} -- Times a second the position is queried (default: {2.0})
+            publish {Callable[[Dict[str, Any]], Any]} -- Publishes the stats (default: {None})
+            publish_interval {float} -- Seconds between publishing the stats (default: {10.0})
+            settle_tolerance {float} -- Distance from a commanded position the camera has got there within [deg] (default: {0.2})
+            calibration {lead.LeadCalibration} -- Calibrates the lead from how far behind the aircraft the camera is (default: {None})
+        """
+        self.client = client
+        self.period = 1.0 / rate
+        self.publish = publish
+        self.publish_interval = publish_interval
+        self.settle_tolerance = settle_tolerance
+        self.calibration = calibration
+        self.histograms = {
+            "commanded": Histogram(ERROR_BOUNDS),  # From the last command [deg]
+            "predicted": Histogram(ERROR_BOUNDS),  # From the aircraft [deg]
+            "behind": Histogram(BEHIND_BOUNDS),  # Behind the aircraft along its motion [s]
+            "settle": Histogram(SETTLE_BOUNDS),  # From a command to getting there [s]
+        }
+        self.counts = {"positions": 0, "failed": 0, "commands": 0, "unsettled": 0}
+        self.command = None  # Last command, (time.monotonic(), pan, tilt)
+        self.pending = collections.deque()  # Commands not settled yet
+        self.prediction = None
+        self.position = None  # Last position, (time.monotonic(), pan, tilt)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def commanded(self, pan: float, tilt: float, now: float = None):
+        """Keep a pan and tilt the camera was sent to
+
+        Arguments:
+            pan {float} -- [deg]
+            tilt {float} -- [deg]
+
+        Keyword Arguments:
+            now {float} -- time.monotonic() it was sent at (default: {now})
+        """
+        command = (time.monotonic() if now is None else now, pan, tilt)
+        with self.lock:
+            self.counts["commands"] += 1
+            self.command = command
+            if len(self.pending) >= SETTLE_PENDING:
+                self.pending.popleft()
+                self.counts["unsettled"] += 1
+            self.pending.append(command)
+
+    def predicted(
+        self,
+        when: float,
+        pan: float,
+        tilt: float,
+        pan_rate: float,
+        tilt_rate: float,
+        lead: float = None,
+    ):
+        """Keep the latest pointing predicted at the aircraft
+
+        Arguments:
+            when {float} -- time.monotonic() the pointing is for, the lead included
+            pan {float} -- [deg]
+            tilt {float} -- [deg]
+            pan_rate {float} -- [deg/s]
+            tilt_rate {float} -- [deg/s]
+
+        Keyword Arguments:
+            lead {float} -- camera_lead the pointing was computed with [s] (default: {None})
+        """
+        prediction = Prediction(time.monotonic(), when, pan, tilt, pan_rate, tilt_rate, lead)
+        with self.lock:
+            self.prediction = prediction
+
+    def observe(self, when: float, pan: float, tilt: float):
+        """Compare a position of the camera with the commands and the prediction
+
+        Arguments:
+            when {float} -- time.monotonic() the camera was there
+            pan {float} -- [deg]
+            tilt {float} -- [deg]
+        """
+        with self.lock:
+            self.counts["positions"] += 1
+            if self.command is not None and self.command[0] <= when:
+                self.histograms["commanded"].add(
+                    distance(pan, tilt, self.command[1], self.command[2])
+                )
+            prediction = self.prediction
+            if prediction is not None and when - prediction.made <= PREDICTION_AGE:
+                self._compare(prediction, when, pan, tilt)
+            self._settle(when, pan, tilt)
+            self.position = (when, pan, tilt)
+
+    def _compare(self, prediction: Prediction, when: float, pan: float, tilt: float):
+        # Where the aircraft is at the time of the position
+        elapsed = when - prediction.when
+        aircraft_pan = prediction.pan + prediction.pan_rate * elapsed
+        aircraft_tilt = prediction.tilt + prediction.tilt_rate * elapsed
+        self.histograms["predicted"].add(distance(pan, tilt, aircraft_pan, aircraft_tilt))
+        # The error along the motion of the aircraft, in seconds of it
+        scale = math.cos(math.radians(tilt))
+        rate_pan = prediction.pan_rate * scale
+        rate2 = rate_pan * rate_pan + prediction.tilt_rate * prediction.tilt_rate
+        if rate2 >= MIN_RATE * MIN_RATE:
+            error_pan = ((aircraft_pan - pan + 180.0) % 360.0 - 180.0) * scale
+            error_tilt = aircraft_tilt - tilt
+            behind = (error_pan * rate_pan + error_tilt * prediction.tilt_rate) / rate2
+            self.histograms["behind"].add(behind)
+            if self.calibration is not None and prediction.lead is not None:
+                self.calibration.measured(math.sqrt(rate2), prediction.lead, behind)
+
+    def _settle(self, when: float, pan: float, tilt: float):
+        kept = collections.deque()
+        for command in self.pending:
+            sent, command_pan, command_tilt = command
+            if when < sent:
+                kept.append(command)
+                continue
+            # Nearest the camera got to the command since it was sent,
+            # moving straight from the last position to this one
+            reached, nearest = when, distance(pan, tilt, command_pan, command_tilt)
+            if self.position is not None and self.position[0] < when:
+                start, start_pan, start_tilt = self.position
+                d_pan = (pan - start_pan + 180.0) % 360.0 - 180.0
+                d_tilt = tilt - start_tilt
+                o_pan = (command_pan - start_pan + 180.0) % 360.0 - 180.0
+                o_tilt = command_tilt - start_tilt
+                scale = math.cos(math.radians(tilt)) ** 2
+                length2 = d_pan * d_pan * scale + d_tilt * d_tilt
+                if length2 > 0.0:
+                    # Only from where the camera was when the command was sent
+                    earliest = max(0.0, (sent - start) / (when - start))
+                    f = (o_pan * d_pan * scale + o_tilt * d_tilt) / length2
+                    f = min(1.0, max(earliest, f))
+                    point_distance = distance(
+                        start_pan + f * d_pan, start_tilt + f * d_tilt, command_pan, command_tilt
+                    )
+                    if point_distance < nearest:
+                        reached, nearest = start + f * (when - start), point_distance
+            if nearest <= self.settle_tolerance:
+                self.histograms["settle"].add(reached - sent)
+            elif when - sent > SETTLE_TIMEOUT:
+                self.counts["unsettled"] += 1
+            else:
+                kept.append(command)
+        self.pending = kept
+
+    def start(self):
+        """Query the position from a daemon thread"""
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop querying the position"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+
+    def _run(self):
+        next_query = time.monotonic()
+        next_publish = next_query + self.publish_interval
+        while not self.stopped.wait(max(0.0, next_query - time.monotonic())):
+            next_query += self.period
+            start = time.monotonic()
+            position = self.client.position()
+            end = time.monotonic()
+            if position is None:
+                with self.lock:
+                    self.counts["failed"] += 1
+            else:
+                # The camera answered somewhere in the middle of the request
+                self.observe((start + end) / 2.0, position["pan"], position["tilt"])
+            if next_query < time.monotonic():
+                next_query = time.monotonic()
+            if self.publish is not None and next_publish <= end:
+                next_publish = end + self.publish_interval
+                try:
+                    self.publish(self.stats())
+                except Exception as e:
+                    logging.error("Unable to publish pointing telemetry: {}".format(e))
+
+    def stats(self) -> Dict[str, Any]:
+        """Counts of positions and commands, and the histograms"""
+        with self.lock:
+            stats = dict(self.counts)
+            for name, histogram in self.histograms.items():
+                stats[name] = histogram.summary()
+        return stats
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serves the stats of the controller as JSON at /metrics"""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], sources: Dict[str, Callable[[], Any]]):
+        """Bind the server, start() serves it
+
+        Arguments:
+            address {Tuple[str, int]} -- Address to listen on
+            sources {Dict[str, Callable[[], Any]]} -- Functions returning the stats, by name
+        """
+        super().__init__(address, MetricsHandler)
+        self.sources = sources
+
+    def start(self) -> threading.Thread:
+        """Serve from a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def metrics(self) -> bytes:
+        content = {"time": time.time()}
+        for name, source in self.sources.items():
+            content[name] = source()
+        return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,13 +1,27 @@
+import argparse
 import math
 from pathlib import Path
 import pytest
+import threading
+import time
 
 import numpy as np
 import pandas as pd
 import quaternion
 
+import burst
 import camera
+import capture
+from config_store import CameraConfig, ConfigStore, TripodFrameStore
+import lead
+import mjpeg
+import schedule
+import standin
+import sun
+import telemetry
 import utils
+import vapix
+import velocity
 
 PRECISION = 1e-12
 RELATIVE_DIFFERENCE = 2  # %
@@ -81,18 +95,34 @@ class TestCameraModule:
         assert qnorm(q_tau_act - q_tau_exp) < PRECISION
         assert np.linalg.norm(E_XYZ_to_rst_act - E_XYZ_to_rst_exp) < PRECISION
 
+    def test_compute_E_XYZ_to_rst(self):
+        """Test the closed form rotation matches the quaternion one."""
+        rng = np.random.default_rng(1)
+        for _ in range(100):
+            o_lambda, o_varphi = rng.uniform(-180.0, 180.0), rng.uniform(-90.0, 90.0)
+            alpha, beta, gamma, rho = rng.uniform(-180.0, 180.0, 4)
+            tau = rng.uniform(-90.0, 90.0)
+            _, e_E_XYZ, e_N_XYZ, e_z_XYZ = utils.compute_E(o_lambda, o_varphi)
+            _, _, _, E_XYZ_to_uvw, _, _, E_XYZ_to_rst_exp = camera.compute_rotations(
+                e_E_XYZ, e_N_XYZ, e_z_XYZ, alpha, beta, gamma, rho, tau
+            )
+            E_XYZ_to_rst_act = camera.compute_E_XYZ_to_rst(E_XYZ_to_uvw, rho, tau)
+            assert np.linalg.norm(E_XYZ_to_rst_act - E_XYZ_to_rst_exp) < PRECISION
+
     def test_calculateCameraPositionB(self):
         data = pd.read_csv("data/A19A08-processed-track.csv")
 
-        camera.camera_latitude = 38.0  # [deg]
-        camera.camera_longitude = -77.0  # [deg]
-        camera.camera_altitude = 86.46  # [m]
-        camera.camera_lead = 0.0  # [s]
+        config = camera.config_store.update(
+            camera_latitude=38.0,  # [deg]
+            camera_longitude=-77.0,  # [deg]
+            camera_altitude=86.46,  # [m]
+            camera_lead=0.0,  # [s]
+        )
 
         # Assign position of the tripod
-        t_varphi = camera.camera_latitude  # [deg]
-        t_lambda = camera.camera_longitude  # [deg]
-        t_h = camera.camera_altitude  # [m]
+        t_varphi = config.camera_latitude  # [deg]
+        t_lambda = config.camera_longitude  # [deg]
+        t_h = config.camera_altitude  # [m]
 
         # Compute position in the XYZ coordinate system of the tripod
         E_XYZ_to_ENz, e_E_XYZ, e_N_XYZ, e_z_XYZ = utils.compute_E(t_lambda, t_varphi)
@@ -190,6 +220,29 @@ class TestCameraModule:
             assert cameraPanD < ANGULAR_DIFFERENCE
             assert cameraTiltD < ANGULAR_DIFFERENCE
 
+    def test_calculateCameraPositionPreposition(self):
+        """Test pointing at a point due north of the tripod."""
+        t_varphi, t_lambda, t_h = 38.0, -77.0, 86.46
+        _, e_E_XYZ, e_N_XYZ, e_z_XYZ = utils.compute_E(t_lambda, t_varphi)
+        r_XYZ_t = utils.compute_r_XYZ(t_lambda, t_varphi, t_h)
+        _, _, _, E_XYZ_to_uvw, _, _, _ = camera.compute_rotations(
+            e_E_XYZ, e_N_XYZ, e_z_XYZ, 0.0, 0.0, 0.0, 0.0, 0.0
+        )
+        point = {"lat": t_varphi + 0.1, "lon": t_lambda, "altitude": 3000.0}
+
+        pan, tilt = camera.calculateCameraPositionPreposition(
+            r_XYZ_t, E_XYZ_to_uvw, point
+        )
+
+        distance2d = utils.coordinate_distance(
+            t_varphi, t_lambda, point["lat"], point["lon"]
+        )
+        assert math.fabs(pan) < ANGULAR_DIFFERENCE
+        assert (
+            math.fabs(tilt - utils.elevation(distance2d, t_h, point["altitude"]))
+            < ANGULAR_DIFFERENCE
+        )
+
 
 def R_pole():
     """Compute the semi-minor axis of the geoid"""
@@ -347,3 +400,467 @@ class TestUtilsModule:
             varphi_1, lambda_1, varphi_2, lambda_2
         )
         assert math.fabs((d_act - d_exp) / d_exp) < PRECISION
+
+
+class TestConfigStore:
+    """Test atomic replacement of configuration snapshots."""
+
+    def test_update(self):
+        store = ConfigStore(CameraConfig())
+        initial = store.get()
+
+        updated = store.update(camera_yaw=10.0, cameraZoom=9999)
+        assert updated.version == initial.version + 1
+        assert updated.camera_yaw == 10.0
+        assert updated.cameraZoom == 9999
+
+        # Snapshots already handed out are never modified
+        assert initial.camera_yaw == 0.0
+        assert initial.cameraZoom is None
+
+    def test_update_unchanged(self):
+        store = ConfigStore(CameraConfig(camera_yaw=10.0))
+        version = store.version()
+        assert store.update(camera_yaw=10.0).version == version
+
+    def test_tripod_frame(self):
+        store = ConfigStore(
+            CameraConfig(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=80.0)
+        )
+        frames = TripodFrameStore(threshold=5.0)
+        frame = frames.get(store.get())
+        E_XYZ_to_ENz, _, _, _ = utils.compute_E(-77.0, 38.0)
+        assert np.linalg.norm(frame.E_XYZ_to_ENz - E_XYZ_to_ENz) < PRECISION
+        assert np.linalg.norm(frame.r_XYZ_t - utils.compute_r_XYZ(-77.0, 38.0, 80.0)) < PRECISION
+
+        # GPS jitter, and other changes, keep the frame
+        assert frames.get(store.update(camera_altitude=82.0)) is frame
+        assert frames.get(store.update(cameraZoom=9999)) is frame
+
+        # Moving, the frame is recomputed once
+        moved = frames.get(store.update(camera_latitude=38.001))
+        assert moved is not frame and moved.version == frame.version + 1
+        assert moved.latitude == 38.001
+        assert frames.get(store.update(cameraZoom=5000)) is moved
+
+        # Small moves add up
+        config = store.get()
+        for step in range(1, 20):
+            config = store.update(camera_altitude=config.camera_altitude + 0.7)
+            if frames.get(config) is not moved:
+                break
+        assert step == 8
+
+
+class TestSunModule:
+    """Test the solar ephemeris and the exclusion cone around the sun."""
+
+    # Solstice noon on the equator, and equinox noon in Washington, DC
+    @pytest.mark.parametrize(
+        "varphi, lambda_, t, az_exp, el_exp",
+        [
+            (0.0, 0.0, 1624276800.0, 0.0, 90.0 - 23.44),
+            (38.89, -77.03, 1616260080.0, 180.0, 90.0 - 38.89),
+        ],
+    )
+    def test_solar_position(self, varphi, lambda_, t, az_exp, el_exp):
+        az_act, el_act = sun.solar_position(varphi, lambda_, t)
+        assert math.fabs(el_act - el_exp) < 0.5
+        assert math.fabs((az_act - az_exp + 180.0) % 360.0 - 180.0) < 5.0
+
+    def test_is_excluded(self):
+        t = 1616260080.0
+        az, el = sun.solar_position(38.89, -77.03, t)
+        s = sun.Sun()
+        assert s.is_excluded(az + 5.0, el, 38.89, -77.03, t, 10.0)
+        assert not s.is_excluded(az, el + 15.0, 38.89, -77.03, t, 10.0)
+        assert not s.is_excluded(az, el, 38.89, -77.03, t, 0.0)
+
+
+class TestVapixModule:
+    """Test the keep-alive VAPIX client against the stand-in camera."""
+
+    @pytest.fixture
+    def server(self):
+        server = standin.StandIn(image_size=1000, nonce_uses=5)
+        server.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def test_keep_alive(self, server):
+        client = vapix.VapixClient(server.url, "root", "pass")
+        for _ in range(4):
+            image, network = client.jpeg()
+            assert image == server.image and network > 0.0
+        client.absolute_move(10.0, 20.0, 9999, 50)
+        # One connection, and one challenge shared by the captures and the PTZ command
+        assert server.counts == {"connections": 1, "challenges": 1, "images": 4, "ptz": 1, "frames": 0, "positions": 0}
+        assert "pan=10.0&tilt=20.0" in server.ptz_commands[0]
+        # The nonce goes stale and is renewed without failing a request
+        image, _ = client.jpeg()
+        assert image is not None and server.counts["challenges"] == 2
+        stats = client.stats()
+        assert stats["jpeg"]["requests"] == 5 and stats["jpeg"]["errors"] == 0
+        assert stats["jpeg"]["challenges"] + stats["ptz"]["challenges"] == 2
+        client.record_disk("jpeg", 0.01)
+        assert client.stats()["jpeg"]["disk"]["max"] == 0.01
+        client.close()
+
+    def test_timeout(self, server):
+        server.image_time = 0.3
+        client = vapix.VapixClient(server.url, "root", "pass", jpeg_timeout=0.1)
+        assert client.jpeg()[0] is None
+        assert client.stats()["jpeg"]["timeouts"] == 1
+        assert vapix.VapixClient(server.url, "root", "wrong").jpeg()[0] is None
+        client.close()
+
+
+class TestCaptureModule:
+    """Test the capture pipeline is never waited on by the move loop."""
+
+    def test_pipeline(self, tmp_path):
+        published = []
+        fetched = threading.Event()
+
+        def fetch(due):
+            fetched.wait(1.0)  # A slow camera
+            return b"image", {"network": 0.01}
+
+        pipeline = capture.CapturePipeline(fetch, published.append, trigger_queue_size=1)
+        pipeline.trigger(str(tmp_path / "a" / "0.jpg"), {"n": 0})
+        while pipeline.stats()["waiting"]:
+            time.sleep(0.001)
+        start = time.monotonic()
+        for n in range(1, 5):
+            pipeline.trigger(str(tmp_path / "a" / "{}.jpg".format(n)), {"n": n})
+        assert time.monotonic() - start < 0.1
+        fetched.set()
+        pipeline.close(1.0)
+        stats = pipeline.stats()
+        # The first was being taken, the newest waited and the ones in between were dropped
+        assert (stats["saved"], stats["dropped"]) == (2, 3)
+        assert sorted(m["n"] for m in published) == [0, 4]
+        assert (tmp_path / "a" / "4.jpg").read_bytes() == b"image"
+        assert published[-1]["timing"]["network"] == 0.01 and "disk" in published[-1]["timing"]
+
+    def test_delay_and_lag(self, tmp_path):
+        published = []
+        pipeline = capture.CapturePipeline(lambda due: (b"image", {}), published.append)
+        start = time.monotonic()
+        pipeline.trigger(str(tmp_path / "1.jpg"), {}, delay=0.2)
+        pipeline.close(1.0)
+        assert time.monotonic() - start >= 0.2
+        assert pipeline.stats()["lag"]["count"] == 1
+        assert published[0]["timing"]["lag"] < 0.1
+        lag = capture.Lag()
+        for seconds in (-0.01, 0.0, 0.05):
+            lag.add(seconds)
+        assert lag.summary() == {"count": 3, "late": 1, "p50": 0.0, "p95": 0.05, "max": 0.05}
+
+    def test_burst_saves_every_frame(self, tmp_path, monkeypatch):
+        # Triggered in the same second, from the same bearing, elevation and distance
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(camera, "args", argparse.Namespace(flat_file_structure=True))
+        monkeypatch.setattr(camera, "currentPlane", {"icao24": "abc123", "lat": 38.0, "lon": -77.0, "altitude": 1000.0})
+        published = []
+        pipeline = capture.CapturePipeline(lambda due: (b"image", {}), published.append)
+        for _ in range(2):
+            metadata = camera.get_json_request()
+            pipeline.trigger(metadata["imagefile"], metadata)
+        pipeline.close(1.0)
+        assert pipeline.stats()["saved"] == 2
+        assert len({m["imagefile"] for m in published}) == 2
+        assert len(list((tmp_path / "capture").iterdir())) == 2
+
+
+class TestMjpegModule:
+    """Test cutting frames out of an MJPEG stream, and picking them by time."""
+
+    def test_scanner(self):
+        frames = [b"\xff\xd8" + bytes([n]) * (1000 * n) + b"\xff\xd9" for n in range(1, 6)]
+        stream = b""
+        for n, frame in enumerate(frames):
+            length = "Content-Length: {}\r\n".format(len(frame)).encode() if n % 2 else b""
+            stream += b"--myboundary\r\nContent-Type: image/jpeg\r\n" + length + b"\r\n" + frame + b"\r\n"
+        stream += b"--myboundary\r\n"
+        # In one piece, and one byte at a time
+        for size in (len(stream), 1, 7):
+            scanner = mjpeg.MultipartScanner(b"myboundary")
+            parts = []
+            for start in range(0, len(stream), size):
+                parts += scanner.feed(stream[start : start + size])
+            assert parts == frames
+
+    def test_grabber(self):
+        server = standin.StandIn(image_size=5000)
+        server.start()
+        client = vapix.VapixClient(server.url, "root", "pass")
+        grabber = mjpeg.MjpegGrabber(client, fps=50, ring_size=10)
+        grabber.start()
+        due = time.monotonic() + 0.2
+        frame = grabber.frame_at(due)
+        assert frame.data == server.image
+        assert abs(frame.monotonic - due) < 0.05
+        # Nothing that close once the stream is gone
+        grabber.stop()
+        assert grabber.frame_at(time.monotonic() + 1.0, tolerance=0.1) is None
+        stats = grabber.stats()
+        assert stats["connections"] == 1 and stats["ring"] == 10 and stats["errors"] == 0
+        server.shutdown()
+        server.server_close()
+
+
+class TestBurstModule:
+    """Test the pass prediction and the capture bursts and budgets."""
+
+    def test_predict_pass(self):
+        # Flying north, 5 km east of the camera at 3 km, 20 km south of it
+        prediction = burst.predict_pass(
+            np.array([5000.0, -20000.0, 3000.0]), np.array([0.0, 200.0, 0.0])
+        )
+        assert prediction.closest == pytest.approx(100.0)
+        assert prediction.peak == pytest.approx(100.0)
+        # Within 1.25 times the closest distance for 0.75 of it either side
+        assert prediction.near == pytest.approx(math.hypot(5000.0, 3000.0) * 0.75 / 200.0)
+        # Climbing, it is highest a little after it is closest
+        prediction = burst.predict_pass(
+            np.array([5000.0, -20000.0, 3000.0]), np.array([0.0, 200.0, 10.0])
+        )
+        assert prediction.closest < 100.0 < prediction.peak
+        assert burst.predict_pass(np.array([1.0, 2.0, 3.0]), np.zeros(3)) == (0.0, 0.0, 0.0)
+
+    def test_scheduler(self):
+        scheduler = burst.CaptureScheduler(
+            burst_period=0.25, sparse_period=5.0, burst_window=3.0, frame_budget=40
+        )
+        captured = []
+        prediction = burst.Pass(100.0, 100.0, 1.0)
+        for n in range(1600):  # 200 s, closest at 100 s
+            now = n * 0.125
+            if scheduler.due("abc123", now, now, prediction):
+                captured.append(now)
+        burst_frames = [t for t in captured if abs(t - 100.0) <= 3.0]
+        assert len(burst_frames) == 25
+        # The approach is limited to a share of the budget, so the burst has room
+        assert len(captured) - len(burst_frames) <= 10
+        assert scheduler.stats()["abc123"]["frames"] == len(captured) <= 40
+
+    def test_long_burst(self):
+        # Near for 60 s either side, the burst's 30 frames are spread over it
+        scheduler = burst.CaptureScheduler(burst_period=0.25, frame_budget=40)
+        prediction = burst.Pass(100.0, 100.0, 60.0)
+        captured = [n * 0.125 for n in range(1600) if scheduler.due("abc123", n * 0.125, n * 0.125, prediction)]
+        burst_frames = [t for t in captured if abs(t - 100.0) <= 60.0]
+        assert 25 <= len(burst_frames) <= 31
+        assert burst_frames[-1] - burst_frames[0] > 100.0
+
+    def test_budgets(self):
+        scheduler = burst.CaptureScheduler(burst_period=1.0, frame_budget=10, byte_budget=5000)
+        prediction = burst.Pass(0.0, 0.0, 0.0)
+        assert [scheduler.due("abc123", float(n), 0.0, prediction) for n in range(12)].count(True) == 10
+        scheduler.record("def456", 5000)
+        assert not scheduler.due("def456", 0.0, 0.0, prediction)
+        assert scheduler.stats()["def456"]["skipped"] == 1
+        # A new pass once the aircraft has been gone for a while
+        assert scheduler.due("abc123", 20.0 + burst.PASS_GAP, 0.0, prediction)
+
+    def test_next_due(self):
+        scheduler = burst.CaptureScheduler(burst_period=0.25, sparse_period=5.0)
+        prediction = burst.Pass(100.0, 100.0, 1.0)
+        assert scheduler.next_due(0.0) == 0.0
+        # Far from the burst, asked again every burst period in case it starts
+        assert scheduler.due("abc123", 0.0, 0.0, prediction)
+        assert scheduler.next_due(0.0) == 0.25
+        # In the burst, at its period
+        assert scheduler.due("abc123", 99.0, 99.0, prediction)
+        assert scheduler.next_due(99.1) == 99.25
+
+
+class TestScheduleModule:
+    """Test sleeping until deadlines, and waking on messages."""
+
+    def test_deadline(self):
+        scheduler = schedule.DeadlineScheduler()
+        start = time.monotonic()
+        assert not scheduler.wait(start + 0.05)
+        assert time.monotonic() - start >= 0.05
+        stats = scheduler.stats()
+        assert stats["count"] == 1 and stats["max"] < 0.05
+
+    def test_wake(self):
+        scheduler = schedule.DeadlineScheduler()
+        # A wake before the wait is not lost
+        scheduler.wake()
+        assert scheduler.wait(time.monotonic() + 1.0)
+        timer = threading.Timer(0.05, scheduler.wake)
+        start = time.monotonic()
+        timer.start()
+        assert scheduler.wait()
+        assert 0.04 < time.monotonic() - start < 0.5
+        assert scheduler.stats()["count"] == 0
+
+
+class TestVelocityModule:
+    """Test pointing with continuous moves, the deadband and the corrections."""
+
+    class Client:
+        def __init__(self):
+            self.commands = []
+
+        def absolute_move(self, pan, tilt, zoom, speed):
+            self.commands.append(("absolute", pan, tilt))
+
+        def continuous_move(self, pan_speed, tilt_speed):
+            self.commands.append(("continuous", pan_speed, tilt_speed))
+
+    def test_pan_tilt_rates(self):
+        assert velocity.pan_tilt_rates(-4.58, 0.5, 36.8) == pytest.approx((-5.72, 0.5), abs=0.01)
+        assert abs(velocity.pan_tilt_rates(1.0, 0.0, 90.0)[0]) <= 1.0 / velocity.MIN_COS_TILT
+
+    def test_track(self):
+        client = self.Client()
+        control = velocity.VelocityControl(
+            client, max_rate=100.0, deadband=0.2, gain=1.0, correction_interval=10.0, settle=0.3
+        )
+        # Absolute first, aimed where the aircraft will be once the camera is there
+        assert control.track(0.0, 10.0, 20.0, 5.0, 1.0) == "absolute"
+        assert client.commands[-1] == ("absolute", 11.5, 20.3)
+        assert control.track(0.1, 10.5, 20.1, 5.0, 1.0) is None
+        # Then continuously, at the rates of the aircraft
+        assert control.track(0.3, 11.5, 20.3, 5.0, 1.0) == "continuous"
+        assert client.commands[-1] == ("continuous", 5, 1)
+        # Small changes are not sent
+        n = len(client.commands)
+        for step in range(1, 10):
+            now = 0.3 + 0.1 * step
+            control.track(now, 11.5 + 5.0 * (now - 0.3), 20.3 + (now - 0.3), 5.05, 1.0)
+        assert len(client.commands) == n
+        assert control.stats() == {"absolute": 1, "continuous": 1, "suppressed": 9}
+        # The error is fed back while it is small
+        assert control.track(1.3, 17.0, 21.3, 5.0, 1.0) == "continuous"
+        assert client.commands[-1] == ("continuous", 6, 1)
+        # And corrected with an absolute move when it is not
+        assert control.track(1.4, 25.0, 21.4, 5.0, 1.0) == "absolute"
+        # And now and then anyway
+        assert control.track(1.7, 26.5, 21.7, 5.0, 1.0) == "continuous"
+        assert control.track(11.3, 74.5, 31.3, 5.0, 1.0) is None
+        assert control.track(11.5, 75.5, 31.5, 5.0, 1.0) == "absolute"
+
+    def test_stop(self):
+        client = self.Client()
+        control = velocity.VelocityControl(client, settle=0.0)
+        control.stop()
+        assert client.commands == []
+        control.track(0.0, 0.0, 0.0, 10.0, 0.0)
+        control.track(0.1, 1.0, 0.0, 10.0, 0.0)
+        control.stop()
+        assert client.commands[-1] == ("continuous", 0, 0)
+        # The position is unknown again
+        assert control.track(5.0, 50.0, 0.0, 10.0, 0.0) == "absolute"
+
+    def test_continuous_move(self):
+        server = standin.StandIn()
+        server.start()
+        client = vapix.VapixClient(server.url, "root", "pass")
+        client.continuous_move(-5, 12)
+        assert "continuouspantiltmove=-5%2C12" in server.ptz_commands[0]
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+class TestTelemetryModule:
+    """Test the histograms, the pointing errors and the settle times."""
+
+    def test_histogram(self):
+        histogram = telemetry.Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.add(value)
+        summary = histogram.summary()
+        assert summary["counts"] == [2, 1, 1]
+        assert summary["mean"] == pytest.approx(0.6625)
+
+    def test_errors(self):
+        pointing = telemetry.PointingTelemetry(None)
+        pointing.commanded(10.0, 0.0, now=0.0)
+        # The aircraft at 10 deg/s in pan, predicted for 0.5 s
+        pointing.prediction = telemetry.Prediction(0.0, 0.5, 10.0, 0.0, 10.0, 0.0)
+        # The camera 0.2 s behind it
+        pointing.observe(0.7, 10.0, 0.0)
+        stats = pointing.stats()
+        assert stats["commanded"]["sum"] == pytest.approx(0.0)
+        assert stats["predicted"]["sum"] == pytest.approx(2.0)
+        assert stats["behind"]["sum"] == pytest.approx(0.2)
+        # The prediction goes stale
+        pointing.observe(1.5, 10.0, 0.0)
+        assert pointing.stats()["predicted"]["count"] == 1
+
+    def test_settle(self):
+        pointing = telemetry.PointingTelemetry(None)
+        pointing.observe(0.0, 0.0, 0.0)
+        pointing.commanded(10.0, 0.0, now=0.0)
+        pointing.commanded(-10.0, 0.0, now=0.1)
+        pointing.observe(0.5, 5.0, 0.0)
+        # There between the two positions
+        pointing.observe(1.5, 15.0, 0.0)
+        stats = pointing.stats()
+        assert stats["settle"]["count"] == 1
+        assert stats["settle"]["sum"] == pytest.approx(1.0)
+        # Never there
+        pointing.observe(6.0, 15.0, 0.0)
+        assert pointing.stats()["unsettled"] == 1
+
+    def test_calibration(self):
+        calibration = lead.LeadCalibration(0.1, smoothing=1.0)
+        pointing = telemetry.PointingTelemetry(None, calibration=calibration)
+        pointing.predicted(time.monotonic(), 10.0, 0.0, 5.0, 0.0, lead=0.1)
+        pointing.observe(time.monotonic(), 9.0, 0.0)
+        assert calibration.lead(5.0) == pytest.approx(0.3, abs=0.01)
+
+    def test_position(self):
+        server = standin.StandIn(slew_rate=50.0)
+        server.start()
+        client = vapix.VapixClient(server.url, "root", "pass")
+        assert client.position() == {"pan": 0.0, "tilt": 0.0, "zoom": 1.0}
+        pointing = telemetry.PointingTelemetry(client, rate=20.0)
+        pointing.start()
+        client.absolute_move(10.0, 5.0)
+        pointing.commanded(10.0, 5.0)
+        time.sleep(0.6)
+        pointing.stop()
+        stats = pointing.stats()
+        assert stats["positions"] >= 5
+        assert stats["settle"]["count"] == 1
+        assert 0.1 < stats["settle"]["sum"] < 0.4
+        assert server.counts["positions"] == stats["positions"] + 1
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+class TestLeadModule:
+    """Test the smoothing, the clamping and the classes of the calibrated lead."""
+
+    def test_smoothing(self):
+        calibration = lead.LeadCalibration(0.1, smoothing=0.5, rate_classes=(1.0, 10.0))
+        calibration.measured(5.0, 0.1, 0.2)
+        assert calibration.lead(5.0) == pytest.approx(0.2)
+        calibration.measured(5.0, 0.2, 0.1)
+        assert calibration.lead(5.0) == pytest.approx(0.25)
+        # Every class on its own
+        assert calibration.lead(0.5) == calibration.lead(20.0) == 0.1
+        assert [c["measurements"] for c in calibration.stats()["classes"]] == [0, 2, 0]
+
+    def test_limits(self):
+        calibration = lead.LeadCalibration(0.1, smoothing=1.0, max_lead=0.5)
+        calibration.measured(5.0, 0.1, -0.5)
+        assert calibration.lead(5.0) == 0.0
+        calibration.measured(5.0, 0.4, 0.9)
+        assert calibration.lead(5.0) == 0.5
+        # Not tracking the aircraft
+        calibration.measured(5.0, 0.5, -3.0)
+        assert calibration.lead(5.0) == 0.5
+        assert calibration.stats()["ignored"] == 1
+        calibration.reset(0.2)
+        assert calibration.lead(5.0) == 0.2
@@ -8,7 +8,8 @@ import coloredlogs
 import sys
 import os
 import time
-from sensecam_control import vapix_control,vapix_config
+
+import vapix
 
 
 def main():
@@ -42,7 +43,7 @@ def main():
                                 '%(message)s')
     print("hello")
     logging.info("---[ Starting %s ]---------------------------------------------" % sys.argv[0])
-    camera = vapix_control.CameraControl(args.axis_ip, args.axis_username, args.axis_password)
+    camera = vapix.VapixClient(args.axis_ip, args.axis_username, args.axis_password)
     print("hello")
     #############################################
     ##                Main Loop                ##
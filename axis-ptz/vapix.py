@@ -0,0 +1,302 @@
+"""
+Persistent VAPIX client for the Axis camera
+
+Every image capture and PTZ command used to open a new connection and send
+the request twice, first without credentials to get the digest challenge
+(401) and then with them. The client keeps one session with a small pool of
+keep-alive connections, and one digest auth whose nonce is reused: after
+the first challenge on a thread, requests carries the Authorization header
+(with an incremented nonce count) from the start, and the camera only
+challenges again when the nonce goes stale. The PTZ commands and the image
+captures share it.
+
+The network time of every request, and the disk time of the captures, are
+kept per kind of request so they can be exported.
+"""
+
+import collections
+import logging
+import sys
+import threading
+import time
+from typing import *
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+# Seconds to wait for an image before giving up on the capture
+JPEG_TIMEOUT = 0.5
+# Seconds to wait for a PTZ command
+PTZ_TIMEOUT = 5.0
+# Seconds to wait for the position of the camera
+POSITION_TIMEOUT = 1.0
+# Keep-alive connections held open to the camera, enough for every thread that talks to it
+POOL_SIZE = 4
+# Requests of each kind kept to compute percentiles from
+TIMING_WINDOW = 256
+
+JPEG_PAYLOAD = {
+    "resolution": "1920x1080",
+    "compression": 5,
+    "camera": 1,
+}
+
+
+class Timing:
+    """Network and disk time of one kind of request"""
+
+    def __init__(self, window: int = TIMING_WINDOW):
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.challenges = 0
+        self.network = collections.deque(maxlen=window)
+        self.disk = collections.deque(maxlen=window)
+        self.network_total = 0.0
+        self.disk_total = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        """Counts, and mean, median, 95th percentile and maximum of the recent times in seconds"""
+        summary = {
+            "requests": self.requests,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "challenges": self.challenges,
+        }
+        for name, times in (("network", self.network), ("disk", self.disk)):
+            if times:
+                ordered = sorted(times)
+                summary[name] = {
+                    "mean": sum(ordered) / len(ordered),
+                    "p50": ordered[len(ordered) // 2],
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max": ordered[-1],
+                }
+        return summary
+
+
+class VapixClient:
+    """Keep-alive session to the camera, shared by the PTZ commands and the image captures"""
+
+    def __init__(
+        self,
+        ip: str,
+        username: str,
+        password: str,
+        pool_size: int = POOL_SIZE,
+        jpeg_timeout: float = JPEG_TIMEOUT,
+        ptz_timeout: float = PTZ_TIMEOUT,
+    ):
+        """Open the session, connections are made on the first requests
+
+        Arguments:
+            ip {str} -- Address (and port) of the camera
+            username {str} -- User allowed to control the camera
+            password {str} -- Password of the user
+
+        Keyword Arguments:
+            pool_size {int} -- Keep-alive connections held open (default: {4})
+            jpeg_timeout {float} -- Seconds to wait for an image (default: {0.5})
+            ptz_timeout {float} -- Seconds to wait for a PTZ command (default: {5.0})
+        """
+        self.base_url = "http://" + ip
+        self.jpeg_timeout = jpeg_timeout
+        self.ptz_timeout = ptz_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # One auth for the session keeps the nonce between requests
+        self.session.auth = HTTPDigestAuth(username, password)
+        self.timings = collections.defaultdict(Timing)
+        self.lock = threading.Lock()
+
+    def get(self, kind: str, path: str, params: Dict[str, Any], timeout: float):
+        """Send a GET request on the session and time it
+
+        A request sent on a keep-alive connection the camera has just closed
+        is sent again once on a new connection.
+
+        Arguments:
+            kind {str} -- Kind of request the time is kept under
+            path {str} -- Path of the CGI on the camera
+            params {Dict[str, Any]} -- Query parameters, None values are left out
+            timeout {float} -- Seconds to wait to connect, and between bytes of the response
+
+        Returns:
+            Tuple[requests.Response, float] -- The response, with its content read, and its network time in seconds
+        """
+        url = self.base_url + path
+        start = time.monotonic()
+        try:
+            try:
+                response = self.session.get(url, params=params, timeout=timeout)
+            except requests.exceptions.Timeout:
+                raise
+            except requests.exceptions.ConnectionError:
+                response = self.session.get(url, params=params, timeout=timeout)
+        except requests.exceptions.Timeout:
+            with self.lock:
+                timing = self.timings[kind]
+                timing.requests += 1
+                timing.timeouts += 1
+            raise
+        except requests.exceptions.RequestException:
+            with self.lock:
+                timing = self.timings[kind]
+                timing.requests += 1
+                timing.errors += 1
+            raise
+        network = time.monotonic() - start
+        with self.lock:
+            timing = self.timings[kind]
+            timing.requests += 1
+            timing.network.append(network)
+            timing.network_total += network
+            # The digest auth keeps the 401 it answered in the history
+            timing.challenges += sum(1 for r in response.history if r.status_code == 401)
+            if response.status_code not in (200, 204):
+                timing.errors += 1
+        return response, network
+
+    def record_disk(self, kind: str, seconds: float):
+        """Keep the time it took to write the result of a request"""
+        with self.lock:
+            timing = self.timings[kind]
+            timing.disk.append(seconds)
+            timing.disk_total += seconds
+
+    def ptz(self, payload: Dict[str, Any]):
+        """Send a command to ptz.cgi, the way sensecam_control does
+
+        Arguments:
+            payload {Dict[str, Any]} -- Parameters of the command
+
+        Returns:
+            requests.Response -- Response of the camera
+        """
+        params = dict(payload, camera=1, html="no", timestamp=int(time.time()))
+        response, _ = self.get("ptz", "/axis-cgi/com/ptz.cgi", params, self.ptz_timeout)
+        if response.status_code not in (200, 204):
+            logging.error(
+                "PTZ command failed: {}\tstatus: {}\t{}".format(
+                    payload, response.status_code, response.text.strip()
+                )
+            )
+            if response.status_code == 401:
+                # As with sensecam_control, wrong credentials end the thread moving the camera
+                sys.exit(1)
+        return response
+
+    def absolute_move(
+        self, pan: float = None, tilt: float = None, zoom: int = None, speed: int = None
+    ):
+        """Move to an absolute pan, tilt and zoom
+
+        Keyword Arguments:
+            pan {float} -- Pan relative to the (0, 0) position [deg]
+            tilt {float} -- Tilt relative to the (0, 0) position [deg]
+            zoom {int} -- Zoom step (0-9999)
+            speed {int} -- Pan/tilt speed (0-100)
+
+        Returns:
+            requests.Response -- Response of the camera
+        """
+        return self.ptz({"pan": pan, "tilt": tilt, "zoom": zoom, "speed": speed})
+
+    def continuous_move(self, pan_speed: int, tilt_speed: int):
+        """Pan and tilt continuously until the next command, 0, 0 stops
+
+        Arguments:
+            pan_speed {int} -- Pan speed, positive to the right (-100-100)
+            tilt_speed {int} -- Tilt speed, positive up (-100-100)
+
+        Returns:
+            requests.Response -- Response of the camera
+        """
+        return self.ptz({"continuouspantiltmove": "{},{}".format(pan_speed, tilt_speed)})
+
+    def position(self) -> Optional[Dict[str, float]]:
+        """Where the camera points now
+
+        Returns:
+            Optional[Dict[str, float]] -- Pan and tilt [deg] and zoom step, as answered by the camera, None if it did not answer
+        """
+        try:
+            response, _ = self.get(
+                "position",
+                "/axis-cgi/com/ptz.cgi",
+                {"query": "position", "camera": 1},
+                POSITION_TIMEOUT,
+            )
+        except requests.exceptions.RequestException as e:
+            logging.error("Unable to query position: {}".format(e))
+            return None
+        if response.status_code != 200:
+            return None
+        position = {}
+        for line in response.text.splitlines():
+            name, _, value = line.partition("=")
+            try:
+                position[name.strip()] = float(value)
+            except ValueError:
+                pass
+        return position if "pan" in position and "tilt" in position else None
+
+    def jpeg(self, params: Dict[str, Any] = None) -> Tuple[Optional[bytes], float]:
+        """Take a JPEG image
+
+        Keyword Arguments:
+            params {Dict[str, Any]} -- Parameters of image.cgi (default: {JPEG_PAYLOAD})
+
+        Returns:
+            Tuple[Optional[bytes], float] -- The image, None if the camera did not send one in time, and the network time in seconds
+        """
+        try:
+            response, network = self.get(
+                "jpeg",
+                "/axis-cgi/jpg/image.cgi",
+                params or JPEG_PAYLOAD,
+                self.jpeg_timeout,
+            )
+        except requests.exceptions.Timeout:
+            logging.info("🚨 Images capture request timed out 🚨  ")
+            return None, self.jpeg_timeout
+        except requests.exceptions.RequestException as e:
+            logging.error("Unable to fetch image: {}".format(e))
+            return None, 0.0
+        if response.status_code != 200:
+            logging.error(
+                "Unable to fetch image: {}\tstatus: {}".format(
+                    response.url, response.status_code
+                )
+            )
+            return None, network
+        return response.content, network
+
+    def bmp(self, params: Dict[str, Any] = None) -> requests.Response:
+        """Take a BMP image, waiting for as long as it takes
+
+        Keyword Arguments:
+            params {Dict[str, Any]} -- Parameters of image.bmp (default: {full resolution})
+
+        Returns:
+            requests.Response -- Response of the camera
+        """
+        response, _ = self.get(
+            "bmp",
+            "/axis-cgi/bitmap/image.bmp",
+            params or {"resolution": "1920x1080", "camera": 1},
+            None,
+        )
+        return response
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Timing of every kind of request sent so far"""
+        with self.lock:
+            return {kind: timing.summary() for kind, timing in self.timings.items()}
+
+    def close(self):
+        """Close the keep-alive connections"""
+        self.session.close()
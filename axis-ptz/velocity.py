@@ -0,0 +1,192 @@
+"""
+Velocity-mode pointing of the camera
+
+Sending an absolute move every move period makes the camera slew to each
+position and stop there until the next one, so it stutters behind the
+aircraft, and costs a PTZ command every period. In velocity mode the camera
+is given the pan and tilt rates the aircraft is moving at, as a continuous
+pan/tilt move, and keeps moving on its own between commands.
+
+Without a reading of the camera's position, where it points is dead
+reckoned from the last absolute move and the speeds sent since. The
+difference to where the aircraft is feeds back into the speeds, and a new
+absolute move corrects the position when the difference is too large, and
+now and then anyway, as the speeds the camera actually moves at drift from
+the ones it is sent. A new speed is only sent when it differs from the last
+one by more than the deadband.
+"""
+
+import math
+import threading
+from typing import *
+
+# Pan and tilt rate of the camera at a continuous move speed of 100 [deg/s]
+MAX_RATE = 100.0
+# Rates closer than this to the ones last sent are not sent [deg/s]
+DEADBAND = 0.2
+# Fraction of the pointing error taken out per second by the speeds sent [1/s]
+GAIN = 3.0
+# Pointing error an absolute move corrects [deg]
+CORRECTION_ERROR = 1.0
+# Seconds between absolute moves, at most, to correct the error that is not seen
+CORRECTION_INTERVAL = 5.0
+# Seconds the camera takes to finish an absolute move before it is moved continuously
+SETTLE = 0.3
+# Cosine of the tilt the pan rate is computed with, at least, so it stays finite overhead
+MIN_COS_TILT = 0.05
+
+
+def wrap(angle: float) -> float:
+    """An angle between -180 and 180 degrees"""
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+def pan_tilt_rates(horizontal: float, vertical: float, tilt: float) -> Tuple[float, float]:
+    """Pan and tilt rates from the angular velocity of the aircraft across the line of sight
+
+    Arguments:
+        horizontal {float} -- Horizontal angular velocity [deg/s]
+        vertical {float} -- Vertical angular velocity [deg/s]
+        tilt {float} -- Tilt of the line of sight [deg]
+
+    Returns:
+        Tuple[float, float] -- Pan and tilt rates [deg/s]
+    """
+    # A horizontal angle across the line of sight is a larger pan the higher it is
+    return horizontal / max(MIN_COS_TILT, math.cos(math.radians(tilt))), vertical
+
+
+class VelocityControl:
+    """Points the camera with continuous pan/tilt moves, corrected with absolute moves"""
+
+    def __init__(
+        self,
+        client,
+        max_rate: float = MAX_RATE,
+        deadband: float = DEADBAND,
+        gain: float = GAIN,
+        correction_error: float = CORRECTION_ERROR,
+        correction_interval: float = CORRECTION_INTERVAL,
+        settle: float = SETTLE,
+    ):
+        """Start with the position of the camera unknown
+
+        Arguments:
+            client {vapix.VapixClient} -- Session to the camera
+
+        Keyword Arguments:
+            max_rate {float} -- Pan and tilt rate at a continuous move speed of 100 [deg/s] (default: {100.0})
+            deadband {float} -- Rates closer than this to the ones last sent are not sent [deg/s] (default: {0.2})
+            gain {float} -- Fraction of the pointing error taken out per second [1/s] (default: {3.0})
+            correction_error {float} -- Pointing error an absolute move corrects [deg] (default: {1.0})
+            correction_interval {float} -- Seconds between absolute moves, at most (default: {5.0})
+            settle {float} -- Seconds an absolute move takes to finish (default: {0.3})
+        """
+        self.client = client
+        self.max_rate = max_rate
+        self.deadband = deadband
+        self.gain = gain
+        self.correction_error = correction_error
+        self.correction_interval = correction_interval
+        self.settle = settle
+        self.pan = None  # Where the camera is dead reckoned to point [deg]
+        self.tilt = None
+        self.speeds = (0, 0)  # Continuous move speeds last sent (-100-100)
+        self.updated = None  # time.monotonic() the position was dead reckoned to
+        self.corrected = None  # time.monotonic() of the last absolute move
+        self.settled = None  # time.monotonic() the last absolute move is finished at
+        self.lock = threading.Lock()
+        self.counts = {"absolute": 0, "continuous": 0, "suppressed": 0}
+
+    def _reckon(self, now: float):
+        # Moved at the speeds last sent, once the absolute move was finished
+        start = max(self.updated, self.settled)
+        if now > start:
+            self.pan = wrap(self.pan + self.speeds[0] * self.max_rate / 100.0 * (now - start))
+            self.tilt += self.speeds[1] * self.max_rate / 100.0 * (now - start)
+        self.updated = now
+
+    def _speed(self, rate: float) -> int:
+        return max(-100, min(100, int(round(rate * 100.0 / self.max_rate))))
+
+    def track(
+        self,
+        now: float,
+        pan: float,
+        tilt: float,
+        pan_rate: float,
+        tilt_rate: float,
+        zoom: int = None,
+        speed: int = None,
+    ) -> Optional[str]:
+        """Keep the camera moving with the aircraft
+
+        Arguments:
+            now {float} -- time.monotonic()
+            pan {float} -- Pan to point at now [deg]
+            tilt {float} -- Tilt to point at now [deg]
+            pan_rate {float} -- Rate the pan changes at [deg/s]
+            tilt_rate {float} -- Rate the tilt changes at [deg/s]
+
+        Keyword Arguments:
+            zoom {int} -- Zoom step of the absolute moves (0-9999) (default: {None})
+            speed {int} -- Pan/tilt speed of the absolute moves (0-100) (default: {None})
+
+        Returns:
+            Optional[str] -- "absolute" or "continuous", the command sent, None if none was
+        """
+        with self.lock:
+            if self.pan is not None:
+                if now < self.settled:
+                    # Moving continuously would cut the absolute move short
+                    return None
+                self._reckon(now)
+                pan_error = wrap(pan - self.pan)
+                tilt_error = tilt - self.tilt
+                error = math.hypot(pan_error * math.cos(math.radians(tilt)), tilt_error)
+            if (
+                self.pan is None
+                or error > self.correction_error
+                or now - self.corrected > self.correction_interval
+            ):
+                # Aim where the aircraft will be once the camera gets there
+                self.pan = wrap(pan + pan_rate * self.settle)
+                self.tilt = tilt + tilt_rate * self.settle
+                self.speeds = (0, 0)
+                self.updated = self.corrected = now
+                self.settled = now + self.settle
+                self.counts["absolute"] += 1
+                command = "absolute"
+            else:
+                pan_rate += self.gain * pan_error
+                tilt_rate += self.gain * tilt_error
+                sent_pan, sent_tilt = (s * self.max_rate / 100.0 for s in self.speeds)
+                speeds = (self._speed(pan_rate), self._speed(tilt_rate))
+                if speeds == self.speeds or (
+                    abs(pan_rate - sent_pan) < self.deadband
+                    and abs(tilt_rate - sent_tilt) < self.deadband
+                ):
+                    self.counts["suppressed"] += 1
+                    return None
+                self.speeds = speeds
+                self.counts["continuous"] += 1
+                command = "continuous"
+        if command == "absolute":
+            self.client.absolute_move(self.pan, self.tilt, zoom, speed)
+        else:
+            self.client.continuous_move(*speeds)
+        return command
+
+    def stop(self):
+        """Stop a continuous move, and forget the position for the next track() to correct"""
+        with self.lock:
+            moving = self.speeds != (0, 0)
+            self.pan = self.tilt = None
+            self.speeds = (0, 0)
+        if moving:
+            self.client.continuous_move(0, 0)
+
+    def stats(self) -> Dict[str, int]:
+        """Counts of the absolute and continuous moves sent, and of the continuous ones suppressed"""
+        with self.lock:
+            return dict(self.counts)
@@ -0,0 +1,176 @@
+"""
+The air picture on the planes topic, as full snapshots with deltas in between
+
+Every aircraft on the dashboard is published on the planes topic, so other
+consumers (dashboards, secondary cameras, loggers) can follow it without
+scraping the web page. A full snapshot is sent every SNAPSHOT_INTERVAL
+seconds, and in between only what changed since the previous message:
+
+    {"type": "snapshot", "seq": 40, "time": 1620915222.0,
+     "aircraft": {"a1b2c3": {"callsign": "UAL1", "lat": 38.01, ...}, ...}}
+
+    {"type": "delta", "seq": 41, "time": 1620915223.0,
+     "added": {"c3d4e5": {...}},
+     "changed": {"a1b2c3": {"lat": 38.0112, "lon": -77.00421, "squawk": null}},
+     "removed": ["f6a7b8"]}
+
+Fields that are not known are left out, and a field that stops being known
+is changed to null. Floats are rounded to what they are worth (PRECISION),
+so an aircraft that did not move does not show up in the delta. Every
+message has the next seq: a consumer that missed one ignores the deltas
+until the next snapshot, see AirPicture.
+"""
+
+from typing import *
+import json
+import dashboard
+
+# Seconds between full snapshots, deltas are sent in between
+SNAPSHOT_INTERVAL = 30.0
+# Observation fields that are published, keyed by icao24
+# Distance, azimuth and elevation are left out, they are relative to this camera and change with every position
+FIELDS = ("callsign", "squawk", "lat", "lon", "latLonTime", "altitude", "groundSpeed", "track", "verticalRate", "onGround",
+          "registration", "operator", "type", "manufacturer", "model")
+# Decimals kept for floats, about a meter for positions
+PRECISION = {"lat": 5, "lon": 5, "latLonTime": 1, "altitude": 0, "groundSpeed": 0, "track": 1, "verticalRate": 0}
+
+
+def compact(observation: Dict[str, Any]) -> Dict[str, Any]:
+    """The published fields of an observation from a dashboard.Snapshot, rounded, without the unknown ones"""
+    fields = {}
+    for f in FIELDS:
+        value = dashboard.plain(observation.get(f))
+        if value is None:
+            continue
+        if isinstance(value, float) and f in PRECISION:
+            value = round(value, PRECISION[f])
+        fields[f] = value
+    return fields
+
+
+def delta(old: Dict[str, Dict[str, Any]], new: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]], List[str]]:
+    """What changed between two air pictures of compacted observations
+
+    Arguments:
+        old {Dict[str, Dict[str, Any]]} -- Aircraft by icao24 as last published
+        new {Dict[str, Dict[str, Any]]} -- Aircraft by icao24 now
+
+    Returns:
+        Tuple -- The aircraft added, the fields changed per aircraft (None when no longer known) and the icao24 of the aircraft removed
+    """
+    added = {}
+    changed = {}
+    for (icao24, fields) in new.items():
+        before = old.get(icao24)
+        if before is None:
+            added[icao24] = fields
+            continue
+        if before == fields:
+            continue
+        diff = {f: v for (f, v) in fields.items() if before.get(f) != v}
+        diff.update((f, None) for f in before if f not in fields)
+        changed[icao24] = diff
+    removed = [icao24 for icao24 in old if icao24 not in new]
+    return (added, changed, removed)
+
+
+def encode(message: Dict[str, Any]) -> str:
+    return json.dumps(message, separators=(",", ":"))
+
+
+class PlanePublisher(object):
+    """
+    Turns air pictures into snapshot and delta messages and publishes them
+    """
+    __publish: Callable[[str], Any] = None
+    __snapshot_interval: float = SNAPSHOT_INTERVAL
+    __aircraft: Dict[str, Dict[str, Any]] = {}
+    __seq: int = 0
+    __next_snapshot: float = None
+    __stats: Dict[str, int] = {}
+
+    def __init__(self, publish: Callable[[str], Any], snapshot_interval: float = SNAPSHOT_INTERVAL):
+        """Set up the publisher
+
+        Arguments:
+            publish {Callable[[str], Any]} -- Sends a JSON message on the planes topic
+
+        Keyword Arguments:
+            snapshot_interval {float} -- Seconds between full snapshots, 0 to only send snapshots (default: {30.0})
+        """
+        self.__publish = publish
+        self.__snapshot_interval = snapshot_interval
+        self.__aircraft = {}
+        self.__seq = 0
+        self.__next_snapshot = None
+        self.__stats = {"snapshots": 0, "snapshot_bytes": 0, "deltas": 0, "delta_bytes": 0}
+
+    def update(self, observations: Iterable[Dict[str, Any]], now: float) -> Dict[str, Any]:
+        """Publish the air picture, in full if a snapshot is due and as a delta otherwise
+
+        Arguments:
+            observations {Iterable[Dict[str, Any]]} -- Observations as in dashboard.Snapshot.observations
+            now {float} -- Time of the air picture (seconds since the epoch)
+
+        Returns:
+            Dict[str, Any] -- The message published
+        """
+        aircraft = {o["icao24"]: compact(o) for o in observations}
+        self.__seq += 1
+        if self.__next_snapshot is None or now >= self.__next_snapshot:
+            message = {"type": "snapshot", "seq": self.__seq, "time": now, "aircraft": aircraft}
+            self.__next_snapshot = now + self.__snapshot_interval
+            kind = "snapshot"
+        else:
+            (added, changed, removed) = delta(self.__aircraft, aircraft)
+            message = {"type": "delta", "seq": self.__seq, "time": now, "added": added, "changed": changed, "removed": removed}
+            kind = "delta"
+        payload = encode(message)
+        self.__publish(payload)
+        self.__aircraft = aircraft
+        self.__stats[kind + "s"] += 1
+        self.__stats[kind + "_bytes"] += len(payload)
+        return message
+
+    def stats(self) -> Dict[str, int]:
+        """Number of snapshots and deltas published, and their total size in bytes"""
+        return dict(self.__stats)
+
+
+class AirPicture(object):
+    """
+    Follows the planes topic: the aircraft by icao24, as of the last message applied
+    """
+
+    def __init__(self):
+        self.aircraft = {}
+        self.seq = None
+
+    def apply(self, message: Dict[str, Any]) -> bool:
+        """Apply a snapshot or delta message
+
+        Arguments:
+            message {Dict[str, Any]} -- Decoded message from the planes topic
+
+        Returns:
+            bool -- False if the message was ignored, because deltas were missed and no snapshot came since
+        """
+        if message["type"] == "snapshot":
+            self.aircraft = {icao24: dict(fields) for (icao24, fields) in message["aircraft"].items()}
+        elif self.seq is None or message["seq"] != self.seq + 1:
+            self.seq = None
+            return False
+        else:
+            for icao24 in message["removed"]:
+                self.aircraft.pop(icao24, None)
+            for (icao24, fields) in message["added"].items():
+                self.aircraft[icao24] = dict(fields)
+            for (icao24, diff) in message["changed"].items():
+                fields = self.aircraft[icao24]
+                for (f, v) in diff.items():
+                    if v is None:
+                        fields.pop(f, None)
+                    else:
+                        fields[f] = v
+        self.seq = message["seq"]
+        return True
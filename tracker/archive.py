@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+Long-term archive of aircraft positions, as columns of NumPy arrays
+
+With --archive, the tracker keeps every position it hears in memory and
+writes it out in parts, at the end of every hour, every FLUSH_INTERVAL
+seconds and when FLUSH_ROWS positions are waiting. A part is a directory
+with one .npy file per column, sorted by aircraft and then time, and a small
+table with the identity of every aircraft in it:
+
+    <root>/2021-05-13/14/<part>/icao24.npy       uint32, sorted
+                                time.npy         float64, seconds since the epoch
+                                lat.npy, lon.npy float32, degrees
+                                altitude.npy     float32, meters
+                                ground_speed.npy float32, meters per second
+                                track.npy        float32, degrees
+                                vertical_rate.npy float32, meters per second
+                                aircraft.npy     icao24, callsign, squawk, registration, type and operator
+
+Days and hours are UTC. Parts are written to a hidden directory and renamed,
+so they are complete when they show up, and every process (shard) writes its
+own. The queries only open the hours they need and memory map the columns,
+so a scan reads the columns it uses and nothing else. Parts of an hour can be
+merged into one with the compact command.
+
+    ./archive.py /data/archive near --lat 38.9 --lon -77.0 --radius 5 --start 2021-05-13T14:00 --end 2021-05-13T16:00
+    ./archive.py /data/archive counts --start 2021-05-13
+    ./archive.py /data/archive types --start 2021-05-01 --end 2021-06-01 --top 20
+    ./archive.py /data/archive track a1b2c3 --start 2021-05-13
+    ./archive.py /data/archive compact
+"""
+
+from typing import *
+import argparse
+import math
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+import numpy as np
+
+# Position columns, in the order a row is appended
+COLUMNS = (
+    ("icao24", np.uint32),
+    ("time", np.float64),
+    ("lat", np.float32),
+    ("lon", np.float32),
+    ("altitude", np.float32),
+    ("ground_speed", np.float32),
+    ("track", np.float32),
+    ("vertical_rate", np.float32),
+)
+# Identity of the aircraft in a part, the latest heard
+AIRCRAFT = np.dtype([("icao24", np.uint32), ("callsign", "U8"), ("squawk", "U4"), ("registration", "U16"), ("type", "U64"), ("operator", "U64")])
+AIRCRAFT_FILE = "aircraft.npy"
+# Positions kept in memory before they are written, whatever the time
+FLUSH_ROWS = 250000
+# Seconds between writes, which is what is lost if the tracker is killed
+FLUSH_INTERVAL = 300.0
+HOUR = 3600
+EARTH_RADIUS = 6371000.0  # [m]
+
+
+def icao24Number(icao24: str) -> Optional[int]:
+    """The 24 bit address as a number, None if it is not hexadecimal"""
+    try:
+        return int(icao24, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def icao24Text(number: int) -> str:
+    return "%06x" % number
+
+
+def text(value) -> str:
+    """A string for the aircraft table, empty for unknown values including NaN from the aircraft database"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return str(value)
+
+
+def hourPath(root: str, hour: int) -> str:
+    """Directory of an hour, given in hours since the epoch"""
+    stamp = datetime.fromtimestamp(hour * HOUR, tz=timezone.utc)
+    return os.path.join(root, stamp.strftime("%Y-%m-%d"), stamp.strftime("%H"))
+
+
+class ArchiveWriter(object):
+    """
+    Buffers the positions heard and writes them out in parts
+    """
+    __root: str = None
+    __flush_rows: int = FLUSH_ROWS
+    __flush_interval: float = FLUSH_INTERVAL
+    __rows: List[Tuple] = []
+    __aircraft: Dict[int, Tuple] = {}
+    __hour: int = None
+    __next_flush: float = None
+    __parts: int = 0
+
+    def __init__(self, root: str, flush_rows: int = FLUSH_ROWS, flush_interval: float = FLUSH_INTERVAL):
+        """Set up the writer, nothing is written until the first flush
+
+        Arguments:
+            root {str} -- Directory of the archive
+
+        Keyword Arguments:
+            flush_rows {int} -- Positions kept in memory before they are written (default: {250000})
+            flush_interval {float} -- Seconds between writes (default: {300.0})
+        """
+        self.__root = root
+        self.__flush_rows = flush_rows
+        self.__flush_interval = flush_interval
+        self.__rows = []
+        self.__aircraft = {}
+        self.__hour = None
+        self.__next_flush = None
+        self.__parts = 0
+
+    def append(self, observation, now: float):
+        """Add the position of an observation
+
+        Arguments:
+            observation {Observation} -- The aircraft, just after a position update
+            now {float} -- Time the position was received (seconds since the epoch)
+        """
+        icao24 = icao24Number(observation.getIcao24())
+        if icao24 is None:
+            return
+        hour = int(now // HOUR)
+        if hour != self.__hour:
+            self.flush()
+            self.__hour = hour
+        if self.__next_flush is None:
+            self.__next_flush = now + self.__flush_interval
+        self.__rows.append((icao24, now, observation.getLat(), observation.getLon(), observation.getAltitude(), observation.getGroundSpeed(), observation.getTrack(), observation.getVerticalRate()))
+        self.__aircraft[icao24] = (icao24, observation.getCallsign(), observation.getSquawk(), observation.getRegistration(), observation.getType(), observation.getOperator())
+        if len(self.__rows) >= self.__flush_rows or now >= self.__next_flush:
+            self.flush()
+
+    def flush(self) -> Optional[str]:
+        """Write the positions kept in memory as a part
+
+        Returns:
+            Optional[str] -- Directory of the part, None if there was nothing to write
+        """
+        self.__next_flush = None
+        if not self.__rows:
+            return None
+        (rows, aircraft) = (self.__rows, self.__aircraft)
+        (self.__rows, self.__aircraft) = ([], {})
+        columns = {name: np.array(values, dtype=dtype) for ((name, dtype), values) in zip(COLUMNS, zip(*rows))}
+        table = np.array([(a[0],) + tuple(text(v) for v in a[1:]) for a in aircraft.values()], dtype=AIRCRAFT)
+        self.__parts += 1
+        name = "%d-%d-%d" % (int(time.time() * 1000), os.getpid(), self.__parts)
+        return writePart(hourPath(self.__root, self.__hour), name, columns, table)
+
+    def close(self):
+        """Write what is left"""
+        self.flush()
+
+
+def writePart(directory: str, name: str, columns: Dict[str, np.ndarray], aircraft: np.ndarray) -> str:
+    """Sort the columns by aircraft and time and write them as a part, renamed in place once complete
+
+    Arguments:
+        directory {str} -- Directory of the hour
+        name {str} -- Name of the part, unique in the hour
+        columns {Dict[str, np.ndarray]} -- The COLUMNS, all the same length
+        aircraft {np.ndarray} -- The identity of the aircraft, as AIRCRAFT
+
+    Returns:
+        str -- Directory of the part
+    """
+    order = np.lexsort((columns["time"], columns["icao24"]))
+    staging = os.path.join(directory, "." + name)
+    os.makedirs(staging, exist_ok=True)
+    for (column, _) in COLUMNS:
+        np.save(os.path.join(staging, column + ".npy"), columns[column][order])
+    np.save(os.path.join(staging, AIRCRAFT_FILE), np.sort(aircraft, order="icao24"))
+    part = os.path.join(directory, name)
+    os.rename(staging, part)
+    return part
+
+
+def parts(root: str, start: float = None, end: float = None) -> Iterator[Tuple[int, str]]:
+    """The parts of the hours that overlap a time range, oldest hour first
+
+    Arguments:
+        root {str} -- Directory of the archive
+
+    Keyword Arguments:
+        start {float} -- Start of the range, seconds since the epoch (default: {the beginning})
+        end {float} -- End of the range, not included (default: {the end})
+
+    Yields:
+        Tuple[int, str] -- Hour (hours since the epoch) and directory of the part
+    """
+    if not os.path.isdir(root):
+        return
+    for day in sorted(os.listdir(root)):
+        try:
+            midnight = int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            continue
+        if (end is not None and midnight >= end) or (start is not None and midnight + 24 * HOUR <= start):
+            continue
+        for hour_name in sorted(os.listdir(os.path.join(root, day))):
+            if not hour_name.isdigit():
+                continue
+            hour = midnight // HOUR + int(hour_name)
+            if (end is not None and hour * HOUR >= end) or (start is not None and (hour + 1) * HOUR <= start):
+                continue
+            directory = os.path.join(root, day, hour_name)
+            for name in sorted(os.listdir(directory)):
+                if not name.startswith("."):
+                    yield (hour, os.path.join(directory, name))
+
+
+def load(part: str, names: Iterable[str]) -> Dict[str, np.ndarray]:
+    """Memory map columns of a part"""
+    return {name: np.load(os.path.join(part, name + ".npy"), mmap_mode="r") for name in names}
+
+
+def loadAircraft(part: str) -> np.ndarray:
+    return np.load(os.path.join(part, AIRCRAFT_FILE))
+
+
+def inRange(times: np.ndarray, start: float = None, end: float = None) -> np.ndarray:
+    """Mask of the times in [start, end)"""
+    mask = np.ones(len(times), dtype=bool)
+    if start is not None:
+        mask &= times >= start
+    if end is not None:
+        mask &= times < end
+    return mask
+
+
+def distances(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Great circle distance in meters from a point to many"""
+    (phi1, phi2) = (math.radians(lat), np.radians(lats.astype(np.float64)))
+    a = np.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lons.astype(np.float64) - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def identities(root: str, start: float = None, end: float = None) -> Dict[int, np.void]:
+    """The latest identity of every aircraft in the hours overlapping a time range, by icao24 number"""
+    known = {}
+    for (_, part) in parts(root, start, end):
+        for row in loadAircraft(part):
+            known[int(row["icao24"])] = row
+    return known
+
+
+def near(root: str, lat: float, lon: float, radius: float, start: float = None, end: float = None) -> Dict[str, Dict[str, Any]]:
+    """Aircraft that came within a distance of a point in a time range
+
+    Arguments:
+        root {str} -- Directory of the archive
+        lat {float} -- Latitude of the point
+        lon {float} -- Longitude of the point
+        radius {float} -- Distance in meters
+
+    Keyword Arguments:
+        start {float} -- Start of the range, seconds since the epoch (default: {the beginning})
+        end {float} -- End of the range, not included (default: {the end})
+
+    Returns:
+        Dict[str, Dict[str, Any]] -- By icao24, the first and last time within the distance, the
+                                     positions within it and the closest distance
+    """
+    # A box around the point throws out most positions before any trigonometry
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(lat)) - dlat / 90.0, 1e-6)
+    found = {}
+    for (_, part) in parts(root, start, end):
+        c = load(part, ("icao24", "time", "lat", "lon"))
+        mask = inRange(c["time"], start, end) & (np.abs(c["lat"] - lat) <= dlat) & (np.abs(c["lon"] - lon) <= dlon)
+        index = np.flatnonzero(mask)
+        if not len(index):
+            continue
+        d = distances(lat, lon, c["lat"][index], c["lon"][index])
+        index = index[d <= radius]
+        d = d[d <= radius]
+        for (icao24, t, dist) in zip(c["icao24"][index], c["time"][index], d):
+            key = icao24Text(int(icao24))
+            entry = found.get(key)
+            if entry is None:
+                found[key] = {"first": float(t), "last": float(t), "positions": 1, "closest": float(dist)}
+            else:
+                entry["first"] = min(entry["first"], float(t))
+                entry["last"] = max(entry["last"], float(t))
+                entry["positions"] += 1
+                entry["closest"] = min(entry["closest"], float(dist))
+    return found
+
+
+def hourlyCounts(root: str, start: float = None, end: float = None) -> List[Tuple[int, int, int]]:
+    """Number of aircraft and positions in every hour of a time range
+
+    Returns:
+        List[Tuple[int, int, int]] -- Hour (hours since the epoch), aircraft and positions, oldest first
+    """
+    hours = {}
+    for (hour, part) in parts(root, start, end):
+        c = load(part, ("icao24", "time"))
+        icao24 = c["icao24"]
+        if (start is not None and hour * HOUR < start) or (end is not None and (hour + 1) * HOUR > end):
+            icao24 = icao24[inRange(c["time"], start, end)]
+        (seen, positions) = hours.get(hour, ([], 0))
+        # The column is sorted, so the aircraft are where it changes
+        seen.append(np.asarray(icao24)[np.concatenate(([True], icao24[1:] != icao24[:-1]))] if len(icao24) else icao24)
+        hours[hour] = (seen, positions + len(icao24))
+    return [(hour, len(np.unique(np.concatenate(seen))), positions) for (hour, (seen, positions)) in sorted(hours.items())]
+
+
+def topTypes(root: str, start: float = None, end: float = None, top: int = 10) -> List[Tuple[str, int]]:
+    """The aircraft types seen the most in a time range, counting every aircraft once
+
+    Returns:
+        List[Tuple[str, int]] -- Type and number of aircraft, most first
+    """
+    types = {}
+    for (icao24, row) in identities(root, start, end).items():
+        kind = str(row["type"]) or "unknown"
+        types[kind] = types.get(kind, 0) + 1
+    return sorted(types.items(), key=lambda t: (-t[1], t[0]))[:top]
+
+
+def track(root: str, icao24: str, start: float = None, end: float = None) -> Dict[str, np.ndarray]:
+    """Every position of one aircraft in a time range
+
+    Returns:
+        Dict[str, np.ndarray] -- The COLUMNS, in time order
+    """
+    number = icao24Number(icao24)
+    pieces = {name: [] for (name, _) in COLUMNS}
+    for (_, part) in parts(root, start, end):
+        c = load(part, [name for (name, _) in COLUMNS])
+        # The part is sorted by aircraft, so it is a slice
+        (first, last) = np.searchsorted(c["icao24"], [number, number + 1])
+        if first == last:
+            continue
+        mask = inRange(c["time"][first:last], start, end)
+        for name in pieces:
+            pieces[name].append(np.asarray(c[name][first:last])[mask])
+    if not pieces["time"]:
+        return {name: np.zeros(0, dtype=dtype) for (name, dtype) in COLUMNS}
+    columns = {name: np.concatenate(values) for (name, values) in pieces.items()}
+    order = np.argsort(columns["time"], kind="stable")
+    return {name: values[order] for (name, values) in columns.items()}
+
+
+def compact(root: str, before: float = None) -> int:
+    """Merge the parts of every hour that has ended into one
+
+    Arguments:
+        root {str} -- Directory of the archive
+
+    Keyword Arguments:
+        before {float} -- Only hours that ended before this, seconds since the epoch (default: {now})
+
+    Returns:
+        int -- Number of hours merged
+    """
+    before = time.time() if before is None else before
+    by_hour = {}
+    for (hour, part) in parts(root, end=before):
+        if (hour + 1) * HOUR <= before:
+            by_hour.setdefault(hour, []).append(part)
+    merged = 0
+    for (hour, hour_parts) in sorted(by_hour.items()):
+        if len(hour_parts) < 2:
+            continue
+        columns = {name: np.concatenate([np.load(os.path.join(p, name + ".npy")) for p in hour_parts]) for (name, _) in COLUMNS}
+        aircraft = {}
+        for p in hour_parts:  # Later parts have the later identity
+            for row in loadAircraft(p):
+                aircraft[int(row["icao24"])] = row
+        writePart(hourPath(root, hour), "compacted-%d" % int(time.time() * 1000), columns, np.array(list(aircraft.values()), dtype=AIRCRAFT))
+        for p in hour_parts:
+            shutil.rmtree(p)
+        merged += 1
+    return merged
+
+
+def parseTime(value: str) -> Optional[float]:
+    """Seconds since the epoch from seconds since the epoch or an ISO 8601 date and time, UTC unless it says otherwise"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    stamp = datetime.fromisoformat(value)
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=timezone.utc)
+    return stamp.timestamp()
+
+
+def utc(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the position archive written by the tracker with --archive')
+    parser.add_argument('root', help="directory of the archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for (name, help) in (("near", "aircraft that came within a distance of a point"), ("counts", "aircraft and positions per hour"), ("types", "aircraft types seen the most"), ("track", "positions of one aircraft"), ("compact", "merge the parts of every hour that has ended")):
+        command = commands.add_parser(name, help=help)
+        if name == "compact":
+            continue
+        command.add_argument('--start', help="start of the time range, ISO 8601 (UTC) or seconds since the epoch")
+        command.add_argument('--end', help="end of the time range, not included")
+    commands.choices["near"].add_argument('--lat', type=float, required=True, help="latitude of the point")
+    commands.choices["near"].add_argument('--lon', type=float, required=True, help="longitude of the point")
+    commands.choices["near"].add_argument('--radius', type=float, required=True, help="distance from the point in km")
+    commands.choices["types"].add_argument('--top', type=int, help="number of types (default 10)", default=10)
+    commands.choices["track"].add_argument('icao24', help="address of the aircraft")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        print("%d hours compacted" % compact(args.root))
+        return
+    (start, end) = (parseTime(args.start), parseTime(args.end))
+    if args.command == "near":
+        found = near(args.root, args.lat, args.lon, args.radius * 1000.0, start, end)
+        known = identities(args.root, start, end)
+        print("icao24  callsign  type                            first                last                 positions  closest km")
+        for (icao24, entry) in sorted(found.items(), key=lambda f: f[1]["first"]):
+            row = known.get(icao24Number(icao24))
+            (callsign, kind) = (row["callsign"], row["type"]) if row is not None else ("", "")
+            print("%s  %-8s  %-30s  %s  %s  %9d  %10.2f" % (icao24, callsign, kind[:30], utc(entry["first"]), utc(entry["last"]), entry["positions"], entry["closest"] / 1000.0))
+    elif args.command == "counts":
+        print("hour (UTC)           aircraft  positions")
+        for (hour, aircraft, positions) in hourlyCounts(args.root, start, end):
+            print("%s  %8d  %9d" % (utc(hour * HOUR)[:13] + ":00", aircraft, positions))
+    elif args.command == "types":
+        for (kind, count) in topTypes(args.root, start, end, args.top):
+            print("%6d  %s" % (count, kind))
+    elif args.command == "track":
+        columns = track(args.root, args.icao24, start, end)
+        print(",".join(name for (name, _) in COLUMNS[1:]))
+        for row in zip(*(columns[name] for (name, _) in COLUMNS[1:])):
+            print("%s,%.5f,%.5f,%.0f,%.1f,%.1f,%.1f" % ((utc(row[0]),) + tuple(row[1:])))
+
+
+if __name__ == "__main__":
+    main()
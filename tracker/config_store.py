@@ -0,0 +1,65 @@
+"""
+Immutable runtime configuration for the flight tracker
+
+The MQTT callback thread receives configuration and EGI updates while the
+ingest and publish threads are in the middle of computations. Instead of
+rewriting module globals field by field, every update builds a new frozen
+snapshot which is swapped in by reference. Readers grab one snapshot and use
+it for the whole computation, and can compare `version` to find out if any
+cached derived state needs to be rebuilt.
+"""
+
+from typing import *
+import threading
+
+
+class TrackerConfig(NamedTuple):
+    """A frozen view of the tracker's runtime configuration"""
+    camera_latitude: float = None
+    camera_longitude: float = None
+    camera_altitude: float = None
+    camera_lead: float = None
+    min_elevation: int = None
+    min_altitude: int = None
+    max_altitude: int = None
+    min_distance: int = None
+    max_distance: int = None
+    aircraft_pinned: str = None
+    sun_exclusion: float = None
+    rules: Tuple[Dict[str, Any], ...] = ()  # Declared trackability rules, see rules.py
+    version: int = 0
+
+
+class ConfigStore(object):
+    """
+    Holds the current configuration snapshot. Reads are a single reference
+    load and need no lock, writers are serialized so no update is lost.
+    """
+
+    def __init__(self, config: TrackerConfig):
+        self.__lock = threading.Lock()
+        self.__config = config
+
+    def get(self) -> TrackerConfig:
+        """Return the current configuration snapshot"""
+        return self.__config
+
+    def version(self) -> int:
+        """Return the version of the current configuration snapshot"""
+        return self.__config.version
+
+    def update(self, **changes) -> TrackerConfig:
+        """Swap in a new snapshot with the given fields changed
+
+        The version is only bumped if a value actually changed, so repeated
+        EGI messages with the same position do not invalidate cached state.
+
+        Returns:
+            TrackerConfig -- The snapshot in effect after the update
+        """
+        with self.__lock:
+            current = self.__config
+            changed = {k: v for k, v in changes.items() if getattr(current, k) != v}
+            if changed:
+                self.__config = current._replace(version=current.version + 1, **changed)
+            return self.__config
@@ -0,0 +1,173 @@
+"""
+Dashboard and JSON API for the tracker, served by an ASGI server
+
+The web server runs in its own thread with an asyncio event loop, and never
+touches the tracker's observations: about once a second the ingest loop
+hands over an immutable Snapshot, swapped in by reference, and every request
+is answered from the latest one. The answer only changes with the snapshot,
+so the encoded and gzipped bodies are cached per snapshot, and any number of
+browsers polling the same page cost one render a second of ingest CPU.
+
+Routes:
+    /                   -- the status page
+    /metrics            -- ingest, overload and rule rejection counters
+    /api/observations   -- the aircraft, nearest first, with
+                           ?offset=&limit= for pagination (limit up to MAX_LIMIT)
+                           and ?fields=icao24,distance,... to pick fields
+"""
+
+from typing import *
+import gzip
+import json
+import math
+import os
+import threading
+import numpy as np
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from jinja2 import Environment, FileSystemLoader
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# Bodies smaller than this are sent as they are
+GZIP_MIN_SIZE = 500
+GZIP_LEVEL = 6
+# Observation fields that are only bookkeeping
+INTERNAL_FIELDS = ("geometryStale", "planedb_nagged")
+# Distinct queries cached for one snapshot, before the cache is emptied
+CACHE_SIZE = 256
+
+
+class Snapshot(NamedTuple):
+    """What the dashboard shows, as of one pass of the ingest loop"""
+    version: int = 0
+    time: float = None
+    tracking: str = None
+    observations: Tuple[Dict[str, Any], ...] = ()  # Nearest first, see observationFields()
+    config: Dict[str, Any] = {}
+    overload: Dict[str, Any] = {}
+    ingest: Dict[str, Any] = {}
+    rejections: Dict[str, int] = {}
+
+
+def plain(value):
+    """The value as something JSON can encode: numpy scalars become Python ones, NaN becomes None"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def observationFields(observation: Dict[str, Any]) -> Dict[str, Any]:
+    """An Observation.dict() without the name mangling on the keys or the bookkeeping fields, and with JSON safe values"""
+    fields = {k.replace("_Observation__", ""): plain(v) for (k, v) in observation.items()}
+    for k in INTERNAL_FIELDS:
+        fields.pop(k, None)
+    return fields
+
+
+class Dashboard(object):
+    """
+    The ASGI application, reading from a function that returns the latest Snapshot
+    """
+    __snapshots: Callable[[], Snapshot] = None
+    __cache: Dict[Tuple, Tuple[bytes, Optional[bytes]]] = {}
+    __cache_version: int = None
+
+    def __init__(self, snapshots: Callable[[], Snapshot], root: str = None):
+        """Set up the application
+
+        Arguments:
+            snapshots {Callable[[], Snapshot]} -- Returns the latest snapshot, must not block
+
+        Keyword Arguments:
+            root {str} -- Directory with the templates and static directories (default: {the directory of this file})
+        """
+        root = root or os.path.dirname(os.path.abspath(__file__))
+        self.__snapshots = snapshots
+        self.__cache = {}
+        self.__cache_version = None
+        self.__templates = Environment(loader=FileSystemLoader(os.path.join(root, "templates")), autoescape=True)
+        self.app = Starlette(routes=[
+            Route("/", self.index),
+            Route("/metrics", self.metrics),
+            Route("/api/observations", self.observations),
+            Mount("/static", StaticFiles(directory=os.path.join(root, "static")), name="static"),
+        ])
+
+    def __respond(self, request: Request, key: Tuple, media_type: str, build: Callable[[Snapshot], bytes]) -> Response:
+        """Answer from the cache for the current snapshot, building and compressing the body only on a miss"""
+        snapshot = self.__snapshots()
+        if snapshot.version != self.__cache_version or len(self.__cache) >= CACHE_SIZE:
+            self.__cache = {}
+            self.__cache_version = snapshot.version
+        entry = self.__cache.get(key)
+        if entry is None:
+            body = build(snapshot)
+            entry = (body, gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_SIZE else None)
+            self.__cache[key] = entry
+        (body, zipped) = entry
+        headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if zipped is not None and "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return Response(zipped, media_type=media_type, headers=headers)
+        return Response(body, media_type=media_type, headers=headers)
+
+    def __json(self, content: Any) -> bytes:
+        return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+    async def index(self, request: Request) -> Response:
+        def build(snapshot: Snapshot) -> bytes:
+            template = self.__templates.get_template("index.html")
+            return template.render(title="SkyScan", tracking=snapshot.tracking, observations=snapshot.observations, config=snapshot.config, overload=snapshot.overload).encode("utf-8")
+        return self.__respond(request, ("index",), "text/html", build)
+
+    async def metrics(self, request: Request) -> Response:
+        def build(snapshot: Snapshot) -> bytes:
+            return self.__json({"time": snapshot.time, "ingest": snapshot.ingest, "overload": snapshot.overload, "rejections": snapshot.rejections})
+        return self.__respond(request, ("metrics",), "application/json", build)
+
+    async def observations(self, request: Request) -> Response:
+        try:
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+            limit = min(max(int(request.query_params.get("limit", DEFAULT_LIMIT)), 0), MAX_LIMIT)
+        except ValueError:
+            return Response(self.__json({"error": "offset and limit have to be integers"}), status_code=400, media_type="application/json")
+        fields = request.query_params.get("fields")
+        fields = tuple(f for f in fields.split(",") if f) if fields else None
+        snapshot = self.__snapshots()
+        if fields and snapshot.observations:
+            unknown = [f for f in fields if f not in snapshot.observations[0]]
+            if unknown:
+                return Response(self.__json({"error": "Unknown fields: {}".format(", ".join(unknown)), "fields": sorted(snapshot.observations[0])}), status_code=400, media_type="application/json")
+
+        def build(snapshot: Snapshot) -> bytes:
+            page = snapshot.observations[offset:offset + limit]
+            if fields:
+                page = [{f: o.get(f) for f in fields} for o in page]
+            return self.__json({"time": snapshot.time, "tracking": snapshot.tracking, "total": len(snapshot.observations), "offset": offset, "limit": limit, "observations": list(page)})
+        return self.__respond(request, ("observations", offset, limit, fields), "application/json", build)
+
+
+def serve(dashboard: Dashboard, host: str = "0.0.0.0", port: int = 5000) -> uvicorn.Server:
+    """Run the dashboard in a daemon thread
+
+    Arguments:
+        dashboard {Dashboard} -- The application to serve
+
+    Keyword Arguments:
+        host {str} -- Address to listen on (default: {"0.0.0.0"})
+        port {int} -- Port to listen on (default: {5000})
+
+    Returns:
+        uvicorn.Server -- The server, set `should_exit` on it to stop it
+    """
+    server = uvicorn.Server(uvicorn.Config(dashboard.app, host=host, port=port, log_level="warning", access_log=False))
+    server.install_signal_handlers = lambda: None  # Only possible in the main thread, which belongs to the tracker
+    threading.Thread(target=server.run, daemon=True, name="dashboard").start()
+    return server
@@ -0,0 +1,120 @@
+"""
+Cheap prefilter for aircraft that cannot be tracked with the current config
+
+The trackability limits on distance, altitude and elevation are turned into
+a latitude/longitude box around the camera and an altitude band. These take a
+few comparisons per position, so most aircraft can be rejected before any
+haversine, bearing or elevation is computed. The box only depends on the
+configuration, so it is rebuilt when the config version changes, e.g. on an
+EGI update.
+
+The box is never smaller than the exact checks: anything it rejects would
+also be rejected by `isTrackable`.
+"""
+
+import math
+import threading
+from config_store import TrackerConfig
+
+EARTH_RADIUS = 6371000.0  # [m] Same sphere as utils.coordinate_distance
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+# Widening of the box, in degrees, so rounding never rejects a trackable aircraft
+MARGIN = 1e-6
+
+
+class Envelope(object):
+    """
+    Latitude/longitude box and altitude band outside which an aircraft cannot
+    be tracked
+    """
+
+    def __init__(self, config: TrackerConfig):
+        """Derive the envelope from a configuration snapshot
+
+        Arguments:
+            config {TrackerConfig} -- The configuration to derive it from
+        """
+        self.version = config.version
+        self.latitude = config.camera_latitude
+        self.longitude = config.camera_longitude
+        camera_altitude = config.camera_altitude or 0
+
+        self.min_altitude = config.min_altitude
+        self.max_altitude = config.max_altitude
+        if config.max_distance is not None:
+            # The 3D distance is never less than the altitude difference
+            low = camera_altitude - config.max_distance
+            high = camera_altitude + config.max_distance
+            self.min_altitude = low if self.min_altitude is None else max(self.min_altitude, low)
+            self.max_altitude = high if self.max_altitude is None else min(self.max_altitude, high)
+
+        # Elevation is atan(height above the camera / ground distance), so for a minimum elevation
+        # above the horizon an aircraft needs to be higher than the camera by the ground distance
+        # times its tangent. The ground distance is at least the latitude difference in meters.
+        self.camera_altitude = camera_altitude
+        self.height_per_degree = None
+        if config.min_elevation is not None and config.min_elevation > 0:
+            self.height_per_degree = METERS_PER_DEGREE * math.tan(math.radians(config.min_elevation))
+
+        # The ground distance is never more than the 3D distance
+        radius = config.max_distance
+        if radius is not None and self.height_per_degree and self.max_altitude is not None:
+            radius = min(radius, max(self.max_altitude - camera_altitude, 0) / self.height_per_degree * METERS_PER_DEGREE)
+
+        self.dlat = None
+        self.dlon = None
+        if radius is not None and self.latitude is not None and self.longitude is not None:
+            # Bounding box of a spherical cap, after J.P. Matuschek
+            angle = radius / EARTH_RADIUS
+            self.dlat = math.degrees(angle) + MARGIN
+            if abs(self.latitude) + self.dlat < 90 and angle < math.pi / 2:
+                self.dlon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(self.latitude)))) + MARGIN
+
+    def contains(self, lat: float, lon: float, altitude: float) -> bool:
+        """Can an aircraft at this position be within the tracking limits
+
+        Arguments:
+            lat {float} -- Latitude of the aircraft
+            lon {float} -- Longitude of the aircraft
+            altitude {float} -- Altitude of the aircraft in meters
+
+        Returns:
+            bool -- False if the aircraft is certain to be out of limits
+        """
+        if self.max_altitude is not None and altitude > self.max_altitude:
+            return False
+        if self.min_altitude is not None and altitude < self.min_altitude:
+            return False
+        if self.latitude is None:
+            return True
+        dlat = abs(lat - self.latitude)
+        if self.dlat is not None and dlat > self.dlat:
+            return False
+        if self.dlon is not None and abs((lon - self.longitude + 180) % 360 - 180) > self.dlon:
+            return False
+        if self.height_per_degree is not None and dlat * self.height_per_degree > altitude - self.camera_altitude + MARGIN:
+            return False
+        return True
+
+
+_lock = threading.Lock()
+_current: Envelope = None
+
+
+def forConfig(config: TrackerConfig) -> Envelope:
+    """The envelope for a configuration snapshot, rebuilt only when its version changes
+
+    Arguments:
+        config {TrackerConfig} -- The configuration snapshot
+
+    Returns:
+        Envelope -- The envelope for that configuration
+    """
+    global _current
+    current = _current
+    if current is not None and current.version == config.version:
+        return current
+    with _lock:
+        if _current is None or _current.version != config.version:
+            _current = Envelope(config)
+        return _current
@@ -31,20 +31,31 @@ import os
 import logging
 import coloredlogs
 import calendar
-from datetime import datetime, timedelta
+from datetime import datetime
 import signal
 import random
 import time
 import re
 import errno
+import heapq
 import sbs1
 import utils
+import ingest
+import shard
+import envelope
+import horizon
+import sun
+import preposition
+import rules
+import dashboard
+import airpicture
+import archive
+from config_store import ConfigStore, TrackerConfig
 import paho.mqtt.client as mqtt 
 from json.decoder import JSONDecodeError
 import pandas as pd
+import numpy as np
 from queue import Queue
-from flask import Flask
-from flask import render_template
 
 ID = str(random.randint(1,100001))
 
@@ -52,51 +63,31 @@ ID = str(random.randint(1,100001))
 OBSERVATION_CLEAN_INTERVAL = 10
 # Socket read timeout
 DUMP1090_SOCKET_TIMEOUT = 60
+# Maximum number of bytes read from dump1090 at once
+DUMP1090_READ_SIZE = 65536
+# Maximum number of bytes drained from the socket into a single batch
+DUMP1090_MAX_BATCH_SIZE = 4 * 1024 * 1024
+# Batches with more messages than this are coalesced per aircraft before processing
+OVERLOAD_THRESHOLD = 1000
+# Number of messages the ingest queue holds between the dump1090 reader and the processing loop
+INGEST_QUEUE_SIZE = 50000
+# Seconds the processing loop waits for messages before cleaning observations anyway
+INGEST_WAIT = 1.0
+# Number of tracking candidates each shard worker reports
+SHARD_CANDIDATES = 5
+# Seconds between predictions of where the camera should wait for the next plane
+PREPOSITION_INTERVAL = 1.0
+# Seconds between snapshots of the observations handed to the dashboard
+SNAPSHOT_INTERVAL = 1.0
 q=Queue() # Good writeup of how to pass messages from MQTT into classes, here: http://www.steves-internet-guide.com/mqtt-python-callbacks/
 args = None
-camera_latitude = None
 plant_topic = None # the onMessage function needs to be outside the Class and it needs to get the Plane Topic, so it prob needs to be a global
 config_topic = "skyscan/config/json"
-camera_longitude = None
-camera_altitude = None
-camera_lead = None
-min_elevation = None
-min_altitude = None
-max_altitude = None
-min_distance = None
-max_distance = None
-aircraft_pinned = None
+config_store = ConfigStore(TrackerConfig()) # Runtime configuration, swapped atomically by the MQTT callback
+horizon_mask = None # Lowest visible elevation by azimuth, if a horizon was given
+sun_position = sun.Sun() # Position of the sun, computed once a second
 tracker = None
 
-app = Flask(__name__)
-
-# http://stackoverflow.com/questions/1165352/fast-comparison-between-two-python-dictionary
-class DictDiffer(object):
-    """
-    Calculate the difference between two dictionaries as:
-    (1) items added
-    (2) items removed
-    (3) keys same in both but changed values
-    (4) keys same in both and unchanged values
-    """
-    def __init__(self, current_dict, past_dict):
-        self.current_dict, self.past_dict = current_dict, past_dict
-        self.set_current, self.set_past = set(current_dict.keys()), set(past_dict.keys())
-        self.intersect = self.set_current.intersection(self.set_past)
-
-    def added(self):
-        return self.set_current - self.intersect
-
-    def removed(self):
-        return self.set_past - self.intersect
-
-    def changed(self):
-        return set(o for o in self.intersect if self.past_dict[o] != self.current_dict[o])
-
-    def unchanged(self):
-        return set(o for o in self.intersect if self.past_dict[o] == self.current_dict[o])
-
-
 class Observation(object):
     """
     This class keeps track of the observed flights around us.
@@ -120,24 +111,34 @@ class Observation(object):
     __updated = None
     __distance = None
     __bearing = None
+    __azimuth = None
     __elevation = None
     __planedb_nagged = False  # Used in case the icao24 is unknown and we only want to log this once
     __onGround = None
+    __squawk = None
+    __geometryStale = False  # Set when distance, bearing and elevation were skipped by the envelope prefilter or left for later
 
-    def __init__(self, sbs1msg):
+    def __init__(self, sbs1msg, now: float):
+        """Create an observation from the first SBS1 message heard from a plane
+
+        Arguments:
+            sbs1msg {dict} -- Parsed SBS1 message
+            now {float} -- Time the message was received (seconds since the epoch)
+        """
 
         self.__icao24 = sbs1msg["icao24"].lower() #lets always keep icao24 in lower case
-        self.__loggedDate = datetime.utcnow()  # sbs1msg["loggedDate"]
+        self.__loggedDate = now  # sbs1msg["loggedDate"]
         self.__callsign = sbs1msg["callsign"]
         self.__altitude = sbs1msg["altitude"]
-        self.__altitudeTime = datetime.utcnow()
+        self.__altitudeTime = now
         self.__groundSpeed = sbs1msg["groundSpeed"]
         self.__track = sbs1msg["track"]
         self.__lat = sbs1msg["lat"]
         self.__lon = sbs1msg["lon"]
-        self.__latLonTime = datetime.utcnow()
-        self.__verticalRate = sbs1msg["verticalRate"]
+        self.__latLonTime = now
+        self.__verticalRate = sbs1msg["verticalRate"] or 0
         self.__onGround = sbs1msg["onGround"]
+        self.__squawk = None if sbs1msg["squawk"] is None else "%04d" % sbs1msg["squawk"]
         self.__operator = None
         self.__registration = None
         self.__type = None
@@ -162,55 +163,148 @@ class Observation(object):
                 
 
     
-    def update(self, sbs1msg):
-        """ Updates information about a plane from an SBS1 message """
-
-        oldData = dict(self.__dict__) # save existing data to determine if anything has changed
-        self.__loggedDate = datetime.utcnow()
-
-        if sbs1msg["icao24"]:
-            self.__icao24 = sbs1msg["icao24"].lower() # Let's always keep icao24 in lower case
-        if sbs1msg["callsign"] and self.__callsign != sbs1msg["callsign"]:
-            self.__callsign = sbs1msg["callsign"].rstrip()
-        if sbs1msg["altitude"] is not None:
-            if self.__altitude != sbs1msg["altitude"]:
-                self.__altitude = sbs1msg["altitude"]
-                self.__altitudeTime = sbs1msg["generatedDate"]
-        if sbs1msg["groundSpeed"] is not None:
-            self.__groundSpeed = sbs1msg["groundSpeed"]
-        if sbs1msg["track"] is not None:
-            self.__track = sbs1msg["track"]
-        if sbs1msg["onGround"] is not None:
-            self.__onGround = sbs1msg["onGround"]
-        if sbs1msg["lat"] is not None:
+    def update(self, sbs1msg, now: float) -> bool:
+        """Updates information about a plane from an SBS1 message received at `now` (seconds since the epoch)
+
+        Each transmission type only carries a few fields, so the message is handed
+        to the update for its type and only that type looks at geometry.
+
+        Arguments:
+            sbs1msg {dict} -- Parsed SBS1 message
+            now {float} -- Time the message was received (seconds since the epoch)
+
+        Returns:
+            bool -- True if the position or velocity changed, so the plane's trackability needs another look
+        """
+        self.__loggedDate = now
+        return Observation.__updates.get(sbs1msg["transmissionType"], Observation.__updateAll)(self, sbs1msg, now)
+
+    def __updateIdentity(self, sbs1msg, now: float) -> bool:
+        """MSG,1: callsign"""
+        callsign = sbs1msg["callsign"]
+        self.__updated = bool(callsign) and self.__callsign != callsign
+        if self.__updated:
+            self.__callsign = callsign.rstrip()
+        return False
+
+    def __updatePosition(self, sbs1msg, now: float) -> bool:
+        """MSG,2 and MSG,3: surface and airborne position"""
+        self.__updated = False
+        self.__updateAltitude(sbs1msg, now)
+        self.__updateOnGround(sbs1msg)
+        self.__updateSpeedAndTrack(sbs1msg)
+        if sbs1msg["lat"] is not None and sbs1msg["lon"] is not None:
+            self.__updated |= (self.__lat, self.__lon) != (sbs1msg["lat"], sbs1msg["lon"])
             self.__lat = sbs1msg["lat"]
-            self.__latLonTime = sbs1msg["generatedDate"]
-        if sbs1msg["lon"] is not None:
             self.__lon = sbs1msg["lon"]
-            self.__latLonTime = sbs1msg["generatedDate"]
+            self.__latLonTime = now
+        if self.__hasPosition():
+            config = config_store.get()
+            if envelope.forConfig(config).contains(self.__lat, self.__lon, self.__altitude):
+                self.__updateGeometry(config)
+            else:
+                # It cannot be tracked, so only work out where it is if someone asks
+                self.__geometryStale = True
+        return True
+
+    def __updateVelocity(self, sbs1msg, now: float) -> bool:
+        """MSG,4: ground speed, track and vertical rate"""
+        self.__updated = False
+        self.__updateSpeedAndTrack(sbs1msg)
         if sbs1msg["verticalRate"] is not None:
-            self.__verticalRate =  sbs1msg["verticalRate"]
+            self.__updated |= self.__verticalRate != sbs1msg["verticalRate"]
+            self.__verticalRate = sbs1msg["verticalRate"]
+        self.__invalidateGeometry()
+        return True
 
-        if not self.__verticalRate:
-            self.__verticalRate = 0
+    def __updateSurveillance(self, sbs1msg, now: float) -> bool:
+        """MSG,5, MSG,6 and MSG,7: altitude and squawk"""
+        self.__updated = False
+        if self.__updateAltitude(sbs1msg, now):
+            self.__invalidateGeometry()
+        self.__updateOnGround(sbs1msg)
+        self.__updateSquawk(sbs1msg)
+        return False
+
+    def __updateAllCall(self, sbs1msg, now: float) -> bool:
+        """MSG,8: all call reply, only tells if the plane is on the ground"""
+        self.__updated = False
+        self.__updateOnGround(sbs1msg)
+        return False
+
+    def __updateAll(self, sbs1msg, now: float) -> bool:
+        """Message without a known transmission type, take whatever it has"""
+        self.__updateIdentity(sbs1msg, now)
+        updated = self.__updated
+        self.__updatePosition(sbs1msg, now)
+        updated |= self.__updated
+        self.__updateVelocity(sbs1msg, now)
+        self.__updateSquawk(sbs1msg)
+        self.__updated |= updated
+        return True
 
- 
-        if self.__lat and self.__lon and self.__altitude and self.__track:
-            # Calculates the distance from the cameras location to the airplane. The output is in METERS!
-            distance3d = utils.coordinate_distance_3d(camera_latitude, camera_longitude, camera_altitude, self.__lat, self.__lon, self.__altitude)
-            distance2d = utils.coordinate_distance(camera_latitude, camera_longitude,  self.__lat, self.__lon )
-            
+    def __updateAltitude(self, sbs1msg, now: float) -> bool:
+        if sbs1msg["altitude"] is not None and self.__altitude != sbs1msg["altitude"]:
+            self.__altitude = sbs1msg["altitude"]
+            self.__altitudeTime = now
+            self.__updated = True
+            return True
+        return False
+
+    def __updateOnGround(self, sbs1msg):
+        if sbs1msg["onGround"] is not None:
+            self.__updated |= self.__onGround != sbs1msg["onGround"]
+            self.__onGround = sbs1msg["onGround"]
+
+    def __updateSquawk(self, sbs1msg):
+        if sbs1msg["squawk"] is not None:
+            squawk = "%04d" % sbs1msg["squawk"]  # Octal digits, so keep the leading zeros
+            self.__updated |= self.__squawk != squawk
+            self.__squawk = squawk
+
+    def __updateSpeedAndTrack(self, sbs1msg):
+        if sbs1msg["groundSpeed"] is not None:
+            self.__updated |= self.__groundSpeed != sbs1msg["groundSpeed"]
+            self.__groundSpeed = sbs1msg["groundSpeed"]
+        if sbs1msg["track"] is not None:
+            self.__updated |= self.__track != sbs1msg["track"]
+            self.__track = sbs1msg["track"]
 
-            self.__distance = distance3d  
-            self.__bearing = utils.bearingFromCoordinate(cameraPosition=[camera_latitude, camera_longitude], airplanePosition=[self.__lat, self.__lon], heading=self.__track)
-            self.__elevation = utils.elevation(distance2d, cameraAltitude=camera_altitude, airplaneAltitude=self.__altitude) # Distance and Altitude are both in meters
+    def __hasPosition(self) -> bool:
+        return bool(self.__lat and self.__lon and self.__altitude and self.__track)
+
+    def __invalidateGeometry(self):
+        """Work out distance, bearing and elevation again the next time they are needed"""
+        if self.__hasPosition():
+            self.__geometryStale = True
+
+    __updates = {
+        1: __updateIdentity,
+        2: __updatePosition,
+        3: __updatePosition,
+        4: __updateVelocity,
+        5: __updateSurveillance,
+        6: __updateSurveillance,
+        7: __updateSurveillance,
+        8: __updateAllCall,
+    }
+
+    def __updateGeometry(self, config):
+        """Compute distance, bearing and elevation from the camera"""
+        # Calculates the distance from the cameras location to the airplane. The output is in METERS!
+        distance3d = utils.coordinate_distance_3d(config.camera_latitude, config.camera_longitude, config.camera_altitude, self.__lat, self.__lon, self.__altitude)
+        distance2d = utils.coordinate_distance(config.camera_latitude, config.camera_longitude,  self.__lat, self.__lon )
         
-        # Check if observation was updated
-        newData = dict(self.__dict__)
-        #del oldData["_Observation__loggedDate"]
-        #del newData["_Observation__loggedDate"]
-        d = DictDiffer(oldData, newData)
-        self.__updated = len(d.changed()) > 0
+
+        self.__distance = distance3d  
+        self.__bearing = utils.bearingFromCoordinate(cameraPosition=[config.camera_latitude, config.camera_longitude], airplanePosition=[self.__lat, self.__lon], heading=self.__track)
+        self.__azimuth = utils.cameraPanFromCoordinate(cameraPosition=[config.camera_latitude, config.camera_longitude], airplanePosition=[self.__lat, self.__lon])
+        self.__elevation = utils.elevation(distance2d, cameraAltitude=config.camera_altitude, airplaneAltitude=self.__altitude) # Distance and Altitude are both in meters
+        self.__geometryStale = False
+
+    def __refreshGeometry(self):
+        if self.__geometryStale:
+            self.__updateGeometry(config_store.get())
 
     def getIcao24(self) -> str:
         return self.__icao24
@@ -225,18 +319,33 @@ class Observation(object):
         return self.__updated
 
     def getElevation(self) -> int:
+        self.__refreshGeometry()
         return self.__elevation
 
     def getDistance(self) -> int:
+        self.__refreshGeometry()
         return self.__distance
 
-    def getLoggedDate(self) -> datetime:
+    def getAzimuth(self) -> float:
+        """True azimuth of the plane from the camera, unlike the bearing which is relative to its track"""
+        self.__refreshGeometry()
+        return self.__azimuth
+
+    def isInEnvelope(self) -> bool:
+        """Is the last position within the envelope of the current config, without computing any geometry"""
+        altitude = self.getAltitude()
+        if self.__lat is None or self.__lon is None or altitude is None:
+            # Heard from, but not located yet
+            return False
+        return envelope.forConfig(config_store.get()).contains(self.__lat, self.__lon, altitude)
+
+    def getLoggedDate(self) -> float:
         return self.__loggedDate
 
-    def getLatLonTime(self) -> datetime:
+    def getLatLonTime(self) -> float:
         return self.__latLonTime
     
-    def getAltitudeTime(self) -> datetime:
+    def getAltitudeTime(self) -> float:
         return self.__altitudeTime
 
     def getGroundSpeed(self) -> float:
@@ -248,9 +357,15 @@ class Observation(object):
     def getOnGround(self) -> bool:
         return self.__onGround
 
+    def getCallsign(self) -> str:
+        return self.__callsign
+
+    def getSquawk(self) -> str:
+        return self.__squawk
+
     def getAltitude(self) -> float:
         if self.getOnGround():
-            self.__altitude = camera_altitude
+            self.__altitude = config_store.get().camera_altitude
         return self.__altitude
 
     def getType(self) -> str:
@@ -275,6 +390,7 @@ class Observation(object):
         return self.__verticalRate
 
     def isPresentable(self) -> bool:
+        self.__refreshGeometry()
         return self.__altitude and self.__groundSpeed and self.__track and self.__lat and self.__lon and self.__distance
 
     def dump(self):
@@ -295,16 +411,19 @@ class Observation(object):
             str -- JSON string
         """
 
+        self.__refreshGeometry()
         if self.__callsign is None:
             callsign = "None"
         else:
             callsign = "\"%s\"" % self.__callsign
 
-        planeDict = {"verticalRate": self.__verticalRate, "time": time.time(), "lat": self.__lat, "lon": self.__lon,  "altitude": self.__altitude, "groundSpeed": self.__groundSpeed, "icao24": self.__icao24, "registration": self.__registration, "track": self.__track, "operator": self.__operator,   "loggedDate": self.__loggedDate, "type": self.__type, "latLonTime": self.__latLonTime, "altitudeTime": self.__altitudeTime, "manufacturer": self.__manufacturer, "model": self.__model, "callsign": callsign, "bearing": self.__bearing, "distance": self.__distance, "elevation": self.__elevation}
+        # Timestamps are kept as seconds since the epoch and only converted to wall-clock time here
+        planeDict = {"verticalRate": self.__verticalRate, "time": time.time(), "lat": self.__lat, "lon": self.__lon,  "altitude": self.__altitude, "groundSpeed": self.__groundSpeed, "icao24": self.__icao24, "registration": self.__registration, "track": self.__track, "operator": self.__operator,   "loggedDate": utils.epoch_to_utc(self.__loggedDate), "type": self.__type, "latLonTime": utils.epoch_to_utc(self.__latLonTime), "altitudeTime": utils.epoch_to_utc(self.__altitudeTime), "manufacturer": self.__manufacturer, "model": self.__model, "callsign": callsign, "bearing": self.__bearing, "azimuth": self.__azimuth, "distance": self.__distance, "elevation": self.__elevation}
         jsonString = json.dumps(planeDict, indent=4, sort_keys=True, default=str)
         return jsonString
 
     def dict(self):
+        self.__refreshGeometry()
         d =  dict(self.__dict__)
         if d["_Observation__verticalRate"] == None:
             d["verticalRate"] = 0
@@ -318,47 +437,222 @@ class Observation(object):
 
 
 
+def isTrackable(observation, count: bool = False) -> bool:
+    """ Does this observation meet all of the requirements to be tracked, see trackabilityRules() """
+    return trackabilityRules().rejection(observation, count) is None
+
+
+def areTrackable(observations: List[Any], count: bool = False) -> np.ndarray:
+    """ Which of the observations meet all of the requirements to be tracked, checked all at once """
+    return trackabilityRules().evaluate(observations, count)
+
+
+def trackabilityRules() -> rules.RuleSet:
+    """ The rules for the current config: the built-in limits, horizon, sun and any declared rules """
+    return rules.forConfig(config_store.get(), TRACKABILITY_CHECKS)
+
+
+def isBehindHorizon(observation, config) -> bool:
+    """ Is the plane hidden by terrain, trees or buildings, according to the horizon mask """
+    if horizon_mask is None:
+        return False
+    return observation.getElevation() < horizon_mask.minElevation(observation.getAzimuth(), config.camera_latitude, config.camera_longitude, config.camera_altitude)
+
+
+def predictPreposition(observations, now: float) -> Optional[Dict[str, Any]]:
+    """ Where and when the first of the planes that are not trackable yet will become trackable """
+    config = config_store.get()
+    observations = list(observations)
+    ruleset = trackabilityRules()
+    waiting = [o for (o, trackable) in zip(observations, ruleset.evaluate(observations)) if not trackable]
+    mask = horizon_mask.mask(config.camera_latitude, config.camera_longitude, config.camera_altitude) if horizon_mask else None
+    glare = sun_position.position(config.camera_latitude, config.camera_longitude, now) if config.sun_exclusion else None
+    # The declared rules are checked on the predicted positions, so an aircraft they reject is never waited for
+    return preposition.predict(waiting, config, now, horizon=mask, sun_position=glare, ruleset=ruleset)
+
+
+def isInSunGlare(observation, config) -> bool:
+    """ Would the camera be pointed into or close to the sun to photograph the plane """
+    return sun_position.isExcluded(observation.getAzimuth(), observation.getElevation(), config.camera_latitude, config.camera_longitude, time.time(), config.sun_exclusion)
+
+
+def horizonRule(config) -> Optional[rules.Rule]:
+    """ Trackability rule for the horizon mask, if there is one """
+    if horizon_mask is None:
+        return None
+    def vector(columns):
+        mask = horizon_mask.mask(config.camera_latitude, config.camera_longitude, config.camera_altitude)
+        bins = (np.nan_to_num(columns["azimuth"]) / horizon.AZIMUTH_STEP).astype(np.int64) % len(mask)
+        return columns["elevation"] >= mask[bins]
+    return rules.Check("Horizon", ("elevation", "azimuth"), lambda o: o.getElevation() is None or not isBehindHorizon(o, config), vector)
+
+
+def sunRule(config) -> Optional[rules.Rule]:
+    """ Trackability rule for the sun exclusion cone, if it is enabled """
+    if not config.sun_exclusion:
+        return None
+    def vector(columns):
+        (sun_azimuth, sun_elevation) = np.radians(sun_position.position(config.camera_latitude, config.camera_longitude, time.time()))
+        e = np.radians(columns["elevation"])
+        cos_separation = np.sin(e) * np.sin(sun_elevation) + np.cos(e) * np.cos(sun_elevation) * np.cos(np.radians(columns["azimuth"]) - sun_azimuth)
+        return cos_separation <= np.cos(np.radians(config.sun_exclusion))
+    return rules.Check("Sun", ("elevation", "azimuth"), lambda o: o.getElevation() is None or not isInSunGlare(o, config), vector)
+
+
+# Checks are made when the config changes, the horizon mask has to be loaded before the first one
+TRACKABILITY_CHECKS = [horizonRule, sunRule]
+
+
+class ShardWorker(object):
+    """
+    Owns the observations of the aircraft hashed to one shard, in a worker process.
+    The tracking decision is left to the coordinator, which gets the nearest
+    trackable aircraft of the shard in every report.
+    """
+    __observations: Dict[str, Observation] = {}
+    __next_clean: float = None
+    __config_version: int = None
+    __preposition: Dict[str, Any] = None
+    __next_preposition: float = 0.0
+    __next_rows: float = 0.0
+    __archive: archive.ArchiveWriter = None
+
+    def __init__(self, archive_dir: str = None):
+        """Set up the shard
+
+        Keyword Arguments:
+            archive_dir {str} -- Directory to archive the positions of the shard's aircraft in, None to not archive them (default: {None})
+        """
+        self.__observations = {}
+        self.__next_clean = time.time() + OBSERVATION_CLEAN_INTERVAL
+        self.__config_version = config_store.version()
+        self.__preposition = None
+        self.__next_preposition = 0.0
+        self.__next_rows = 0.0
+        self.__archive = archive.ArchiveWriter(archive_dir) if archive_dir else None
+
+    def configure(self, config: Dict[str, Any]):
+        """Apply a configuration snapshot sent by the coordinator
+
+        Arguments:
+            config {Dict[str, Any]} -- The coordinator's configuration snapshot
+        """
+        self.__config_version = config.pop("version")
+        config["rules"] = tuple(config.get("rules") or ())  # Comes back from JSON as a list
+        config_store.update(**config)
+
+    def processBatch(self, lines: List[str], now: float):
+        """Update the observations with a batch of SBS1 messages
+
+        Arguments:
+            lines {List[str]} -- SBS1 messages
+            now {float} -- Time the batch was received (seconds since the epoch)
+        """
+        if now > self.__next_clean:
+            for icao24 in [icao24 for icao24 in self.__observations if self.__observations[icao24].getLoggedDate() + OBSERVATION_CLEAN_INTERVAL < now]:
+                logging.info("%s\t[REMOVED]\t" % (icao24))
+                del self.__observations[icao24]
+            self.__next_clean = now + OBSERVATION_CLEAN_INTERVAL
+        aircraft_pinned = config_store.get().aircraft_pinned
+        for data in lines:
+            m = sbs1.parse(data)
+            if m:
+                icao24 = m["icao24"].lower()
+                if icao24 not in self.__observations:
+                    self.__observations[icao24] = Observation(m, now)
+                elif not self.__observations[icao24].update(m, now):
+                    continue
+                if self.__archive and m["lat"] is not None:
+                    self.__archive.append(self.__observations[icao24], now)
+                if not aircraft_pinned:
+                    # Counted for every message that can change what is tracked, as in-process
+                    isTrackable(self.__observations[icao24], count=True)
+
+    def close(self):
+        """Write out what is left to archive"""
+        if self.__archive:
+            self.__archive.close()
+
+    def __candidate(self, observation) -> Dict[str, Any]:
+        return {"icao24": observation.getIcao24(), "distance": observation.getDistance(), "elevation": observation.getElevation(), "json": observation.json(), "observation": observation.dict()}
+
+    def report(self) -> Dict[str, Any]:
+        """Summary of the shard for the coordinator
+
+        Returns:
+            Dict[str, Any] -- The configuration version the shard is working with, the
+                              nearest trackable aircraft, the pinned aircraft if the
+                              shard has seen it, the shard's predicted next plane, the
+                              shard's rule rejection counters and, once every
+                              SNAPSHOT_INTERVAL, the rows of all of its presentable
+                              aircraft for the dashboard and the plane topic
+        """
+        observations = list(self.__observations.values())
+        trackable = [o for (o, ok) in zip(observations, areTrackable(observations)) if ok]
+        nearest = heapq.nsmallest(SHARD_CANDIDATES, trackable, key=lambda o: o.getDistance())
+        aircraft_pinned = config_store.get().aircraft_pinned
+        pinned = self.__observations.get(aircraft_pinned) if aircraft_pinned else None
+        now = time.time()
+        if now > self.__next_preposition:
+            self.__preposition = predictPreposition(self.__observations.values(), now)
+            self.__next_preposition = now + PREPOSITION_INTERVAL
+        report = {
+            "version": self.__config_version,
+            "observations": len(self.__observations),
+            "candidates": [self.__candidate(o) for o in nearest],
+            "pinned": self.__candidate(pinned) if pinned else None,
+            "preposition": self.__preposition,
+            "rejections": rules.rejections(),
+        }
+        if now >= self.__next_rows:
+            # Only as often as the coordinator takes snapshots, the candidates are enough to track from
+            report[shard.ROWS] = [o.dict() for o in observations if o.isPresentable()]
+            self.__next_rows = now + SNAPSHOT_INTERVAL
+        return report
+
+
 def update_config(config):
     """ Adjust configuration values based on MQTT config messages that come in """
-    global camera_lead
-    global min_elevation
-    global min_distance
-    global min_altitude
-    global min_elevation
-    global max_altitude
-    global max_distance
-    global aircraft_pinned
-
+    changes = {}
 
     if "cameraLead" in config:
-        camera_lead = float(config["cameraLead"])
-        logging.info("Setting Camera Lead to: {}".format(camera_lead))
+        changes["camera_lead"] = float(config["cameraLead"])
+        logging.info("Setting Camera Lead to: {}".format(changes["camera_lead"]))
     if "minElevation" in config:
-        min_elevation = int(config["minElevation"])
-        logging.info("Setting Min. Elevation to: {}".format(min_elevation))
+        changes["min_elevation"] = int(config["minElevation"])
+        logging.info("Setting Min. Elevation to: {}".format(changes["min_elevation"]))
     if "minDistance" in config:
-        min_distance = int(config["minDistance"])
-        logging.info("Setting Min. Distance to: {}".format(min_distance))
+        changes["min_distance"] = int(config["minDistance"])
+        logging.info("Setting Min. Distance to: {}".format(changes["min_distance"]))
     if "minAltitude" in config:
-        min_altitude = int(config["minAltitude"])
-        logging.info("Setting Min. Altitude to: {}".format(min_altitude))
+        changes["min_altitude"] = int(config["minAltitude"])
+        logging.info("Setting Min. Altitude to: {}".format(changes["min_altitude"]))
     if "maxAltitude" in config:
-        max_altitude = int(config["maxAltitude"])
-        logging.info("Setting Max Altitude to: {}".format(max_altitude))                    
+        changes["max_altitude"] = int(config["maxAltitude"])
+        logging.info("Setting Max Altitude to: {}".format(changes["max_altitude"]))                    
     if "maxDistance" in config:
-        max_distance = int(config["maxDistance"])
-        logging.info("Setting Max Distance to: {}".format(min_elevation))
+        changes["max_distance"] = int(config["maxDistance"])
+        logging.info("Setting Max Distance to: {}".format(changes["max_distance"]))
+    if "sunExclusion" in config:
+        changes["sun_exclusion"] = float(config["sunExclusion"])
+        logging.info("Setting Sun Exclusion to: {}".format(changes["sun_exclusion"]))
     if "aircraftPinned" in config:
-        aircraft_pinned = config["aircraftPinned"].lower()
-        logging.info("Pinning Aircraft to: {}".format(aircraft_pinned))
+        changes["aircraft_pinned"] = config["aircraftPinned"].lower()
+        logging.info("Pinning Aircraft to: {}".format(changes["aircraft_pinned"]))
+    if "rules" in config:
+        try:
+            rules.parse(config["rules"] or [])
+            changes["rules"] = tuple(config["rules"] or ())
+            logging.info("Setting Rules to: {}".format(changes["rules"]))
+        except (TypeError, ValueError) as e:
+            logging.error("Ignoring rules: {}".format(e))
+
+    # Swap all of the changes in at once so readers never see half an update
+    config_store.update(**changes)
         
 def on_message(client, userdata, message):
     """ MQTT Client callback for new messages """
 
-    global camera_altitude
-    global camera_latitude
-    global camera_longitude
-
     command = str(message.payload.decode("utf-8"))
     # Assumes you will only be getting JSON on your subscribed messages
     try:
@@ -374,9 +668,7 @@ def on_message(client, userdata, message):
 
     if message.topic == "skyscan/egi":
         #logging.info(update)
-        camera_longitude = float(update["long"])
-        camera_latitude = float(update["lat"])
-        camera_altitude = float(update["alt"])
+        config_store.update(camera_longitude=float(update["long"]), camera_latitude=float(update["lat"]), camera_altitude=float(update["alt"]))
     elif message.topic == config_topic:
         update_config(update)
         logging.info("Config Message: {}".format(update))
@@ -392,13 +684,29 @@ class FlightTracker(object):
     __observations: Dict[str, str] = {}
     __tracking_icao24: str = None
     __tracking_distance: int = 999999999
-    __next_clean: datetime = None
+    __next_clean: float = None
     __has_nagged: bool = False
     __dump1090_host: str = ""
     __dump1090_port: int = 0
     __dump1090_sock: socket.socket = None
-
-    def __init__(self, dump1090_host: str, mqtt_broker: str, plane_topic: str, flight_topic: str, dump1090_port: int = 30003, mqtt_port: int = 1883, ):
+    __dump1090_partial: bytes = b""
+    __overload_threshold: int = OVERLOAD_THRESHOLD
+    __overloaded: bool = False
+    __overload_stats: Dict[str, Any] = {}
+    __ingest: ingest.IngestQueue = None
+    __shards: int = 0
+    __pool: shard.ShardPool = None
+    __forwarded_version: int = None
+    __shard_reports: List[Dict[str, Any]] = []
+    __tracking_json: str = None
+    __preposition_topic: str = None
+    __snapshot: dashboard.Snapshot = dashboard.Snapshot()
+    __next_snapshot: float = 0.0
+    __plane_snapshot_interval: float = airpicture.SNAPSHOT_INTERVAL
+    __archive_dir: str = None
+    __archive: archive.ArchiveWriter = None
+
+    def __init__(self, dump1090_host: str, mqtt_broker: str, plane_topic: str, flight_topic: str, dump1090_port: int = 30003, mqtt_port: int = 1883, overload_threshold: int = OVERLOAD_THRESHOLD, queue_size: int = INGEST_QUEUE_SIZE, drop_policy: str = ingest.DROP_OLDEST, shards: int = 0, preposition_topic: str = None, plane_snapshot_interval: float = airpicture.SNAPSHOT_INTERVAL, archive_dir: str = None):
         """Initialize the flight tracker
 
         Arguments:
@@ -406,32 +714,53 @@ class FlightTracker(object):
             mqtt_broker {str} -- Name or IP of dump1090 MQTT broker
             latitude {float} -- Latitude of receiver
             longitude {float} -- Longitude of receiver
-            plane_topic {str} -- MQTT topic for plane reports
+            plane_topic {str} -- MQTT topic for all the aircraft, None to not publish them
             flight_topic {str} -- MQTT topic for current tracking report
 
         Keyword Arguments:
             dump1090_port {int} -- Override the dump1090 raw port (default: {30003})
             mqtt_port {int} -- Override the MQTT default port (default: {1883})
+            overload_threshold {int} -- Coalesce batches with more messages than this (default: {1000})
+            queue_size {int} -- Messages buffered between the dump1090 reader and the processing (default: {50000})
+            drop_policy {str} -- What to do when that buffer is full (default: {"drop-oldest"})
+            shards {int} -- Number of worker processes sharing the observations, 0 to process them in this process (default: {0})
+            preposition_topic {str} -- MQTT topic for where the camera should wait for the next plane, None to not publish it (default: {None})
+            plane_snapshot_interval {float} -- Seconds between full snapshots of the aircraft on the plane topic, with deltas in between (default: {30.0})
+            archive_dir {str} -- Directory to archive every position heard in, see archive.py, None to not archive them (default: {None})
         """
         self.__dump1090_host = dump1090_host
         self.__dump1090_port = dump1090_port
         self.__mqtt_broker = mqtt_broker
         self.__mqtt_port = mqtt_port
-        self.__sock = None
+        self.__dump1090_partial = b""
         self.__observations = {}
-        self.__next_clean = datetime.utcnow() + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL)
+        self.__next_clean = time.time() + OBSERVATION_CLEAN_INTERVAL
         self.__plane_topic = plane_topic
         self.__flight_topic = flight_topic
+        self.__overload_threshold = overload_threshold
+        self.__overloaded = False
+        self.__overload_stats = {"batches": 0, "received": 0, "processed": 0, "dropped": {}}
+        self.__ingest = ingest.IngestQueue(queue_size, drop_policy)
+        self.__shards = shards
+        self.__shard_reports = []
+        self.__preposition_topic = preposition_topic
+        self.__snapshot = dashboard.Snapshot()
+        self.__next_snapshot = 0.0
+        self.__plane_snapshot_interval = plane_snapshot_interval
+        self.__archive_dir = archive_dir
+        # With shards, every worker archives the positions of its own aircraft
+        self.__archive = archive.ArchiveWriter(archive_dir) if archive_dir and not shards else None
 
     def __getObservationJson(self, observation):
-        (lat, lon, alt) = utils.calc_travel_3d(observation.getLat(), observation.getLon(), observation.getAltitude(), observation.getLatLonTime(), observation.getAltitudeTime(), observation.getGroundSpeed(), observation.getTrack(), observation.getVerticalRate(), camera_lead)
-        distance3d = utils.coordinate_distance_3d(camera_latitude, camera_longitude, camera_altitude, lat, lon, alt)
+        config = config_store.get()
+        (lat, lon, alt) = utils.calc_travel_3d(observation.getLat(), observation.getLon(), observation.getAltitude(), observation.getLatLonTime(), observation.getAltitudeTime(), observation.getGroundSpeed(), observation.getTrack(), observation.getVerticalRate(), config.camera_lead, time.time())
+        distance3d = utils.coordinate_distance_3d(config.camera_latitude, config.camera_longitude, config.camera_altitude, lat, lon, alt)
         #(latorig, lonorig) = utils.calc_travel(observation.getLat(), observation.getLon(), observation.getLatLonTime(),  observation.getGroundSpeed(), observation.getTrack(), camera_lead)
-        distance2d = utils.coordinate_distance(camera_latitude, camera_longitude, lat, lon)
-        bearing = utils.bearingFromCoordinate( cameraPosition=[camera_latitude, camera_longitude], airplanePosition=[lat, lon], heading=observation.getTrack())
-        elevation = utils.elevation(distance2d, cameraAltitude=camera_altitude, airplaneAltitude=alt) 
+        distance2d = utils.coordinate_distance(config.camera_latitude, config.camera_longitude, lat, lon)
+        bearing = utils.bearingFromCoordinate( cameraPosition=[config.camera_latitude, config.camera_longitude], airplanePosition=[lat, lon], heading=observation.getTrack())
+        elevation = utils.elevation(distance2d, cameraAltitude=config.camera_altitude, airplaneAltitude=alt) 
         cameraTilt = elevation
-        cameraPan = utils.cameraPanFromCoordinate(cameraPosition=[camera_latitude, camera_longitude], airplanePosition=[lat, lon])
+        cameraPan = utils.cameraPanFromCoordinate(cameraPosition=[config.camera_latitude, config.camera_longitude], airplanePosition=[lat, lon])
         #elevationorig = utils.elevation(distance2d, observation.getAltitude(), camera_altitude) 
         return observation.json()
 
@@ -453,18 +782,27 @@ class FlightTracker(object):
             if not self.__tracking_icao24:
                 retain = False
                 self.__client.publish(self.__flight_topic, notTrackingJson, 0, retain)
+                if self.__preposition_topic:
+                    # Tell the camera where to wait for the next plane
+                    upcoming = self.getPreposition(time.time())
+                    self.__client.publish(self.__preposition_topic, json.dumps(upcoming) if upcoming else notTrackingJson, 0, retain)
                 delay = 1
                 time.sleep(delay)
             else:
-                # Check to see if the currently tracked airplane is in the observations
-                if not self.__tracking_icao24 in self.__observations:
-                    self.__tracking_icao24 = None
-                    continue
-                cur = self.__observations[self.__tracking_icao24]
-                if cur is None:
-                    continue
+                if self.__pool:
+                    # The shard that owns the plane reported its JSON with it
+                    trackingJson = self.__tracking_json
+                else:
+                    # Check to see if the currently tracked airplane is in the observations
+                    if not self.__tracking_icao24 in self.__observations:
+                        self.__tracking_icao24 = None
+                        continue
+                    cur = self.__observations[self.__tracking_icao24]
+                    if cur is None:
+                        continue
+                    trackingJson = cur.json()
                 retain = False
-                self.__client.publish(self.__flight_topic, cur.json(), 0, retain)
+                self.__client.publish(self.__flight_topic, trackingJson, 0, retain)
                 
 
                 if self.__tracking_distance < 3000:
@@ -475,86 +813,34 @@ class FlightTracker(object):
                     delay = 1
                 time.sleep(delay)
 
+    def __planes_thread(self):
+        """
+        MQTT publish all the aircraft on the plane topic, from the dashboard snapshots so the observations are not touched
+        """
+        publisher = airpicture.PlanePublisher(lambda payload: self.__client.publish(self.__plane_topic, payload, 0, False), self.__plane_snapshot_interval)
+        version = None
+        while True:
+            snapshot = self.__snapshot
+            if snapshot.version != version and snapshot.time is not None:
+                publisher.update(snapshot.observations, snapshot.time)
+                version = snapshot.version
+            time.sleep(SNAPSHOT_INTERVAL)
+
     def __whyTrackable(self, observation) -> str:
         """ Returns a string explaining why a Plane can or cannot be tracked """
-
-        reason = ""
-
-        if observation.getAltitude() == None or observation.getGroundSpeed() == None or observation.getTrack() == None or observation.getLat() == None or observation.getLon() == None:
-            reason = "Loc: ⛔️" 
-        else:
-            reason = "Loc: ✅" 
-
-        if observation.getOnGround() == True:
-            reason = reason + "\tGrnd: ⛔️" 
-        else:
-            reason = reason + "\tGrnd: ✅" 
-        
-        if max_altitude != None and observation.getAltitude() > max_altitude:
-            reason = reason + "\tMax Alt: ⛔️" 
-        else:
-            reason = reason + "\tMax Alt: ✅" 
-
-        if min_altitude != None and observation.getAltitude() < min_altitude:
-            reason = reason + "\tMin Alt: ⛔️" 
-        else:
-            reason = reason + "\tMin Alt: ✅" 
-
-        if observation.getDistance() == None or observation.getElevation() == None:
-            return False
-
-        if min_distance != None and observation.getDistance() < min_distance:
-            reason = reason + "\tMin Dist: ⛔️" 
-        else:
-            reason = reason + "\tMin Dist: ✅" 
-
-        if max_distance != None and observation.getDistance() > max_distance:
-            reason = reason + "\tMax Dist: ⛔️" 
-        else:
-            reason = reason + "\tMax Dist: ✅" 
-        
-        if observation.getElevation() < min_elevation:
-            reason = reason + "\tMin Elv: ⛔️" 
-        else:
-            reason = reason + "\tMin Elv: ✅" 
-
-        return reason
+        return "\t".join("{}: {}".format(name, "✅" if met else "⛔️") for (name, met) in trackabilityRules().explain(observation))
 
     def __isTrackable(self, observation) -> bool:
-        """ Does this observation meet all of the requirements to be tracked """
-
-        if observation.getAltitude() == None or observation.getGroundSpeed() == None or observation.getTrack() == None or observation.getLat() == None or observation.getLon() == None:
-            return False 
-
-        if observation.getOnGround() == True:
-            return False
-        
-        if max_altitude != None and observation.getAltitude() > max_altitude:
-            return False
-
-        if min_altitude != None and observation.getAltitude() < min_altitude:
-            return False
-
-        if observation.getDistance() == None or observation.getElevation() == None:
-            return False
-
-        if min_distance != None and observation.getDistance() < min_distance:
-            return False
-
-        if max_distance != None and observation.getDistance() > max_distance:
-            return False
-        
-        if observation.getElevation() < min_elevation:
-            return False
-
-        return True
+        """ Does this observation meet all of the requirements to be tracked, counting the rule that rejected it if not """
+        return isTrackable(observation, count=True)
 
     def __updateTrackingDistance(self):
         """Update distance to aircraft being tracked
         """
         cur = self.__observations[self.__tracking_icao24]
         if cur.getAltitude():
-            self.__tracking_distance = utils.coordinate_distance_3d(camera_latitude, camera_longitude, camera_altitude, cur.getLat(), cur.getLon(), cur.getAltitude())
+            config = config_store.get()
+            self.__tracking_distance = utils.coordinate_distance_3d(config.camera_latitude, config.camera_longitude, config.camera_altitude, cur.getLat(), cur.getLon(), cur.getAltitude())
 
     def __observationKey(self,obs):
 
@@ -562,6 +848,11 @@ class FlightTracker(object):
 
 
     def getObservations(self):
+        if self.__pool:
+            # The rows each shard sends of all of its aircraft, or its candidates until it has
+            items = [row for r in self.__shard_reports if r for row in (r[shard.ROWS] if shard.ROWS in r else [c["observation"] for c in r["candidates"]])]
+            items.sort(key=self.__observationKey)
+            return items
         items=[]
         for icao24 in self.__observations:
             if self.__observations[icao24].isPresentable():
@@ -572,7 +863,51 @@ class FlightTracker(object):
     def getTracking(self):
         return self.__tracking_icao24
 
+    def getObservation(self, icao24: str):
+        """The observation of a plane, None if it is not known here (or the observations are sharded)"""
+        return self.__observations.get(icao24)
+
+    def getTrackableObservations(self) -> List[Observation]:
+        """The observations that pass the trackability rules now, empty if the observations are sharded"""
+        observations = list(self.__observations.values())
+        return [o for (o, trackable) in zip(observations, areTrackable(observations)) if trackable]
+
+    def __takeSnapshot(self, now: float):
+        """Hand the dashboard a copy of what it shows, made here so it never reads the observations while they change"""
+        self.__snapshot = dashboard.Snapshot(
+            version=self.__snapshot.version + 1,
+            time=now,
+            tracking=self.__tracking_icao24,
+            observations=tuple(dashboard.observationFields(o) for o in self.getObservations()),
+            config={k: dashboard.plain(v) for (k, v) in getConfig().items()},
+            overload=self.getOverloadStats(),
+            ingest=self.getIngestStats(),
+            rejections=self.getRejections())
+        self.__next_snapshot = now + SNAPSHOT_INTERVAL
+
+    def getSnapshot(self) -> dashboard.Snapshot:
+        """The latest snapshot for the dashboard, which is never changed once made"""
+        return self.__snapshot
+
+    def getPreposition(self, now: float) -> Optional[Dict[str, Any]]:
+        """Predict where and when the next plane will become trackable, while none is being tracked
+
+        Arguments:
+            now {float} -- Current time (seconds since the epoch)
+
+        Returns:
+            Optional[Dict[str, Any]] -- The plane and its entry point, None if tracking or nothing is coming
+        """
+        if self.__tracking_icao24:
+            return None
+        if self.__pool:
+            upcoming = [r["preposition"] for r in self.__shard_reports if r and r["preposition"]]
+            return min(upcoming, key=lambda p: p["time"]) if upcoming else None
+        return predictPreposition(list(self.__observations.values()), now)
+
     def getTrackingObservation(self):
+        if self.__pool:
+            return self.__tracking_json
         return self.__getObservationJson(self.__observations[self.__tracking_icao24])
 
 
@@ -587,6 +922,7 @@ class FlightTracker(object):
                 if not self.__has_nagged:
                     logging.info("Connecting to dump1090")
                 self.__dump1090_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.__dump1090_partial = b""
                 self.__dump1090_sock.connect((self.__dump1090_host, self.__dump1090_port))
                 logging.info("ADSB connected")
                 self.__dump1090_sock.settimeout(DUMP1090_SOCKET_TIMEOUT)
@@ -616,70 +952,260 @@ class FlightTracker(object):
         logging.critical("Closing dump1090 connection")
 
 
-    def dump1090Read(self) -> str:
-        """Read a line from the dump1090 host. If the host went down, close the socket and return None
+    def dump1090Read(self) -> List[str]:
+        """Read the SBS1 messages that are available from the dump1090 host. If the host went down, close the socket and return None
 
         Returns:
-            str -- An SBS1 message or None if disconnected or timeout
-
-        Yields:
-            str -- An SBS1 message or None if disconnected or timeout
+            List[str] -- The complete SBS1 messages received (empty on timeout) or None if disconnected
         """
         try:
-            try:
-                buffer = self.__dump1090_sock.recv(4096)
-            except ConnectionResetError:
-                logging.critical("Connection Reset Error")
-                self.dump1090Close()
-                return None
-            except socket.error:
-                logging.critical("Socket Error")
-                self.dump1090Close()
-                return None
-            buffer = buffer.decode("utf-8")
-            buffering = True
-            if buffer == "":
-                logging.critical("Buffer Empty")
-                self.dump1090Close()
-                return None
-            while buffering:
-                if "\n" in buffer:
-                    (line, buffer) = buffer.split("\r\n", 1)
-                    yield line
-                else:
-                    try:
-                        more = self.__dump1090_sock.recv(4096)
-                    except ConnectionResetError:
-                        logging.critical("Connection Reset Error")
-                        self.dump1090Close()
-                        return None
-                    except socket.error:
-                        logging.critical("Socket Error")
-                        self.dump1090Close()
-                        return None
-                    if not more:
-                        buffering = False
-                    else:
-                        if not isinstance(more, str):
-                            more = more.decode("utf-8")
-                        if more == "":
-                            logging.critical("Receive Empty")
-                            self.dump1090Close()
-                            return None
-                        buffer += more
-            if buffer:
-                yield buffer
+            buffer = self.__dump1090_sock.recv(DUMP1090_READ_SIZE)
         except socket.timeout:
+            return []
+        except ConnectionResetError:
+            logging.critical("Connection Reset Error")
+            self.dump1090Close()
             return None
+        except socket.error:
+            logging.critical("Socket Error")
+            self.dump1090Close()
+            return None
+        if not buffer:
+            logging.critical("Buffer Empty")
+            self.dump1090Close()
+            return None
+        # Drain whatever else is already waiting, so a backlog arrives as one batch
+        chunks = [buffer]
+        size = len(buffer)
+        while size < DUMP1090_MAX_BATCH_SIZE and select.select([self.__dump1090_sock], [], [], 0)[0]:
+            try:
+                more = self.__dump1090_sock.recv(DUMP1090_READ_SIZE)
+            except socket.error:
+                break
+            if not more:
+                break
+            chunks.append(more)
+            size += len(more)
+        buffer = b"".join(chunks)
+        # Messages are terminated by \r\n, the last piece is kept until the rest of it arrives
+        lines = (self.__dump1090_partial + buffer).split(b"\n")
+        self.__dump1090_partial = lines.pop()
+        return [line.decode("utf-8", errors="replace") for line in lines]
 
 
+    def processBatch(self, lines: List[str], now: float, received: List[float] = None):
+        """Process a batch of SBS1 messages that were received together
+
+        Arguments:
+            lines {List[str]} -- SBS1 messages
+            now {float} -- Time the batch is processed (seconds since the epoch)
+
+        Keyword Arguments:
+            received {List[float]} -- Time each message was received (seconds since the epoch), None if
+                                      they all were at `now` (default: {None})
+        """
+        if received is None:
+            received = [now] * len(lines)
+        if now >= self.__next_snapshot:
+            self.__takeSnapshot(now)
+        if len(lines) > self.__overload_threshold:
+            (lines, received) = self.__shedLoad(lines, received)
+        elif self.__overloaded:
+            self.__overloaded = False
+            logging.info("[OVERLOAD CLEARED]\tCoalesced {} batches, {} of {} messages dropped".format(self.__overload_stats["batches"], self.__overload_stats["received"] - self.__overload_stats["processed"], self.__overload_stats["received"]))
+        if self.__pool:
+            if config_store.version() != self.__forwarded_version:
+                config = config_store.get()
+                self.__pool.configure(config._asdict())
+                self.__forwarded_version = config.version
+            # The messages of each read from dump1090 go with the time they were received
+            start = 0
+            for end in range(1, len(lines) + 1):
+                if end == len(lines) or received[end] != received[start]:
+                    self.__pool.dispatch(lines[start:end], received[start])
+                    start = end
+            self.__selectFromShards()
+            return
+        self.cleanObservations(now)
+        for (data, time_received) in zip(lines, received):
+            m = sbs1.parse(data)
+            if m:
+                self.__processMessage(m, time_received)
+
+
+    def __shedLoad(self, lines: List[str], received: List[float]) -> Tuple[List[str], List[float]]:
+        """Reduce a backlog to the latest identity, position and velocity message of each aircraft
+
+        Arguments:
+            lines {List[str]} -- SBS1 messages
+            received {List[float]} -- Time each message was received
+
+        Returns:
+            Tuple[List[str], List[float]] -- The SBS1 messages to process, and the time each one was received
+        """
+        (indices, dropped) = sbs1.coalesceIndices(lines)
+        kept = [lines[i] for i in indices]
+        stats = self.__overload_stats
+        stats["batches"] += 1
+        stats["received"] += len(lines)
+        stats["processed"] += len(kept)
+        for transmissionType, count in dropped.items():
+            stats["dropped"][transmissionType] = stats["dropped"].get(transmissionType, 0) + count
+        if not self.__overloaded:
+            self.__overloaded = True
+            logging.info("[OVERLOAD]\tBacklog of {} messages, coalescing to {}".format(len(lines), len(kept)))
+        return (kept, [received[i] for i in indices])
+
+    def startShards(self):
+        """Fork the worker processes, if the tracker was created with shards"""
+        if self.__shards and not self.__pool:
+            self.__pool = shard.ShardPool(self.__shards, lambda: ShardWorker(self.__archive_dir))
+            self.__forwarded_version = None
+
+    def stopShards(self):
+        """Stop the worker processes"""
+        if self.__pool:
+            self.__pool.close()
+            self.__pool = None
+
+    def flushArchive(self):
+        """Write out the positions waiting to be archived, the shard workers do so when they are stopped"""
+        if self.__archive:
+            self.__archive.flush()
+
+    def drainShards(self, timeout: float) -> bool:
+        """Wait until the worker processes have processed every message, and track from their reports
+
+        Arguments:
+            timeout {float} -- Maximum number of seconds to wait
+
+        Returns:
+            bool -- False if the workers did not catch up in time
+        """
+        if not self.__pool:
+            return True
+        drained = self.__pool.drain(timeout)
+        self.__selectFromShards()
+        return drained
+
+    def __selectFromShards(self):
+        """Make the tracking decision from the latest reports of the shard workers
+        """
+        reports = self.__pool.reports()
+        self.__shard_reports = reports
+        aircraft_pinned = config_store.get().aircraft_pinned
+        if aircraft_pinned:
+            owner = reports[shard.shardOf(aircraft_pinned, self.__pool.shards())]
+            # Only trust a report made after the shard got the pin
+            if owner and owner["version"] == self.__forwarded_version:
+                if owner["pinned"]:
+                    if self.__tracking_icao24 != aircraft_pinned:
+                        logging.info("{}\t[PINNED AIRCRAFT TRACKING]\tDist: {}\tElev: {}\t\t".format(aircraft_pinned, owner["pinned"]["distance"], owner["pinned"]["elevation"]))
+                    self.__tracking_icao24 = aircraft_pinned
+                    self.__tracking_distance = owner["pinned"]["distance"] or 999999999
+                    self.__tracking_json = owner["pinned"]["json"]
+                    return
+                config_store.update(aircraft_pinned=None)
+                logging.info("%s\t[REMOVED PINNED AIRCRAFT - REVERTING TO NORMAL TRACKING]\t" % (aircraft_pinned))
+            else:
+                return
+
+        nearest = None
+        for report in reports:
+            if report and report["candidates"] and (nearest is None or report["candidates"][0]["distance"] < nearest["distance"]):
+                nearest = report["candidates"][0]
+        if nearest is None:
+            if self.__tracking_icao24:
+                logging.info("%s\t[NOT TRACKING]\t - Observation is no longer trackable" % (self.__tracking_icao24))
+            self.__tracking_icao24 = None
+            self.__tracking_distance = 999999999
+            self.__tracking_json = None
+            return
+        if nearest["icao24"] != self.__tracking_icao24:
+            logging.info("{}\t[TRACKING]\tDist: {}\tElev: {}\t\t".format(nearest["icao24"], int(nearest["distance"]), int(nearest["elevation"])))
+        self.__tracking_icao24 = nearest["icao24"]
+        self.__tracking_distance = nearest["distance"]
+        self.__tracking_json = nearest["json"]
+
+    def getOverloadStats(self) -> Dict[str, Any]:
+        """Counters for the messages dropped while coalescing backlogs
+
+        Returns:
+            Dict[str, Any] -- Batches coalesced, messages received and processed in those batches,
+                              and messages dropped for each transmission type
+        """
+        stats = dict(self.__overload_stats)
+        stats["dropped"] = dict(stats["dropped"])
+        stats["overloaded"] = self.__overloaded
+        return stats
+
+    def __processMessage(self, m, now: float):
+        """Update the observations with a parsed SBS1 message and decide which plane to track
+
+        Arguments:
+            m {dict} -- Parsed SBS1 message
+            now {float} -- Time the message was received (seconds since the epoch)
+        """
+        icao24 = m["icao24"].lower()
+
+        # Add or update the Observation for the plane
+        if icao24 not in self.__observations:
+            self.__observations[icao24] = Observation(m, now)
+        elif not self.__observations[icao24].update(m, now):
+            # Identity, altitude only and all call messages do not change what is tracked
+            return
+        if self.__archive and m["lat"] is not None:
+            self.__archive.append(self.__observations[icao24], now)
+        
+        aircraft_pinned = config_store.get().aircraft_pinned
+        if bool(aircraft_pinned) & (aircraft_pinned not in self.__observations):
+            config_store.update(aircraft_pinned=None)
+            aircraft_pinned = None
+
+        # if the pinned_aircraft variable is set and that the plane is the pinned aircraft    
+        if (bool(aircraft_pinned)) & (icao24 == aircraft_pinned):
+            if aircraft_pinned != self.__tracking_icao24:
+                self.__tracking_icao24 = icao24
+                self.__updateTrackingDistance()
+                logging.info("{}\t[PINNED AIRCRAFT TRACKING]\tDist: {}\tElev: {}\t\t".format(self.__tracking_icao24, self.__tracking_distance, self.__observations[icao24].getElevation()))
+            else:
+                self.__updateTrackingDistance()
+        
+        # if the plane is suitable to be tracked        
+        elif (not bool(aircraft_pinned)) & self.__isTrackable(self.__observations[icao24]):
+
+            # if no plane is being tracked, track this one
+            if not self.__tracking_icao24:
+                self.__tracking_icao24 = icao24
+                self.__updateTrackingDistance()
+                logging.info("{}\t[TRACKING]\tDist: {}\tElev: {}\t\t".format(self.__tracking_icao24, self.__tracking_distance, self.__observations[icao24].getElevation()))
+
+            # if this is the plane being tracked, update the tracking distance
+            elif self.__tracking_icao24 == icao24:
+                self.__updateTrackingDistance()
+            
+            # This plane is trackable, but is not the one being tracked
+            else:
+                distance = self.__observations[icao24].getDistance()
+                if distance < self.__tracking_distance:
+                    self.__tracking_icao24 = icao24
+                    self.__tracking_distance = distance
+                    logging.info("{}\t[TRACKING]\tDist: {}\tElev: {}\t\t - Switched to closer plane".format(self.__tracking_icao24, int(self.__tracking_distance), int(self.__observations[icao24].getElevation())))
+        else:
+            # If the plane is currently being tracked, but is no longer trackable:
+            if self.__tracking_icao24 == icao24:
+                logging.info("%s\t[NOT TRACKING]\t - Observation is no longer trackable" % (icao24))
+                logging.info(self.__whyTrackable(self.__observations[icao24]))
+                self.__tracking_icao24 = None
+                self.__tracking_distance = 999999999
 
 
     def run(self):
         """Run the flight tracker.
         """
-        global aircraft_pinned
-        print("connecting to MQTT broker at "+ self.__mqtt_broker +", subcribing on channel '"+ self.__plane_topic+"'publising on: " + self.__flight_topic)
+        self.startShards()
+
+        print("connecting to MQTT broker at "+ self.__mqtt_broker +", publising on: " + self.__flight_topic + " and " + str(self.__plane_topic))
         self.__client = mqtt.Client("skyscan-tracker-" + ID) #create new instance
 
         self.__client.on_message = on_message #attach function to callback
@@ -693,67 +1219,42 @@ class FlightTracker(object):
         self.__client.publish("skyscan/registration", "skyscan-tracker-"+ID+" Registration", 0, False)
         print("subscribe mqtt")
         threading.Thread(target = self.__publish_thread, daemon = True).start()
+        if self.__plane_topic:
+            threading.Thread(target = self.__planes_thread, daemon = True).start()
+
+        threading.Thread(target = self.__reader_thread, daemon = True).start()
+
+        # This loop takes the messages read from dump1090 and determines which plane to track.
+        # Everything queued since the last pass is one batch, so its size is the backlog.
+        while True:
+            (lines, received) = self.__ingest.get(INGEST_WAIT)
+            # Stamped with when they were read from dump1090, not when the backlog got to them
+            self.processBatch(lines, time.time(), received)
 
-        # This loop reads in new messages from dump1090 and determines which plane to track
+    def __reader_thread(self):
+        """
+        Move messages from the dump1090 socket into the ingest queue as fast as they arrive
+        """
         while True:
             if not self.dump1090Connect():
                 continue
-            for data in self.dump1090Read():
-                if data is None:
-                    continue
-                self.cleanObservations()
-                m = sbs1.parse(data)
-                if m:
-                    icao24 = m["icao24"].lower()
-
-                    # Add or update the Observation for the plane
-                    if icao24 not in self.__observations:
-                        self.__observations[icao24] = Observation(m)
-                    else:
-                        self.__observations[icao24].update(m)
-                    
-                    if bool(aircraft_pinned) & (aircraft_pinned not in self.__observations):
-                        aircraft_pinned = None
-
-                    # if the pinned_aircraft variable is set and that the plane is the pinned aircraft    
-                    if (bool(aircraft_pinned)) & (icao24 == aircraft_pinned):
-                        if aircraft_pinned != self.__tracking_icao24:
-                            self.__tracking_icao24 = icao24
-                            self.__updateTrackingDistance()
-                            logging.info("{}\t[PINNED AIRCRAFT TRACKING]\tDist: {}\tElev: {}\t\t".format(self.__tracking_icao24, self.__tracking_distance, self.__observations[icao24].getElevation()))
-                        else:
-                            self.__updateTrackingDistance()
-                    
-                    # if the plane is suitable to be tracked        
-                    elif (not bool(aircraft_pinned)) & self.__isTrackable(self.__observations[icao24]):
-
-                        # if no plane is being tracked, track this one
-                        if not self.__tracking_icao24:
-                            self.__tracking_icao24 = icao24
-                            self.__updateTrackingDistance()
-                            logging.info("{}\t[TRACKING]\tDist: {}\tElev: {}\t\t".format(self.__tracking_icao24, self.__tracking_distance, self.__observations[icao24].getElevation()))
-          
-                        # if this is the plane being tracked, update the tracking distance
-                        elif self.__tracking_icao24 == icao24:
-                            self.__updateTrackingDistance()
-                        
-                        # This plane is trackable, but is not the one being tracked
-                        else:
-                            distance = self.__observations[icao24].getDistance()
-                            if distance < self.__tracking_distance:
-                                self.__tracking_icao24 = icao24
-                                self.__tracking_distance = distance
-                                logging.info("{}\t[TRACKING]\tDist: {}\tElev: {}\t\t - Switched to closer plane".format(self.__tracking_icao24, int(self.__tracking_distance), int(self.__observations[icao24].getElevation())))
-                    else:
-                        # If the plane is currently being tracked, but is no longer trackable:
-                        if self.__tracking_icao24 == icao24:
-                            logging.info("%s\t[NOT TRACKING]\t - Observation is no longer trackable" % (icao24))
-                            logging.info(self.__whyTrackable(self.__observations[icao24]))
-                            self.__tracking_icao24 = None
-                            self.__tracking_distance = 999999999
-            
-            delay = 0.01                                     
-            time.sleep(delay)
+            lines = self.dump1090Read()
+            if lines:
+                self.__ingest.put(lines)
+
+    def getRejections(self) -> Dict[str, int]:
+        """How many times each trackability rule was the one that rejected an aircraft, over all shards"""
+        if not self.__pool:
+            return rules.rejections()
+        total = {}
+        for report in self.__shard_reports or []:
+            for (name, n) in (report or {}).get("rejections", {}).items():
+                total[name] = total.get(name, 0) + n
+        return total
+
+    def getIngestStats(self) -> Dict[str, Any]:
+        """Metrics of the queue between the dump1090 reader and the processing loop"""
+        return self.__ingest.stats()
 
     def selectNearestObservation(self):
         """Select nearest presentable aircraft
@@ -771,18 +1272,21 @@ class FlightTracker(object):
             logging.info("{}\t[TRACKING]\tDist: {}\t\t - Selected Nearest Observation".format(self.__tracking_icao24, self.__tracking_distance))
             
 
-    def cleanObservations(self):
-        global aircraft_pinned
+    def cleanObservations(self, now: float):
         """Clean observations for planes not seen in a while
+
+        Arguments:
+            now {float} -- Current time (seconds since the epoch)
         """
-        now = datetime.utcnow()
         if now > self.__next_clean:
+            aircraft_pinned = config_store.get().aircraft_pinned
             cleaned = []
             for icao24 in self.__observations:
-#                logging.info("[%s] %s -> %s : %s" % (icao24, self.__observations[icao24].getLoggedDate(), self.__observations[icao24].getLoggedDate() + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL), now))
-                if self.__observations[icao24].getLoggedDate() + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL) < now:
+#                logging.info("[%s] %s -> %s : %s" % (icao24, self.__observations[icao24].getLoggedDate(), self.__observations[icao24].getLoggedDate() + OBSERVATION_CLEAN_INTERVAL, now))
+                if self.__observations[icao24].getLoggedDate() + OBSERVATION_CLEAN_INTERVAL < now:
                     logging.info("%s\t[REMOVED]\t" % (icao24))
                     if icao24 == aircraft_pinned:
+                        config_store.update(aircraft_pinned=None)
                         aircraft_pinned = None
                         logging.info("%s\t[REMOVED PINNED AIRCRAFT - REVERTING TO NORMAL TRACKING]\t" % (icao24))
                     if icao24 == self.__tracking_icao24:
@@ -799,43 +1303,20 @@ class FlightTracker(object):
             if self.__tracking_icao24 is None:
                 self.selectNearestObservation()
 
-            self.__next_clean = now + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL)
+            self.__next_clean = now + OBSERVATION_CLEAN_INTERVAL
 
 
 def getConfig():
-    config ={}
-    config["camera_altitude"] = camera_altitude
-    config["camera_latitude"] = camera_latitude
-    config["camera_longitude"] = camera_longitude
-    config["camera_lead"] = camera_lead
-    config["min_elevation"] = min_elevation
-    config["min_distance"] = min_distance
-    config["max_distance"] = max_distance
-    config["min_altitude"] = min_altitude
-    config["max_altitude"] = max_altitude
-    config["aircraft_pinned"] = aircraft_pinned
-    return config
-
-
-
-
-@app.route('/')
-def index():
-    return render_template('index.html', title='SkyScan', tracking=tracker.getTracking(), observations=tracker.getObservations(), config=getConfig())
-
+    return config_store.get()._asdict()
 
 
 def main():
     global args
     global logging
-    global camera_altitude
-    global camera_latitude
-    global camera_longitude
-    global camera_lead
     global plane_topic
-    global min_elevation
     global planes
     global tracker
+    global horizon_mask
     parser = argparse.ArgumentParser(description='A Dump 1090 to MQTT bridge')
 
 
@@ -844,25 +1325,33 @@ def main():
     parser.add_argument('-a', '--alt', type=float, help="altitude of camera in METERS!", default=0)
     parser.add_argument('-c', '--camera-lead', type=float, help="how many seconds ahead of a plane's predicted location should the camera be positioned", default=0.25)
     parser.add_argument('-M', '--min-elevation', type=int, help="minimum elevation for camera", default=0)
+    parser.add_argument('--sun-exclusion', type=float, help="never track planes within this many degrees of the sun, 0 to disable (default %g)" % sun.SUN_EXCLUSION, default=sun.SUN_EXCLUSION)
     parser.add_argument('-m', '--mqtt-host', help="MQTT broker hostname", default='127.0.0.1')
     parser.add_argument('-p', '--mqtt-port', type=int, help="MQTT broker port number (default 1883)", default=1883)
-    parser.add_argument('-P', '--plane-topic', dest='plane_topic', help="MQTT plane topic", default="skyscan/planes/json")
+    parser.add_argument('-P', '--plane-topic', dest='plane_topic', help="MQTT topic for all the aircraft, empty to disable", default="skyscan/planes/json")
+    parser.add_argument('--plane-snapshot-interval', type=float, help="seconds between full snapshots on the plane topic, with deltas in between (default %g)" % airpicture.SNAPSHOT_INTERVAL, default=airpicture.SNAPSHOT_INTERVAL)
     parser.add_argument('-T', '--flight-topic', dest='flight_topic', help="MQTT flight tracking topic", default="skyscan/flight/json")
+    parser.add_argument('--preposition-topic', help="MQTT topic for where the camera should wait for the next plane, empty to disable", default="skyscan/preposition/json")
     parser.add_argument('-v', '--verbose',  action="store_true", help="Verbose output")
     parser.add_argument('-H', '--dump1090-host', help="dump1090 hostname", default='127.0.0.1')
     parser.add_argument('--dump1090-port', type=int, help="dump1090 port number (default 30003)", default=30003)
+    parser.add_argument('--queue-size', type=int, help="messages buffered between the dump1090 reader and the processing (default %d)" % INGEST_QUEUE_SIZE, default=INGEST_QUEUE_SIZE)
+    parser.add_argument('--drop-policy', choices=ingest.DROP_POLICIES, help="what to do with new messages when that buffer is full (default %s)" % ingest.DROP_OLDEST, default=ingest.DROP_OLDEST)
+    parser.add_argument('--horizon', help="horizon profile (azimuth elevation per line) or elevation grid (.asc, .tif) of obstructions around the camera")
+    parser.add_argument('--horizon-cache', help="directory to cache horizon masks built from grids in (default /data)", default="/data")
+    parser.add_argument('--rules', help="JSON file with a list of extra trackability rules, see rules.py")
+    parser.add_argument('--shards', type=int, help="worker processes sharing the observations by icao24, 0 to process them in one process (default 0)", default=0)
+    parser.add_argument('--archive', help="directory to archive every position heard in, to query with archive.py")
+    parser.add_argument('--dashboard-port', type=int, help="port of the dashboard and JSON API (default 5000)", default=5000)
+    parser.add_argument('--overload-threshold', type=int, help="coalesce to the latest messages of each aircraft when more than this many messages are waiting to be processed (default %d)" % OVERLOAD_THRESHOLD, default=OVERLOAD_THRESHOLD)
  
     args = parser.parse_args()
 
     if not args.lat and not args.lon:
         logging.critical("You really need to tell me where you are located (--lat and --lon)")
         sys.exit(1)
-    camera_longitude = args.lon
-    camera_latitude = args.lat
-    camera_altitude = args.alt # Altitude is in METERS
     plane_topic = args.plane_topic
-    camera_lead = args.camera_lead
-    min_elevation = args.min_elevation
+    config_store.update(camera_longitude=args.lon, camera_latitude=args.lat, camera_altitude=args.alt, camera_lead=args.camera_lead, min_elevation=args.min_elevation, sun_exclusion=args.sun_exclusion) # Altitude is in METERS
     level = logging.DEBUG if args.verbose else logging.INFO
 
     styles = {'critical': {'bold': True, 'color': 'red'}, 'debug': {'color': 'green'}, 'error': {'color': 'red'}, 'info': {'color': 'white'}, 'notice': {'color': 'magenta'}, 'spam': {'color': 'green', 'faint': True}, 'success': {'bold': True, 'color': 'green'}, 'verbose': {'color': 'blue'}, 'warning': {'color': 'yellow'}}
@@ -881,11 +1370,27 @@ def main():
                                 '%(message)s')
 
     logging.info("---[ Starting %s ]---------------------------------------------" % sys.argv[0])
+    if args.rules:
+        with open(args.rules) as f:
+            declared = json.load(f)
+        rules.parse(declared)  # Fail now on a rule that is not understood
+        config_store.update(rules=tuple(declared))
+    if args.horizon:
+        horizon_mask = horizon.HorizonMask(args.horizon, args.horizon_cache)
+        horizon_mask.mask(args.lat, args.lon, args.alt)  # Build it now rather than on the first plane
     planes = pd.read_csv("/data/aircraftDatabase.csv") #,index_col='icao24')
     logging.info("Printing table")
     logging.info(planes)
-    threading.Thread(target=app.run, kwargs={"host": '0.0.0.0', "port": 5000}).start()
-    tracker = FlightTracker(args.dump1090_host, args.mqtt_host, args.plane_topic, args.flight_topic,dump1090_port = args.dump1090_port,  mqtt_port = args.mqtt_port)
+    tracker = FlightTracker(args.dump1090_host, args.mqtt_host, args.plane_topic or None, args.flight_topic,dump1090_port = args.dump1090_port,  mqtt_port = args.mqtt_port, overload_threshold = args.overload_threshold, queue_size = args.queue_size, drop_policy = args.drop_policy, shards = args.shards, preposition_topic = args.preposition_topic or None, plane_snapshot_interval = args.plane_snapshot_interval, archive_dir = args.archive)
+    tracker.startShards()  # Fork the workers before any other threads are running
+    dashboard.serve(dashboard.Dashboard(tracker.getSnapshot), port=args.dashboard_port)
+
+    def stop(signum, frame):
+        # Keep the positions waiting to be archived when the container is stopped
+        tracker.stopShards()
+        tracker.flushArchive()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
 
 
     tracker.run()  # Never returns
@@ -0,0 +1,324 @@
+"""
+Horizon mask: the lowest visible elevation for every azimuth around the camera
+
+`min_elevation` is the same in every direction, but trees and buildings hide
+aircraft up to different elevations depending on where they are. The mask is
+an array with the minimum elevation for every 0.1 degree of azimuth, so a
+trackability check is a single lookup.
+
+The mask is built from one of:
+  - a profile file: lines of "azimuth elevation" in degrees, drawn by hand or
+    measured with a clinometer, interpolated between the given points
+  - an ESRI ASCII grid (.asc) or, if rasterio is installed, a GeoTIFF, with
+    heights in meters above sea level on a latitude/longitude grid. A surface
+    model (with trees and buildings) works better than a bare earth model.
+
+Grids are ray marched from the camera position, all azimuths and ranges at
+once, and the result is cached to disk keyed by the camera position and the
+grid file. It is only computed again when the camera moves further than GPS
+jitter, in the background while the old mask is still used, and the cached
+mask for the old position is then removed.
+"""
+
+from typing import *
+import hashlib
+import logging
+import math
+import glob
+import os
+import threading
+import numpy as np
+
+try:
+    import rasterio
+except ImportError:
+    rasterio = None
+
+AZIMUTH_STEP = 0.1  # [deg]
+BINS = int(round(360 / AZIMUTH_STEP))
+EARTH_RADIUS = 6371000.0  # [m]
+# How far out obstructions are looked for
+MAX_RANGE = 10000.0  # [m]
+# Range of the first ray marching step, closer cells are mostly the camera mount itself
+MIN_RANGE = 10.0  # [m]
+
+# Distance the camera has to move from where the mask was built before it
+# is built again, so GPS jitter is ignored
+MOVE_THRESHOLD = 5.0  # [m]
+
+GRID_SUFFIXES = (".asc", ".tif", ".tiff")
+
+
+def loadProfile(path: str) -> np.ndarray:
+    """Read a horizon profile of "azimuth elevation" pairs
+
+    Values can be separated by whitespace or commas, and lines starting with #
+    are comments. Azimuths between the given points are linearly interpolated,
+    wrapping around north.
+
+    Arguments:
+        path {str} -- Profile file
+
+    Returns:
+        np.ndarray -- Minimum elevation for each azimuth bin
+    """
+    points = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].replace(",", " ").split()
+            if line:
+                points.append((float(line[0]) % 360, float(line[1])))
+    if not points:
+        raise ValueError("No azimuth/elevation points in %s" % path)
+    points.sort()
+    azimuths = np.array([a for (a, _) in points])
+    elevations = np.array([e for (_, e) in points])
+    return np.interp(np.arange(BINS) * AZIMUTH_STEP, azimuths, elevations, period=360)
+
+
+def loadAsciiGrid(path: str) -> Tuple[np.ndarray, float, float, float, float]:
+    """Read an ESRI ASCII grid with latitude/longitude cells
+
+    Arguments:
+        path {str} -- Grid file
+
+    Returns:
+        Tuple[np.ndarray, float, float, float, float] -- Heights (row 0 is the northern edge,
+            missing cells are NaN), latitude and longitude of the north-west corner, and the
+            cell size in latitude and longitude
+    """
+    header = {}
+    with open(path) as f:
+        while True:
+            pos = f.tell()
+            line = f.readline().split()
+            if not line or not line[0][0].isalpha():
+                f.seek(pos)
+                break
+            header[line[0].lower()] = float(line[1])
+        heights = np.loadtxt(f, dtype=np.float64, ndmin=2)
+    (rows, cols) = (int(header["nrows"]), int(header["ncols"]))
+    if heights.shape != (rows, cols):
+        raise ValueError("%s: expected %dx%d cells, found %dx%d" % (path, rows, cols, heights.shape[0], heights.shape[1]))
+    cellsize = header["cellsize"]
+    # Corner registration gives the outer edge of the cells, center registration the middle
+    west = header["xllcorner"] if "xllcorner" in header else header["xllcenter"] - cellsize / 2
+    south = header["yllcorner"] if "yllcorner" in header else header["yllcenter"] - cellsize / 2
+    if "nodata_value" in header:
+        heights[heights == header["nodata_value"]] = np.nan
+    return (heights, south + rows * cellsize, west, cellsize, cellsize)
+
+
+def loadGeoTiff(path: str) -> Tuple[np.ndarray, float, float, float, float]:
+    """Read a single band GeoTIFF with latitude/longitude cells, see loadAsciiGrid()"""
+    if rasterio is None:
+        raise ImportError("Reading GeoTIFF needs rasterio (pip install rasterio), or convert %s to an ESRI ASCII grid" % path)
+    with rasterio.open(path) as src:
+        heights = src.read(1).astype(np.float64)
+        if src.nodata is not None:
+            heights[heights == src.nodata] = np.nan
+        t = src.transform
+        return (heights, t.f, t.c, -t.e, t.a)
+
+
+def rayMarch(grid: Tuple[np.ndarray, float, float, float, float], lat: float, lon: float, alt: float, max_range: float = MAX_RANGE) -> np.ndarray:
+    """Find the highest elevation of the terrain in every azimuth bin
+
+    Every azimuth is sampled at ranges spaced about one cell apart, out to
+    `max_range` or the edge of the grid. The drop of the terrain due to the
+    curvature of the earth is included.
+
+    Arguments:
+        grid {Tuple} -- Heights and georeferencing, as returned by loadAsciiGrid()
+        lat {float} -- Latitude of the camera
+        lon {float} -- Longitude of the camera
+        alt {float} -- Altitude of the camera in meters above sea level
+
+    Keyword Arguments:
+        max_range {float} -- Distance in meters to look for obstructions (default: {MAX_RANGE})
+
+    Returns:
+        np.ndarray -- Minimum elevation for each azimuth bin, -90 where nothing is in the way
+    """
+    (heights, north, west, dlat, dlon) = grid
+    meters_per_lat = EARTH_RADIUS * math.pi / 180
+    meters_per_lon = meters_per_lat * math.cos(math.radians(lat))
+    step = max(min(dlat * meters_per_lat, dlon * meters_per_lon), 1.0)
+    ranges = np.arange(MIN_RANGE, max_range + step, step)
+    azimuths = np.radians(np.arange(BINS) * AZIMUTH_STEP)
+
+    # Local flat earth around the camera, every row is one azimuth
+    sample_lat = lat + np.outer(np.cos(azimuths), ranges) / meters_per_lat
+    sample_lon = lon + np.outer(np.sin(azimuths), ranges) / meters_per_lon
+    row = np.floor((north - sample_lat) / dlat).astype(np.int64)
+    col = np.floor((sample_lon - west) / dlon).astype(np.int64)
+    inside = (row >= 0) & (row < heights.shape[0]) & (col >= 0) & (col < heights.shape[1])
+    terrain = np.full(row.shape, np.nan)
+    terrain[inside] = heights[row[inside], col[inside]]
+
+    rise = terrain - alt - ranges ** 2 / (2 * EARTH_RADIUS)
+    with np.errstate(invalid="ignore"):
+        angles = np.degrees(np.arctan2(rise, ranges))
+    angles[np.isnan(angles)] = -90.0
+    return angles.max(axis=1)
+
+
+def distance(a: Tuple[float, float, float], b: Tuple[float, float, float]) -> float:
+    """Distance in meters between two nearby positions
+
+    Arguments:
+        a {Tuple[float, float, float]} -- Latitude, longitude and altitude in meters
+        b {Tuple[float, float, float]} -- Latitude, longitude and altitude in meters
+
+    Returns:
+        float -- Distance in meters, on a flat earth
+    """
+    meters_per_lat = EARTH_RADIUS * math.pi / 180
+    north = (b[0] - a[0]) * meters_per_lat
+    east = ((b[1] - a[1] + 180) % 360 - 180) * meters_per_lat * math.cos(math.radians(a[0]))
+    return math.sqrt(north ** 2 + east ** 2 + (b[2] - a[2]) ** 2)
+
+
+class HorizonMask(object):
+    """
+    Builds and caches the horizon mask for the current camera position
+    """
+    __source: str = None
+    __cache_dir: str = None
+    __max_range: float = MAX_RANGE
+    __move_threshold: float = MOVE_THRESHOLD
+    __position: Tuple = None
+    __mask: np.ndarray = None
+    __rebuild: threading.Thread = None
+
+    def __init__(self, source: str, cache_dir: str = None, max_range: float = MAX_RANGE, move_threshold: float = MOVE_THRESHOLD):
+        """Set up a horizon mask
+
+        Arguments:
+            source {str} -- Profile file, or grid file ending in .asc, .tif or .tiff
+
+        Keyword Arguments:
+            cache_dir {str} -- Directory to cache masks built from grids in, None to not cache them (default: {None})
+            max_range {float} -- Distance in meters to look for obstructions in grids (default: {MAX_RANGE})
+            move_threshold {float} -- Distance in meters the camera has to move before the mask is built again (default: {MOVE_THRESHOLD})
+        """
+        self.__source = source
+        self.__cache_dir = cache_dir
+        self.__max_range = max_range
+        self.__move_threshold = move_threshold
+        self.__lock = threading.Lock()
+        self.__position = None
+        self.__mask = None
+        self.__rebuild = None
+        if not self.isGrid():
+            self.__mask = loadProfile(source)
+
+    def isGrid(self) -> bool:
+        return self.__source.lower().endswith(GRID_SUFFIXES)
+
+    def __cachePrefix(self) -> str:
+        stat = os.stat(self.__source)
+        key = "%s|%d|%d|%.0f" % (os.path.abspath(self.__source), stat.st_size, stat.st_mtime, self.__max_range)
+        return os.path.join(self.__cache_dir, "horizon-%s-" % hashlib.sha1(key.encode()).hexdigest()[:8])
+
+    def __cachePath(self, lat: float, lon: float, alt: float) -> str:
+        key = "%.6f|%.6f|%.1f" % (lat, lon, alt)
+        return "%s%s.npy" % (self.__cachePrefix(), hashlib.sha1(key.encode()).hexdigest()[:8])
+
+    def __prune(self, path: str):
+        """Remove the masks cached for other positions of the camera with the same grid"""
+        for superseded in glob.glob(glob.escape(self.__cachePrefix()) + "*.npy"):
+            if superseded != path:
+                try:
+                    os.remove(superseded)
+                except OSError as e:
+                    logging.warning("[HORIZON]\tUnable to remove {}: {}".format(superseded, e))
+
+    def __build(self, lat: float, lon: float, alt: float) -> np.ndarray:
+        path = self.__cachePath(lat, lon, alt) if self.__cache_dir else None
+        if path and os.path.exists(path):
+            self.__prune(path)
+            return np.load(path)
+        if self.__source.lower().endswith(".asc"):
+            grid = loadAsciiGrid(self.__source)
+        else:
+            grid = loadGeoTiff(self.__source)
+        mask = rayMarch(grid, lat, lon, alt, self.__max_range)
+        logging.info("[HORIZON]\tBuilt mask from {} for {:.6f}, {:.6f}, {:.1f}m, highest {:.1f} deg at {:.1f} deg azimuth".format(self.__source, lat, lon, alt, mask.max(), mask.argmax() * AZIMUTH_STEP))
+        if path:
+            np.save(path, mask)
+            self.__prune(path)
+        return mask
+
+    def __rebuildMask(self, position: Tuple[float, float, float]):
+        """Build the mask for a new position, the old one is used until it is done"""
+        try:
+            mask = self.__build(*position)
+        except Exception as e:
+            # Keep the old mask rather than trying again on every check
+            logging.error("[HORIZON]\tUnable to build mask for {:.6f}, {:.6f}, {:.1f}m: {}".format(*position, e))
+            mask = self.__mask
+        with self.__lock:
+            self.__mask = mask
+            self.__position = position
+            self.__rebuild = None
+
+    def mask(self, lat: float, lon: float, alt: float) -> np.ndarray:
+        """The mask for a camera position
+
+        Built from a grid right away the first time. After that it is built
+        again only when the camera moves further than the move threshold, in
+        a background thread, and the old mask is returned until it is done.
+
+        Arguments:
+            lat {float} -- Latitude of the camera
+            lon {float} -- Longitude of the camera
+            alt {float} -- Altitude of the camera in meters
+
+        Returns:
+            np.ndarray -- Minimum elevation for each azimuth bin
+        """
+        if not self.isGrid():
+            return self.__mask
+        position = (lat, lon, alt)
+        if self.__mask is None:
+            with self.__lock:
+                if self.__mask is None:
+                    self.__mask = self.__build(lat, lon, alt)
+                    self.__position = position
+            return self.__mask
+        if distance(self.__position, position) > self.__move_threshold:
+            with self.__lock:
+                if self.__rebuild is None and distance(self.__position, position) > self.__move_threshold:
+                    self.__rebuild = threading.Thread(target=self.__rebuildMask, args=(position,), daemon=True)
+                    self.__rebuild.start()
+        return self.__mask
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for a mask being built in the background
+
+        Keyword Arguments:
+            timeout {float} -- Seconds to wait at most, None to wait until it is done (default: {None})
+
+        Returns:
+            bool -- True if no mask is being built any more
+        """
+        rebuild = self.__rebuild
+        if rebuild is not None:
+            rebuild.join(timeout)
+            return not rebuild.is_alive()
+        return True
+
+    def minElevation(self, azimuth: float, lat: float, lon: float, alt: float) -> float:
+        """The lowest visible elevation in a direction
+
+        Arguments:
+            azimuth {float} -- True azimuth from the camera in degrees
+            lat {float} -- Latitude of the camera
+            lon {float} -- Longitude of the camera
+            alt {float} -- Altitude of the camera in meters
+
+        Returns:
+            float -- Elevation in degrees
+        """
+        return self.mask(lat, lon, alt)[int(azimuth / AZIMUTH_STEP) % BINS]
@@ -0,0 +1,137 @@
+"""
+Bounded queue of SBS-1 messages between the dump1090 reader and the tracker
+
+The reader thread only moves bytes off the socket, so a slow processing step
+no longer back-pressures into the kernel socket buffer (which makes dump1090
+drop our connection). What happens when the queue is full is decided by the
+drop policy.
+"""
+
+from typing import *
+import collections
+import threading
+import time
+import sbs1
+
+DROP_OLDEST = "drop-oldest"
+DROP_NON_POSITION = "drop-non-position"
+BLOCK = "block"
+DROP_POLICIES = [DROP_OLDEST, DROP_NON_POSITION, BLOCK]
+
+# Weight of the newest batch in the moving average of the dwell time
+DWELL_SMOOTHING = 0.1
+
+POSITION_TYPES = (str(sbs1.ES_SURFACE_POS), str(sbs1.ES_AIRBORNE_POS))
+
+
+def isPosition(msg: str) -> bool:
+    """Is this SBS1 message a position report, without parsing it"""
+    parts = msg.split(',', 2)
+    return len(parts) > 1 and parts[1] in POSITION_TYPES
+
+
+class IngestQueue(object):
+    """
+    A ring buffer of SBS1 messages with the time each one was queued.
+
+    When full, `drop-oldest` discards the oldest queued message,
+    `drop-non-position` discards incoming messages that are not position
+    reports (a position report still replaces the oldest message), and
+    `block` makes the reader wait for room.
+    """
+    __capacity: int = 0
+    __policy: str = DROP_OLDEST
+
+    def __init__(self, capacity: int, policy: str = DROP_OLDEST):
+        """Initialize the queue
+
+        Arguments:
+            capacity {int} -- Maximum number of queued messages
+
+        Keyword Arguments:
+            policy {str} -- What to do when the queue is full (default: {"drop-oldest"})
+        """
+        if policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy: %s" % policy)
+        self.__capacity = capacity
+        self.__policy = policy
+        self.__entries = collections.deque()
+        self.__cond = threading.Condition()
+        self.__enqueued = 0
+        self.__dropped = 0
+        self.__high_water = 0
+        self.__dwell_avg = 0.0
+        self.__dwell_max = 0.0
+
+    def put(self, msgs: List[str]):
+        """Queue messages that were read together
+
+        Arguments:
+            msgs {List[str]} -- SBS1 messages
+        """
+        now = time.monotonic()
+        with self.__cond:
+            for msg in msgs:
+                if len(self.__entries) >= self.__capacity:
+                    if self.__policy == BLOCK:
+                        while len(self.__entries) >= self.__capacity:
+                            self.__cond.wait()
+                    elif self.__policy == DROP_NON_POSITION and not isPosition(msg):
+                        self.__dropped += 1
+                        continue
+                    else:
+                        self.__entries.popleft()
+                        self.__dropped += 1
+                self.__entries.append((now, msg))
+                self.__enqueued += 1
+            self.__high_water = max(self.__high_water, len(self.__entries))
+            self.__cond.notify_all()
+
+    def get(self, timeout: float) -> Tuple[List[str], List[float]]:
+        """Take every queued message, waiting if the queue is empty
+
+        Arguments:
+            timeout {float} -- Maximum number of seconds to wait
+
+        Returns:
+            Tuple[List[str], List[float]] -- SBS1 messages, oldest first (empty on timeout), and the time
+                                             each one was received (seconds since the epoch)
+        """
+        with self.__cond:
+            if not self.__entries:
+                self.__cond.wait(timeout)
+            entries = self.__entries
+            self.__entries = collections.deque()
+            self.__cond.notify_all()
+        if not entries:
+            return ([], [])
+        # The oldest message waited the longest
+        now = time.monotonic()
+        dwell = now - entries[0][0]
+        self.__dwell_avg += DWELL_SMOOTHING * (dwell - self.__dwell_avg)
+        self.__dwell_max = max(self.__dwell_max, dwell)
+        epoch = time.time() - now
+        return ([msg for (_, msg) in entries], [queued + epoch for (queued, _) in entries])
+
+    def depth(self) -> int:
+        """Number of messages waiting to be processed"""
+        return len(self.__entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue metrics
+
+        Returns:
+            Dict[str, Any] -- Current depth, capacity, high-water mark, messages
+                              queued and dropped, and the dwell time (seconds) of
+                              the oldest message of each batch, averaged and at most
+        """
+        return {
+            "policy": self.__policy,
+            "depth": len(self.__entries),
+            "capacity": self.__capacity,
+            "highWater": self.__high_water,
+            "enqueued": self.__enqueued,
+            "dropped": self.__dropped,
+            "dwellAvg": self.__dwell_avg,
+            "dwellMax": self.__dwell_max,
+        }
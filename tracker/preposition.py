@@ -0,0 +1,170 @@
+"""
+Predict where the next aircraft will become trackable
+
+While nothing is being tracked, the camera can be parked where the next
+aircraft is going to show up, instead of slewing there from wherever it last
+was once the aircraft passes the trackability checks. Every aircraft that
+is not trackable yet is flown forward in a straight line at its current
+speed, track and vertical rate, and the first moment it is within the
+distance, altitude, elevation, horizon and sun limits, and meets the
+trackability rules, is its entry point. The aircraft entering soonest wins.
+
+All aircraft and time steps are computed at once with numpy, on a local flat
+earth around the camera, which is good enough to point a camera a few tens
+of kilometers out.
+"""
+
+from typing import *
+import math
+import numpy as np
+import rules
+
+# How far ahead entries are predicted
+LOOKAHEAD = 120.0  # [s]
+# Time between predicted positions
+STEP = 1.0  # [s]
+METERS_PER_DEGREE = 6371000.0 * math.pi / 180
+# Fields that change as an aircraft is flown forward
+FLOWN = {"lat", "lon", "altitude", "distance", "elevation", "azimuth"}
+
+
+def fly(observations: List[Any], config, now: float, horizon: np.ndarray = None, sun_position: Tuple[float, float] = None,
+        ruleset: rules.RuleSet = None) -> Optional[Dict[str, Any]]:
+    """Fly the aircraft forward LOOKAHEAD seconds and check the trackability limits at every STEP
+
+    Arguments:
+        observations {List[Observation]} -- The aircraft
+        config {TrackerConfig} -- Configuration snapshot with the camera position and limits
+        now {float} -- Current time (seconds since the epoch)
+
+    Keyword Arguments:
+        horizon {np.ndarray} -- Horizon mask, minimum elevation per 0.1 degree of azimuth (default: {None})
+        sun_position {Tuple[float, float]} -- Azimuth and elevation of the sun, to keep clear of (default: {None})
+        ruleset {rules.RuleSet} -- Trackability rules to check at every step too (default: {None})
+
+    Returns:
+        Optional[Dict[str, Any]] -- "icao24" of the aircraft that could be flown, "steps" (seconds from now)
+                                    and arrays with a row per aircraft and a column per step of "ok" (within
+                                    the limits), "east", "north", "altitude", "azimuth", "elevation" and
+                                    "distance", or None if no aircraft could be flown
+    """
+    rows = []
+    flown = []
+    for o in observations:
+        state = (o.getLat(), o.getLon(), o.getAltitude(), o.getLatLonTime(), o.getGroundSpeed(), o.getTrack())
+        if o.getOnGround() or any(v is None for v in state):
+            continue
+        rows.append(state + (o.getVerticalRate() or 0.0,))
+        flown.append(o)
+    if not rows or config.camera_latitude is None or config.camera_longitude is None:
+        return None
+    (lat, lon, alt, fix_time, speed, track, climb) = (np.array(c, dtype=np.float64)[:, None] for c in zip(*rows))
+
+    steps = np.arange(0.0, LOOKAHEAD + STEP, STEP)[None, :]
+    elapsed = now - fix_time + steps
+    track = np.radians(track)
+    meters_per_lon = METERS_PER_DEGREE * math.cos(math.radians(config.camera_latitude))
+    east = (lon - config.camera_longitude) * meters_per_lon + speed * np.sin(track) * elapsed
+    north = (lat - config.camera_latitude) * METERS_PER_DEGREE + speed * np.cos(track) * elapsed
+    altitude = alt + climb * elapsed
+    up = altitude - (config.camera_altitude or 0)
+    distance2d = np.hypot(east, north)
+    distance3d = np.hypot(distance2d, up)
+    elevation = np.degrees(np.arctan2(up, distance2d))
+    azimuth = np.degrees(np.arctan2(east, north)) % 360
+
+    ok = elevation >= (config.min_elevation or 0)
+    if config.min_altitude is not None:
+        ok &= altitude >= config.min_altitude
+    if config.max_altitude is not None:
+        ok &= altitude <= config.max_altitude
+    if config.min_distance is not None:
+        ok &= distance3d >= config.min_distance
+    if config.max_distance is not None:
+        ok &= distance3d <= config.max_distance
+    if horizon is not None:
+        ok &= elevation >= horizon[(azimuth / (360.0 / len(horizon))).astype(np.int64) % len(horizon)]
+    if sun_position is not None and config.sun_exclusion:
+        (sun_azimuth, sun_elevation) = np.radians(sun_position)
+        e = np.radians(elevation)
+        cos_separation = np.sin(e) * math.sin(sun_elevation) + np.cos(e) * math.cos(sun_elevation) * np.cos(np.radians(azimuth) - sun_azimuth)
+        ok &= cos_separation < math.cos(math.radians(config.sun_exclusion))
+    if ruleset is not None:
+        ok &= meetsRules(ruleset, flown, {
+            "lat": config.camera_latitude + north / METERS_PER_DEGREE,
+            "lon": config.camera_longitude + east / meters_per_lon,
+            "altitude": altitude,
+            "distance": distance3d,
+            "elevation": elevation,
+            "azimuth": azimuth,
+        })
+
+    return {"icao24": [o.getIcao24() for o in flown], "steps": steps[0], "ok": ok, "east": east, "north": north, "altitude": altitude,
+            "azimuth": azimuth, "elevation": elevation, "distance": distance3d}
+
+
+def meetsRules(ruleset: rules.RuleSet, observations: List[Any], states: Dict[str, np.ndarray]) -> np.ndarray:
+    """Check the rules at every step, with the fields that change as the aircraft fly taken from the predicted states
+
+    Arguments:
+        ruleset {rules.RuleSet} -- Trackability rules
+        observations {List[Observation]} -- The aircraft flown
+        states {Dict[str, np.ndarray]} -- The fields in FLOWN, a row per aircraft and a column per step
+
+    Returns:
+        np.ndarray -- Which aircraft meet every rule at every step
+    """
+    # The envelope only rules out what the limits already do
+    checked = [rule for rule in ruleset.rules if "envelope" not in rule.fields]
+    fields = set(f for rule in checked for f in rule.fields)
+    shape = next(iter(states.values())).shape
+    columns = {field: np.repeat(column, shape[1]) for (field, column) in rules.columns(observations, fields - FLOWN).items()}
+    columns.update((field, states[field].ravel()) for field in fields & FLOWN)
+    met = np.ones(shape[0] * shape[1], dtype=bool)
+    for rule in checked:
+        met &= rule.vector(columns)
+    return met.reshape(shape)
+
+
+def predict(observations: List[Any], config, now: float, horizon: np.ndarray = None, sun_position: Tuple[float, float] = None,
+            ruleset: rules.RuleSet = None) -> Optional[Dict[str, Any]]:
+    """Find the aircraft that will enter the trackable envelope first
+
+    Arguments:
+        observations {List[Observation]} -- Aircraft that are not trackable now
+        config {TrackerConfig} -- Configuration snapshot with the camera position and limits
+        now {float} -- Current time (seconds since the epoch)
+
+    Keyword Arguments:
+        horizon {np.ndarray} -- Horizon mask, minimum elevation per 0.1 degree of azimuth (default: {None})
+        sun_position {Tuple[float, float]} -- Azimuth and elevation of the sun, to keep clear of (default: {None})
+        ruleset {rules.RuleSet} -- Trackability rules the aircraft has to meet too (default: {None})
+
+    Returns:
+        Optional[Dict[str, Any]] -- The aircraft, when (seconds since the epoch) and where
+                                    (lat, lon, altitude, azimuth, elevation, distance) it
+                                    becomes trackable, or None if nothing will within LOOKAHEAD
+    """
+    flown = fly(observations, config, now, horizon, sun_position, ruleset)
+    if flown is None:
+        return None
+    (ok, distance3d, steps) = (flown["ok"], flown["distance"], flown["steps"])
+    entering = ok.any(axis=1)
+    if not entering.any():
+        return None
+    first = ok.argmax(axis=1)
+    # Soonest entry, then the closest one
+    candidates = np.flatnonzero(entering)
+    best = candidates[np.lexsort((distance3d[candidates, first[candidates]], first[candidates]))[0]]
+    i = first[best]
+    meters_per_lon = METERS_PER_DEGREE * math.cos(math.radians(config.camera_latitude))
+    return {
+        "icao24": flown["icao24"][best],
+        "time": float(now + steps[i]),
+        "lat": float(config.camera_latitude + flown["north"][best, i] / METERS_PER_DEGREE),
+        "lon": float(config.camera_longitude + flown["east"][best, i] / meters_per_lon),
+        "altitude": float(flown["altitude"][best, i]),
+        "azimuth": float(flown["azimuth"][best, i]),
+        "elevation": float(flown["elevation"][best, i]),
+        "distance": float(distance3d[best, i]),
+    }
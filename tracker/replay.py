@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Replay recorded SBS-1 messages through the flight tracker as fast as possible
+
+The tracker's processing path (parsing, observation updates, cleaning and the
+tracking decision) is driven directly, without dump1090 or an MQTT broker, so
+changes to the hot path can be measured in messages per second. A recorded
+log (one SBS-1 line per row, as output by dump1090 on port 30003) can be
+replayed, or a synthetic air picture can be generated.
+
+With --dashboard-clients, the dashboard is served while the messages are
+replayed, and browsers polling it are simulated from another process, to
+measure the request latency and what serving it costs the processing.
+"""
+
+from typing import *
+import argparse
+import http.client
+import json
+import logging
+import math
+import multiprocessing
+import random
+import threading
+import time
+import pandas as pd
+import flighttracker
+import dashboard
+import sun
+
+# Columns of the aircraft database CSV, used to build an empty database when none is given
+AIRCRAFT_DB_COLUMNS = ['icao24', 'registration', 'manufacturericao', 'manufacturername', 'model', 'typecode', 'serialnumber', 'linenumber', 'icaoaircrafttype', 'operator', 'operatorcallsign', 'operatoricao', 'operatoriata', 'owner', 'testreg', 'registered', 'reguntil', 'status', 'built', 'firstflightdate', 'seatconfiguration', 'engines', 'modes', 'adsb', 'acars', 'notes', 'categoryDescription']
+
+# Approximate mix of transmission types heard by a dump1090 receiver
+SYNTHETIC_MESSAGE_MIX = [(1, 3), (3, 35), (4, 20), (5, 15), (6, 2), (7, 10), (8, 15)]
+
+# Seconds to wait for shard workers to process the last messages
+DRAIN_TIMEOUT = 600
+
+# Pan/tilt speed of the camera, to turn slew angles into time
+SLEW_RATE = 90.0  # [deg/s]
+
+# Pages a simulated dashboard client cycles through
+DASHBOARD_PATHS = ["/", "/api/observations?limit=100", "/api/observations?limit=50&offset=50&fields=icao24,callsign,distance,elevation"]
+# Seconds between requests of a simulated dashboard client, like a page that refreshes itself
+DASHBOARD_POLL = 0.5
+
+
+def synthetic_messages(lat: float, lon: float, aircraft: int, count: int, seed: int = 0, spread: float = 1.5) -> List[str]:
+    """Generate SBS-1 messages for aircraft flying straight lines around a location
+
+    Arguments:
+        lat {float} -- Latitude of the receiver
+        lon {float} -- Longitude of the receiver
+        aircraft {int} -- Number of aircraft in the air picture
+        count {int} -- Number of messages to generate
+
+    Keyword Arguments:
+        seed {int} -- Seed for the random generator (default: {0})
+        spread {float} -- Degrees of latitude and longitude around the receiver the aircraft start in (default: {1.5})
+
+    Returns:
+        List[str] -- SBS-1 messages
+    """
+    rng = random.Random(seed)
+    planes = []
+    for i in range(aircraft):
+        planes.append({
+            "icao24": "%06X" % rng.randint(0, 0xFFFFFF),
+            "callsign": "TST%d" % i,
+            "lat": lat + rng.uniform(-spread, spread),
+            "lon": lon + rng.uniform(-spread, spread),
+            "altitude": rng.randint(10, 400) * 100,
+            "groundSpeed": rng.randint(120, 480),
+            "track": rng.randint(0, 359),
+            "verticalRate": rng.choice([0, 0, 0, -1024, 1024]),
+        })
+    types = [t for (t, weight) in SYNTHETIC_MESSAGE_MIX for _ in range(weight)]
+    stamp = "2021/05/13,14:13:42.000,2021/05/13,14:13:42.000"
+    messages = []
+    for n in range(count):
+        p = planes[rng.randrange(aircraft)]
+        t = rng.choice(types)
+        if t == 3:
+            # Move the plane along its track by roughly one second of flight
+            d = p["groundSpeed"] * 0.514444 / 111320.0
+            p["lat"] += d * math.cos(math.radians(p["track"]))
+            p["lon"] += d * math.sin(math.radians(p["track"])) / math.cos(math.radians(p["lat"]))
+            if abs(p["lat"] - lat) > spread or abs(p["lon"] - lon) > spread:
+                # Keep the air picture busy, a plane that leaves comes back in from the edge, heading roughly inwards
+                bearing = rng.uniform(0, 360)
+                p["lat"] = lat + spread * math.cos(math.radians(bearing))
+                p["lon"] = lon + spread * math.sin(math.radians(bearing))
+                p["track"] = int(bearing + 180 + rng.uniform(-30, 30)) % 360
+            fields = ["", str(p["altitude"]), "", "", "%.5f" % p["lat"], "%.5f" % p["lon"], "", "", "0", "0", "0", "0"]
+        elif t == 4:
+            fields = ["", "", str(p["groundSpeed"]), str(p["track"]), "", "", str(p["verticalRate"]), "", "", "", "", "0"]
+        elif t == 1:
+            fields = [p["callsign"], "", "", "", "", "", "", "", "", "", "", ""]
+        elif t in (5, 7):
+            fields = ["", str(p["altitude"]), "", "", "", "", "", "", "0", "", "0", "0"]
+        elif t == 6:
+            fields = ["", str(p["altitude"]), "", "", "", "", "", "1200", "0", "0", "0", "0"]
+        else:
+            fields = ["", "", "", "", "", "", "", "", "", "", "", ""]
+        messages.append(",".join(["MSG", str(t), "111", "11111", p["icao24"], "111111", stamp] + fields))
+    return messages
+
+
+def replay(tracker: flighttracker.FlightTracker, messages: List[str], batch_size: int) -> float:
+    """Feed messages through the tracker in batches
+
+    Arguments:
+        tracker {FlightTracker} -- The tracker to drive
+        messages {List[str]} -- SBS-1 messages
+        batch_size {int} -- Number of messages handed to the tracker at once
+
+    Returns:
+        float -- Elapsed time in seconds, until any shard workers have caught up
+    """
+    start = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        tracker.processBatch(messages[i:i + batch_size], time.time())
+    if not tracker.drainShards(DRAIN_TIMEOUT):
+        logging.critical("Shard workers did not catch up within %d seconds" % DRAIN_TIMEOUT)
+    return time.perf_counter() - start
+
+
+def acquisition(tracker: flighttracker.FlightTracker, messages: List[str], batch_size: int, slew_rate: float, preposition_every: int) -> Dict[str, List[float]]:
+    """Measure how far the camera has to slew when the tracker picks up a plane
+
+    The camera is taken to point at the tracked plane while tracking and stay
+    where it was otherwise. With pre-slew it also moves to every pre-position
+    while idle. Each time tracking starts after an idle period, the angle
+    between the camera and the plane is a slew the camera has to make before
+    it can photograph anything.
+
+    Arguments:
+        tracker {FlightTracker} -- The tracker to drive
+        messages {List[str]} -- SBS-1 messages
+        batch_size {int} -- Number of messages handed to the tracker at once
+        slew_rate {float} -- Camera pan/tilt speed in degrees per second
+        preposition_every {int} -- Batches between pre-positions, as the tracker publishes them once a second
+
+    Returns:
+        Dict[str, List[float]] -- Slew angles on acquisition, without ("direct") and with ("preslew") pre-positioning
+    """
+    direct = (0.0, 0.0)
+    preslew = (0.0, 0.0)
+    slews = {"direct": [], "preslew": []}
+    tracking = None
+    for n, i in enumerate(range(0, len(messages), batch_size)):
+        now = time.time()
+        tracker.processBatch(messages[i:i + batch_size], now)
+        acquired = tracker.getTracking()
+        if acquired:
+            plane = json.loads(tracker.getTrackingObservation())
+            if plane["azimuth"] is None:
+                continue
+            target = (plane["azimuth"], plane["elevation"])
+            if not tracking:
+                slews["direct"].append(sun.separation(direct[0], direct[1], target[0], target[1]))
+                slews["preslew"].append(sun.separation(preslew[0], preslew[1], target[0], target[1]))
+            direct = preslew = target
+        elif n % preposition_every == 0:
+            upcoming = tracker.getPreposition(now)
+            if upcoming:
+                preslew = (upcoming["azimuth"], upcoming["elevation"])
+        tracking = acquired
+    return slews
+
+
+def dashboardClients(host: str, port: int, paths: List[str], clients: int, interval: float, stop, results):
+    """Simulate browsers polling the dashboard, until `stop` is set
+
+    Meant to be run in its own process, so the clients do not hold the
+    tracker's GIL. Every client keeps its connection open and accepts gzip.
+
+    Arguments:
+        host {str} -- Dashboard host
+        port {int} -- Dashboard port
+        paths {List[str]} -- Paths each client requests in turn
+        clients {int} -- Number of concurrent clients
+        interval {float} -- Seconds between the starts of a client's requests, 0 to request back to back
+        stop {multiprocessing.Event} -- Set to stop the clients
+        results {multiprocessing.Queue} -- Gets a dict of path to a list of latencies in seconds, and the number of failed requests
+    """
+    latencies = {path: [] for path in paths}
+    failures = [0]
+
+    def client(n: int):
+        connection = http.client.HTTPConnection(host, port, timeout=10)
+        i = n
+        while not stop.is_set():
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path, headers={"Accept-Encoding": "gzip"})
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    latencies[path].append(time.perf_counter() - start)
+                else:
+                    failures[0] += 1
+            except (OSError, http.client.HTTPException):
+                failures[0] += 1
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=10)
+            stop.wait(max(interval - (time.perf_counter() - start), 0))
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, failures[0]))
+
+
+def dashboardLoad(tracker: flighttracker.FlightTracker, messages: List[str], batch_size: int, repeat: int, port: int, clients: int, interval: float) -> Tuple[List[float], List[float], Dict[str, List[float]], int]:
+    """Replay the messages with the dashboard served, without and then with clients polling it
+
+    Arguments:
+        tracker {FlightTracker} -- The tracker to drive, its snapshots are served
+        messages {List[str]} -- SBS-1 messages
+        batch_size {int} -- Number of messages handed to the tracker at once
+        repeat {int} -- Number of replays with and without clients
+        port {int} -- Port to serve the dashboard on
+        clients {int} -- Number of concurrent clients
+        interval {float} -- Seconds between the requests of a client
+
+    Returns:
+        Tuple -- Messages per second of each replay without clients and with them, the request
+                 latencies in seconds by path, and the number of failed requests
+    """
+    server = dashboard.serve(dashboard.Dashboard(tracker.getSnapshot), host="127.0.0.1", port=port)
+    try:
+        while not server.started:
+            time.sleep(0.05)
+        idle = [len(messages) / replay(tracker, messages, batch_size) for _ in range(repeat)]
+        context = multiprocessing.get_context("spawn")
+        (stop, results) = (context.Event(), context.Queue())
+        process = context.Process(target=dashboardClients, args=("127.0.0.1", port, DASHBOARD_PATHS, clients, interval, stop, results))
+        process.start()
+        time.sleep(2)  # Let the clients get going
+        loaded = [len(messages) / replay(tracker, messages, batch_size) for _ in range(repeat)]
+        stop.set()
+        (latencies, failures) = results.get()
+        process.join()
+    finally:
+        server.should_exit = True
+    return (idle, loaded, latencies, failures)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The value below which p percent of the values are"""
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)] if values else float("nan")
+
+
+def profile(tracker: flighttracker.FlightTracker, messages: List[str]) -> Dict[int, Tuple[int, float]]:
+    """Time the processing of every message, by transmission type
+
+    Messages are handed to the tracker one at a time, so the timings include
+    parsing, the observation update and the tracking decision.
+
+    Arguments:
+        tracker {FlightTracker} -- The tracker to drive
+        messages {List[str]} -- SBS-1 messages
+
+    Returns:
+        Dict[int, Tuple[int, float]] -- Number of messages and total seconds, by transmission type
+    """
+    totals = {}
+    clock = time.perf_counter
+    for msg in messages:
+        parts = msg.split(',', 2)
+        transmissionType = int(parts[1]) if len(parts) > 2 and parts[1].isdigit() else 0
+        now = time.time()
+        start = clock()
+        tracker.processBatch([msg], now)
+        elapsed = clock() - start
+        (count, total) = totals.get(transmissionType, (0, 0.0))
+        totals[transmissionType] = (count + 1, total + elapsed)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay SBS-1 messages through the flight tracker')
+    parser.add_argument('log', nargs='?', help="File with one SBS-1 message per line, omit to generate a synthetic air picture")
+    parser.add_argument('-l', '--lat', type=float, help="Latitude of camera", default=38.9)
+    parser.add_argument('-L', '--lon', type=float, help="Longitude of camera", default=-77.0)
+    parser.add_argument('-a', '--alt', type=float, help="altitude of camera in METERS!", default=0)
+    parser.add_argument('-M', '--min-elevation', type=int, help="minimum elevation for camera", default=0)
+    parser.add_argument('-b', '--batch-size', type=int, help="messages per batch (default 50)", default=50)
+    parser.add_argument('-r', '--repeat', type=int, help="number of times to replay the messages (default 5)", default=5)
+    parser.add_argument('--aircraft', type=int, help="aircraft in the synthetic air picture (default 300)", default=300)
+    parser.add_argument('--spread', type=float, help="degrees around the camera the synthetic aircraft start in (default 1.5)", default=1.5)
+    parser.add_argument('--messages', type=int, help="messages in the synthetic air picture (default 200000)", default=200000)
+    parser.add_argument('--shards', type=int, help="worker processes sharing the observations, 0 for none (default 0)", default=0)
+    parser.add_argument('--profile', action="store_true", help="break the processing time down by transmission type, instead of throughput")
+    parser.add_argument('--acquisition', action="store_true", help="measure camera slews when tracking starts, with and without pre-slew, instead of throughput")
+    parser.add_argument('--max-distance', type=int, help="max distance to track planes at, in meters", default=None)
+    parser.add_argument('--slew-rate', type=float, help="camera pan/tilt speed in deg/s (default %g)" % SLEW_RATE, default=SLEW_RATE)
+    parser.add_argument('--dashboard-clients', type=int, help="serve the dashboard and measure its latency and cost with this many clients polling it, instead of throughput", default=0)
+    parser.add_argument('--dashboard-port', type=int, help="port to serve the dashboard on for --dashboard-clients (default 5055)", default=5055)
+    parser.add_argument('--poll-interval', type=float, help="seconds between requests of a dashboard client, 0 for back to back (default %g)" % DASHBOARD_POLL, default=DASHBOARD_POLL)
+    parser.add_argument('--aircraft-db', help="aircraft database CSV, omit to use an empty database")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    if args.aircraft_db:
+        flighttracker.planes = pd.read_csv(args.aircraft_db)
+    else:
+        flighttracker.planes = pd.DataFrame(columns=AIRCRAFT_DB_COLUMNS)
+    flighttracker.config_store.update(camera_latitude=args.lat, camera_longitude=args.lon, camera_altitude=args.alt, camera_lead=0.25, min_elevation=args.min_elevation, max_distance=args.max_distance)
+
+    if args.log:
+        with open(args.log) as f:
+            messages = [line for line in f.read().splitlines() if line]
+    else:
+        messages = synthetic_messages(args.lat, args.lon, args.aircraft, args.messages, spread=args.spread)
+
+    if args.profile:
+        tracker = flighttracker.FlightTracker("replay", "replay", "skyscan/planes/json", "skyscan/flight/json")
+        totals = profile(tracker, messages)
+        overall = sum(total for (_, total) in totals.values())
+        print("type  messages  total ms  us/msg  share")
+        for transmissionType in sorted(totals):
+            (count, total) = totals[transmissionType]
+            print("%4d  %8d  %8.1f  %6.1f  %4.1f%%" % (transmissionType, count, total * 1000, total / count * 1e6, 100 * total / overall))
+        return
+
+    if args.acquisition:
+        tracker = flighttracker.FlightTracker("replay", "replay", "skyscan/planes/json", "skyscan/flight/json")
+        lead = flighttracker.config_store.get().camera_lead
+        slews = acquisition(tracker, messages, args.batch_size, args.slew_rate, 10)
+        print("%d acquisitions, camera lead %gs, slew rate %g deg/s" % (len(slews["direct"]), lead, args.slew_rate))
+        for name in ("direct", "preslew"):
+            angles = sorted(slews[name]) or [0.0]
+            print("%-8s  slew mean: %5.1f deg  median: %5.1f deg  latency mean: %.2fs  median: %.2fs" % (name, sum(angles) / len(angles), angles[len(angles) // 2], sum(angles) / len(angles) / args.slew_rate + lead, angles[len(angles) // 2] / args.slew_rate + lead))
+        return
+
+    if args.dashboard_clients:
+        tracker = flighttracker.FlightTracker("replay", "replay", "skyscan/planes/json", "skyscan/flight/json")
+        (idle, loaded, latencies, failures) = dashboardLoad(tracker, messages, args.batch_size, args.repeat, args.dashboard_port, args.dashboard_clients, args.poll_interval)
+        (idle_rate, loaded_rate) = (sorted(idle)[len(idle) // 2], sorted(loaded)[len(loaded) // 2])
+        requests = sum(len(l) for l in latencies.values())
+        print("%d clients polling every %gs, %d requests, %d failed" % (args.dashboard_clients, args.poll_interval, requests, failures))
+        print("messages/s median  without clients: %.0f  with clients: %.0f  (%+.1f%%)" % (idle_rate, loaded_rate, 100 * (loaded_rate - idle_rate) / idle_rate))
+        for (path, values) in latencies.items():
+            print("%-80s  n: %5d  p50: %6.1fms  p95: %6.1fms  p99: %6.1fms" % (path, len(values), percentile(values, 50) * 1000, percentile(values, 95) * 1000, percentile(values, 99) * 1000))
+        return
+
+    rates = []
+    for _ in range(args.repeat):
+        tracker = flighttracker.FlightTracker("replay", "replay", "skyscan/planes/json", "skyscan/flight/json", shards=args.shards)
+        tracker.startShards()
+        try:
+            elapsed = replay(tracker, messages, args.batch_size)
+        finally:
+            tracker.stopShards()
+        rates.append(len(messages) / elapsed)
+    rates.sort()
+    print("%d messages x %d runs, batch size %d, %d shards" % (len(messages), args.repeat, args.batch_size, args.shards))
+    print("messages/s  best: %.0f  median: %.0f  worst: %.0f" % (rates[-1], rates[len(rates) // 2], rates[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,481 @@
+"""
+Declarative trackability rules
+
+Whether an aircraft can be tracked is decided by a list of rules. The
+built-in ones come from the tracker configuration (position known, not on
+the ground, altitude, distance and elevation limits), and more can be
+declared in a JSON file given with --rules or in the "rules" key of a
+message on skyscan/config/json, for example:
+
+    [{"field": "squawk", "deny": ["7500", "7600", "7700"]},
+     {"field": "operator", "allow": ["United Airlines", "Delta Air Lines"]},
+     {"field": "altitude", "min": 1000, "max": 12000},
+     {"name": "Airport", "geofence": [[38.93, -77.48], [38.97, -77.48], [38.97, -77.43]], "exclude": true}]
+
+A rule with "min" and/or "max" is a band, "allow" and "deny" compare the
+field as a case insensitive string against a list, and "geofence" is a
+polygon of [lat, lon] points the aircraft has to be inside, or outside with
+"exclude". Any rule can be given a "name" for the diagnostics.
+
+The rules are compiled once per configuration version into a RuleSet, with
+the cheap ones first and the ones needing distance or elevation last. For
+checking one observation, which happens for every position message, the rules
+are compiled into a single Python function that gets each field once and
+returns at the first rule not met. Many observations are checked at once by
+evaluating every rule over arrays of their fields with numpy. The rule that rejected an aircraft is counted, to see what is
+keeping aircraft from being tracked.
+"""
+
+from typing import *
+from operator import methodcaller
+import threading
+import numpy as np
+from config_store import TrackerConfig
+
+# Fields rules can look at, and the Observation getter for each
+FIELDS = {
+    "icao24": "getIcao24",
+    "callsign": "getCallsign",
+    "lat": "getLat",
+    "lon": "getLon",
+    "altitude": "getAltitude",
+    "groundSpeed": "getGroundSpeed",
+    "track": "getTrack",
+    "verticalRate": "getVerticalRate",
+    "onGround": "getOnGround",
+    "squawk": "getSquawk",
+    "distance": "getDistance",
+    "elevation": "getElevation",
+    "azimuth": "getAzimuth",
+    "operator": "getOperator",
+    "type": "getType",
+    "manufacturer": "getManufacturer",
+    "model": "getModel",
+    "registration": "getRegistration",
+    "envelope": "isInEnvelope",
+}
+NUMERIC = {"lat", "lon", "altitude", "groundSpeed", "track", "verticalRate", "distance", "elevation", "azimuth"}
+# Computed from the position, and only worth computing inside the envelope
+GEOMETRY = {"distance", "elevation", "azimuth"}
+LOCATION = ("altitude", "groundSpeed", "track", "lat", "lon")
+
+
+def _text(value) -> Optional[str]:
+    return None if value is None else str(value).strip().lower()
+
+
+def _local(field: str) -> str:
+    """Name of the variable holding a field in the compiled rules"""
+    return "f_" + field
+
+
+class Rule(object):
+    """
+    One constraint an aircraft has to meet to be tracked
+    """
+    name: str = None
+    fields: Tuple[str, ...] = ()
+    explain: bool = True  # Show up in the explanation of why an aircraft is not tracked
+    passes: Callable[[Any], bool] = None  # Does a single observation meet the rule
+
+    def expression(self, constant: Callable[[Any], str]) -> Optional[str]:
+        """Python expression for the rule over the variables named by _local() for its fields
+
+        Arguments:
+            constant {Callable[[Any], str]} -- Gives the name a value can be referred to by in the expression
+
+        Returns:
+            Optional[str] -- The expression, or None to call `passes` on the observation instead
+        """
+        return None
+
+    def tier(self) -> int:
+        """Order to check the rules in: plain fields, then the envelope, then geometry"""
+        if "envelope" in self.fields:
+            return 1
+        return 2 if GEOMETRY.intersection(self.fields) else 0
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        """Which of the observations in the columns meet the rule"""
+        raise NotImplementedError()
+
+
+class Required(Rule):
+    """The fields have to be known"""
+
+    def __init__(self, name: str, fields: Tuple[str, ...]):
+        self.name = name
+        self.fields = tuple(fields)
+        getters = [methodcaller(FIELDS[f]) for f in fields]
+
+        def passes(observation) -> bool:
+            for get in getters:
+                if get(observation) is None:
+                    return False
+            return True
+        self.passes = passes
+
+    def expression(self, constant: Callable[[Any], str]) -> Optional[str]:
+        return " and ".join("{} is not None".format(_local(f)) for f in self.fields)
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        return np.logical_and.reduce([~np.isnan(columns[f]) if f in NUMERIC else columns[f] != None for f in self.fields])  # noqa: E711
+
+
+class Band(Rule):
+    """The field has to be known and between `low` and `high`, where a bound of None is open"""
+
+    def __init__(self, name: str, field: str, low: float = None, high: float = None):
+        self.name = name
+        self.fields = (field,)
+        self.low = low
+        self.high = high
+        get = methodcaller(FIELDS[field])
+        low = float("-inf") if low is None else low
+        high = float("inf") if high is None else high
+
+        def passes(observation) -> bool:
+            value = get(observation)
+            return value is not None and low <= value <= high
+        self.passes = passes
+
+    def expression(self, constant: Callable[[Any], str]) -> Optional[str]:
+        value = _local(self.fields[0])
+        terms = ["{} is not None".format(value)]
+        if self.low is not None:
+            terms.append("{} <= {}".format(constant(self.low), value))
+        if self.high is not None:
+            terms.append("{} <= {}".format(value, constant(self.high)))
+        return " and ".join(terms)
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        values = columns[self.fields[0]]
+        ok = ~np.isnan(values)
+        if self.low is not None:
+            ok &= values >= self.low
+        if self.high is not None:
+            ok &= values <= self.high
+        return ok
+
+
+class NotSet(Rule):
+    """The field can be unknown or false, but not true, like being on the ground"""
+
+    def __init__(self, name: str, field: str):
+        self.name = name
+        self.fields = (field,)
+        get = methodcaller(FIELDS[field])
+        self.passes = lambda observation: get(observation) is not True
+
+    def expression(self, constant: Callable[[Any], str]) -> Optional[str]:
+        return "{} is not True".format(_local(self.fields[0]))
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        return columns[self.fields[0]] != True  # noqa: E712
+
+
+class Member(Rule):
+    """The field has to be one of the `allow` values, or must not be one of the `deny` values"""
+
+    def __init__(self, name: str, field: str, values: Iterable[Any], allow: bool):
+        self.name = name
+        self.fields = (field,)
+        self.values = frozenset(_text(v) for v in values)
+        self.allow = allow
+        get = methodcaller(FIELDS[field])
+        values = self.values
+        self.passes = lambda observation: (_text(get(observation)) in values) == allow
+
+    def expression(self, constant: Callable[[Any], str]) -> Optional[str]:
+        return "_text({}) {} {}".format(_local(self.fields[0]), "in" if self.allow else "not in", constant(self.values))
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        values = columns[self.fields[0]]
+        found = np.fromiter((_text(v) in self.values for v in values), dtype=bool, count=len(values))
+        return found if self.allow else ~found
+
+
+class Geofence(Rule):
+    """The aircraft has to be inside a polygon of [lat, lon] points, or outside it with `exclude`"""
+
+    def __init__(self, name: str, polygon: List[Tuple[float, float]], exclude: bool = False):
+        if len(polygon) < 3:
+            raise ValueError("A geofence needs at least 3 points")
+        self.name = name
+        self.fields = ("lat", "lon")
+        self.polygon = np.array(polygon, dtype=np.float64)
+        self.exclude = exclude
+        self.__edges = edges = [(float(a[0]), float(a[1]), float(b[0]), float(b[1])) for (a, b) in zip(self.polygon, np.roll(self.polygon, 1, axis=0)) if a[0] != b[0]]
+
+        def passes(observation) -> bool:
+            (lat, lon) = (observation.getLat(), observation.getLon())
+            if lat is None or lon is None:
+                return exclude
+            # Ray casting, counting the edges crossed going east from the point
+            inside = False
+            for (lat1, lon1, lat2, lon2) in edges:
+                if (lat1 > lat) != (lat2 > lat) and lon < (lon2 - lon1) * (lat - lat1) / (lat2 - lat1) + lon1:
+                    inside = not inside
+            return inside != exclude
+        self.passes = passes
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        (lat, lon) = (columns["lat"], columns["lon"])
+        inside = np.zeros(lat.shape, dtype=bool)
+        with np.errstate(invalid="ignore"):
+            for (lat1, lon1, lat2, lon2) in self.__edges:
+                inside ^= ((lat1 > lat) != (lat2 > lat)) & (lon < (lon2 - lon1) * (lat - lat1) / (lat2 - lat1) + lon1)
+        known = ~np.isnan(lat) & ~np.isnan(lon)
+        return np.where(known, inside != self.exclude, self.exclude)
+
+
+class Check(Rule):
+    """A rule given as a pair of functions, for checks that need more than the fields, like the horizon mask.
+    The functions get observations whose fields can be unknown."""
+
+    def __init__(self, name: str, fields: Tuple[str, ...], passes: Callable[[Any], bool], vector: Callable[[Dict[str, np.ndarray]], np.ndarray]):
+        self.name = name
+        self.fields = tuple(fields)
+        self.passes = passes
+        self.__vector = vector
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        known = np.logical_and.reduce([~np.isnan(columns[f]) for f in self.fields])
+        return known & self.__vector(columns)
+
+
+class Envelope(Rule):
+    """Prefilter that rules out most aircraft before any geometry is computed, see envelope.py"""
+    name = "Envelope"
+    fields = ("envelope",)
+    explain = False
+    passes = staticmethod(methodcaller("isInEnvelope"))
+
+    def vector(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        return columns["envelope"].astype(bool)
+
+
+def parse(declared: Iterable[Dict[str, Any]]) -> List[Rule]:
+    """Turn declared rules into Rules
+
+    Arguments:
+        declared {Iterable[Dict[str, Any]]} -- Rules as read from JSON, see the module docstring
+
+    Raises:
+        ValueError: If a rule is not understood
+
+    Returns:
+        List[Rule] -- The rules
+    """
+    parsed = []
+    for d in declared:
+        if not isinstance(d, dict):
+            raise ValueError("Rule {} is not an object".format(d))
+        if "geofence" in d:
+            try:
+                polygon = [(float(lat), float(lon)) for (lat, lon) in d["geofence"]]
+            except (TypeError, ValueError):
+                raise ValueError("Geofence {} is not a list of [lat, lon] points".format(d["geofence"]))
+            parsed.append(Geofence(d.get("name", "Geofence"), polygon, bool(d.get("exclude", False))))
+            continue
+        field = d.get("field")
+        if field not in FIELDS or field == "envelope":
+            raise ValueError("Rule {} has an unknown field, use one of {}".format(d, ", ".join(f for f in FIELDS if f != "envelope")))
+        if "allow" in d or "deny" in d:
+            allow = "allow" in d
+            values = d["allow"] if allow else d["deny"]
+            if isinstance(values, str) or not isinstance(values, Iterable):
+                values = [values]
+            parsed.append(Member(d.get("name", "{} {}".format(field, "allow" if allow else "deny")), field, values, allow))
+        elif "min" in d or "max" in d:
+            if field not in NUMERIC:
+                raise ValueError("Rule {} is a band on {}, which is not a number".format(d, field))
+            low = None if d.get("min") is None else float(d["min"])
+            high = None if d.get("max") is None else float(d["max"])
+            parsed.append(Band(d.get("name", "{} band".format(field)), field, low, high))
+        else:
+            raise ValueError("Rule {} needs min/max, allow, deny or geofence".format(d))
+    return parsed
+
+
+def columns(observations: List[Any], fields: Iterable[str]) -> Dict[str, np.ndarray]:
+    """Gather fields of many observations into arrays
+
+    Numbers become float arrays with NaN where unknown, other fields object
+    arrays. Distance, elevation and azimuth are only looked up for observations
+    inside the envelope, so no geometry is computed for the others.
+
+    Arguments:
+        observations {List[Observation]} -- The observations
+        fields {Iterable[str]} -- Names of the fields, see FIELDS
+
+    Returns:
+        Dict[str, np.ndarray] -- An array for each field
+    """
+    fields = set(fields)
+    if GEOMETRY.intersection(fields):
+        fields.add("envelope")
+    result = {}
+    if "envelope" in fields:
+        result["envelope"] = np.fromiter((o.isInEnvelope() for o in observations), dtype=bool, count=len(observations))
+    for field in fields:
+        if field == "envelope":
+            continue
+        getter = FIELDS[field]
+        if field in GEOMETRY:
+            values = [getattr(o, getter)() if inside else None for (o, inside) in zip(observations, result["envelope"])]
+        else:
+            values = [getattr(o, getter)() for o in observations]
+        if field in NUMERIC:
+            result[field] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        else:
+            result[field] = np.array(values + [None], dtype=object)[:-1]  # The None stops numpy from making a 2D array of strings
+    return result
+
+
+_counter_lock = threading.Lock()
+_rejections: Dict[str, int] = {}
+
+
+def rejections() -> Dict[str, int]:
+    """How many times each rule was the one that rejected an aircraft"""
+    with _counter_lock:
+        return dict(_rejections)
+
+
+def _count(name: str, n: int = 1):
+    with _counter_lock:
+        _rejections[name] = _rejections.get(name, 0) + n
+
+
+class RuleSet(object):
+    """
+    The rules for one configuration version, in the order they are checked
+    """
+
+    def __init__(self, version: int, rules: List[Rule]):
+        self.version = version
+        self.rules = sorted(rules, key=lambda r: r.tier())  # Stable, so the declared order is kept within a tier
+        self.__fields = set(f for r in self.rules for f in r.fields)
+        self.__first_unmet = self.__compile()
+
+    def __compile(self) -> Callable[[Any], int]:
+        """Turn the rules into one function returning the index of the first rule an observation does not meet, or -1"""
+        namespace = {"_text": _text}
+
+        def constant(value) -> str:
+            name = "c{}".format(len(namespace))
+            namespace[name] = value
+            return name
+
+        lines = ["def first_unmet(o):"]
+        fetched = set()
+        for (i, rule) in enumerate(self.rules):
+            expression = rule.expression(constant)
+            if expression is None:
+                expression = "{}(o)".format(constant(rule.passes))
+            else:
+                # Only get fields when the first rule needing them is reached, so geometry stays behind the envelope
+                for field in rule.fields:
+                    if field not in fetched:
+                        lines.append("    {} = o.{}()".format(_local(field), FIELDS[field]))
+                        fetched.add(field)
+            lines.append("    if not ({}):".format(expression))
+            lines.append("        return {}".format(i))
+        lines.append("    return -1")
+        exec("\n".join(lines), namespace)
+        return namespace["first_unmet"]
+
+    def rejection(self, observation, count: bool = False) -> Optional[str]:
+        """The first rule an observation does not meet
+
+        Arguments:
+            observation {Observation} -- The observation to check
+
+        Keyword Arguments:
+            count {bool} -- Add the rejection to the counters (default: {False})
+
+        Returns:
+            Optional[str] -- Name of the rule, or None if the aircraft can be tracked
+        """
+        i = self.__first_unmet(observation)
+        if i < 0:
+            return None
+        name = self.rules[i].name
+        if count:
+            _count(name)
+        return name
+
+    def explain(self, observation) -> List[Tuple[str, bool]]:
+        """Check every rule, instead of stopping at the first one not met
+
+        Returns:
+            List[Tuple[str, bool]] -- Name of each rule, and whether it was met
+        """
+        return [(rule.name, rule.passes(observation)) for rule in self.rules if rule.explain]
+
+    def evaluate(self, observations: List[Any], count: bool = False) -> np.ndarray:
+        """Check many observations at once
+
+        Arguments:
+            observations {List[Observation]} -- The observations to check
+
+        Keyword Arguments:
+            count {bool} -- Add the first rule each observation does not meet to the counters (default: {False})
+
+        Returns:
+            np.ndarray -- True for the observations that can be tracked
+        """
+        if not observations:
+            return np.zeros(0, dtype=bool)
+        cols = columns(observations, self.__fields)
+        met = np.array([rule.vector(cols) for rule in self.rules], dtype=bool).reshape(len(self.rules), len(observations))
+        ok = met.all(axis=0)
+        if count and not ok.all():
+            first = np.bincount(np.argmin(met[:, ~ok], axis=0), minlength=len(self.rules))
+            for (rule, n) in zip(self.rules, first):
+                if n:
+                    _count(rule.name, int(n))
+        return ok
+
+
+def builtin(config: TrackerConfig) -> List[Rule]:
+    """The rules that come from the configuration fields"""
+    return [
+        Required("Loc", LOCATION),
+        NotSet("Grnd", "onGround"),
+        Band("Max Alt", "altitude", high=config.max_altitude),
+        Band("Min Alt", "altitude", low=config.min_altitude),
+        Envelope(),
+        Band("Min Dist", "distance", low=config.min_distance),
+        Band("Max Dist", "distance", high=config.max_distance),
+        Band("Min Elv", "elevation", low=config.min_elevation),
+    ]
+
+
+_lock = threading.Lock()
+_current: RuleSet = None
+
+
+def forConfig(config: TrackerConfig, checks: List[Callable[[TrackerConfig], Rule]] = ()) -> RuleSet:
+    """The rules for a configuration snapshot, compiled again only when its version changes
+
+    Arguments:
+        config {TrackerConfig} -- The configuration snapshot
+
+    Keyword Arguments:
+        checks {List[Callable]} -- Functions making extra rules for a configuration, or None if there is nothing
+                                   to check with it, checked after the built-in ones (default: {()})
+
+    Returns:
+        RuleSet -- The compiled rules
+    """
+    global _current
+    current = _current
+    if current is not None and current.version == config.version:
+        return current
+    with _lock:
+        if _current is None or _current.version != config.version:
+            extra = [rule for rule in (check(config) for check in checks) if rule is not None]
+            _current = RuleSet(config.version, builtin(config) + extra + parse(config.rules))
+        return _current
@@ -27,6 +27,51 @@ SURVEILLANCE_ID = 6
 AIR_TO_AIR = 7
 ALL_CALL_REPLY = 8
 
+# What each transmission type contributes when a backlog is coalesced, types
+# that are not listed carry nothing the tracker needs to catch up with
+COALESCE_KINDS = {
+    ES_IDENT_AND_CATEGORY: "identity",
+    ES_SURFACE_POS: "position",
+    ES_AIRBORNE_POS: "position",
+    ES_AIRBORNE_VEL: "velocity",
+}
+
+def coalesce(msgs: List[str]) -> Tuple[List[str], Dict[int, int]]:
+    """Reduce a backlog of messages to the latest identity, position and velocity of each aircraft
+
+    Only the fields needed to find the aircraft and the transmission type are
+    split out, the messages are not parsed. The messages that are kept stay in
+    the order they were received.
+
+    Returns a tuple with the messages kept and a dict with the number of
+    messages dropped for each transmission type (0 for malformed messages)
+    """
+    (kept, dropped) = coalesceIndices(msgs)
+    return ([msgs[index] for index in kept], dropped)
+
+def coalesceIndices(msgs: List[str]) -> Tuple[List[int], Dict[int, int]]:
+    """Same as coalesce(), with the indices of the messages kept instead of the messages"""
+    latest = {}
+    dropped = {}
+    for index, msg in enumerate(msgs):
+        parts = msg.lstrip().split(',', 5)
+        try:
+            transmissionType = int(parts[1])
+            kind = COALESCE_KINDS.get(transmissionType)
+            key = (parts[4].lower(), kind)
+        except (IndexError, ValueError):
+            transmissionType = 0
+            kind = None
+        if kind is None or parts[0] != "MSG":
+            dropped[transmissionType] = dropped.get(transmissionType, 0) + 1
+            continue
+        if key in latest:
+            superseded = latest[key][1]
+            dropped[superseded] = dropped.get(superseded, 0) + 1
+        latest[key] = (index, transmissionType)
+    kept = [index for (index, _) in sorted(latest.values())]
+    return (kept, dropped)
+
 def parse(msg: str) -> Dict[str, Union[str, int, float, bool, datetime]]:
     """Parse message from the feed output by dump1090 on port 30003
 
@@ -139,8 +184,14 @@ def __parseInt(array: List, index: int):
     """Parse int at given index in array
     Return int value or None if index is out of bounds or type casting failed"""
     try:
-        numbers = re.findall('[\-0-9]+', array[index])[0]        
-        return int(numbers)
+        value = array[index]
+        if not value:
+            return None
+        try:
+            # Nearly always a plain number, the regex is for the odd one with junk around it
+            return int(value)
+        except ValueError:
+            return int(re.findall('[\-0-9]+', value)[0])
     except ValueError as e:
         return None
     except TypeError as e:
@@ -165,7 +216,16 @@ def __parseDateTime(array: List, dateIndex: int, timeIndex: int):
     Return datetime value or None if indexes are out of bounds or type casting failed"""
     date = __parseString(array, dateIndex)
     time = __parseString(array, timeIndex)
+    d = None
     if date != None and time != None:
+      # dump1090 always writes "YYYY/MM/DD" and "HH:MM:SS.mmm", slicing those is
+      # much cheaper than the general purpose parser which is kept as a fallback
+      if len(date) == 10 and len(time) >= 8 and time[2] == ":" and time[5] == ":":
+        try:
+          micro = int(time[9:15].ljust(6, "0")) if len(time) > 9 else 0
+          return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(time[0:2]), int(time[3:5]), int(time[6:8]), micro)
+        except ValueError:
+          pass
       try:
         d = dateutil.parser.parse("%s %s" % (date, time))
       except ValueError:
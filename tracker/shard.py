@@ -0,0 +1,304 @@
+"""
+Shared-memory transport for processing SBS-1 messages in several processes
+
+Messages are routed to a worker process by the hash of their icao24, so each
+worker owns every observation of its aircraft. Batches of raw messages go to
+the workers, and reports with their best tracking candidates come back, over
+single-producer single-consumer ring buffers in shared memory. Nothing is
+pickled on the way: messages are newline separated text and reports are JSON.
+"""
+
+from typing import *
+import json
+import logging
+import multiprocessing
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+
+# Bytes of shared memory for each ring buffer
+RING_SIZE = 8 * 1024 * 1024
+# Messages sent to a worker in one record
+DISPATCH_CHUNK = 2000
+# Seconds a worker reports at least once in, even when it got no messages
+REPORT_INTERVAL = 1.0
+# Seconds to sleep when a ring buffer is empty (reading) or full (writing)
+POLL_INTERVAL = 0.001
+
+# Record kinds
+MESSAGES = b"M"
+CONFIG = b"C"
+REPORT = b"R"
+STOP = b"S"
+
+# Key of the rows of all of a worker's observations in its reports
+ROWS = "rows"
+
+_HEADER = struct.Struct("<QQ")     # head, tail: bytes ever written and read
+_LENGTH = struct.Struct("<I")
+_TIME = struct.Struct("<d")
+
+
+class SharedRing(object):
+    """
+    A ring buffer of variable length records in shared memory, for exactly one
+    writing and one reading process. The writer only moves `head` and the reader
+    only moves `tail`, and each does so after copying the record, so no lock is
+    needed.
+    """
+    __shm: shared_memory.SharedMemory = None
+    __capacity: int = 0
+
+    def __init__(self, size: int = RING_SIZE):
+        """Allocate the ring buffer
+
+        Keyword Arguments:
+            size {int} -- Bytes of shared memory, including the header (default: {RING_SIZE})
+        """
+        self.__shm = shared_memory.SharedMemory(create=True, size=size)
+        self.__buf = self.__shm.buf
+        self.__capacity = size - _HEADER.size
+        _HEADER.pack_into(self.__buf, 0, 0, 0)
+
+    def __copyIn(self, pos: int, data: bytes):
+        offset = pos % self.__capacity
+        first = min(len(data), self.__capacity - offset)
+        self.__buf[_HEADER.size + offset:_HEADER.size + offset + first] = data[:first]
+        if first < len(data):
+            self.__buf[_HEADER.size:_HEADER.size + len(data) - first] = data[first:]
+
+    def __copyOut(self, pos: int, length: int) -> bytes:
+        offset = pos % self.__capacity
+        first = min(length, self.__capacity - offset)
+        data = bytes(self.__buf[_HEADER.size + offset:_HEADER.size + offset + first])
+        if first < length:
+            data += bytes(self.__buf[_HEADER.size:_HEADER.size + length - first])
+        return data
+
+    def write(self, record: bytes) -> bool:
+        """Append a record
+
+        Arguments:
+            record {bytes} -- The record
+
+        Returns:
+            bool -- False if there is currently no room for the record
+        """
+        needed = _LENGTH.size + len(record)
+        if needed > self.__capacity:
+            raise ValueError("Record of %d bytes does not fit in a ring of %d bytes" % (len(record), self.__capacity))
+        (head, tail) = _HEADER.unpack_from(self.__buf, 0)
+        if self.__capacity - (head - tail) < needed:
+            return False
+        self.__copyIn(head, _LENGTH.pack(len(record)))
+        self.__copyIn(head + _LENGTH.size, record)
+        struct.pack_into("<Q", self.__buf, 0, head + needed)
+        return True
+
+    def read(self) -> Optional[bytes]:
+        """Take the oldest record
+
+        Returns:
+            Optional[bytes] -- The record, or None if the ring is empty
+        """
+        (head, tail) = _HEADER.unpack_from(self.__buf, 0)
+        if head == tail:
+            return None
+        (length,) = _LENGTH.unpack(self.__copyOut(tail, _LENGTH.size))
+        record = self.__copyOut(tail + _LENGTH.size, length)
+        struct.pack_into("<Q", self.__buf, 8, tail + _LENGTH.size + length)
+        return record
+
+    def close(self, unlink: bool = False):
+        """Detach from the shared memory, and free it if `unlink` is set"""
+        self.__buf = None
+        self.__shm.close()
+        if unlink:
+            self.__shm.unlink()
+
+
+def shardOf(icao24: str, shards: int) -> int:
+    """Which shard handles an aircraft
+
+    Arguments:
+        icao24 {str} -- ICAO 24-bit address, in either case
+        shards {int} -- Number of shards
+
+    Returns:
+        int -- Index of the shard
+    """
+    try:
+        return int(icao24, 16) % shards
+    except ValueError:
+        # Non-ICAO addresses, like TIS-B tracks prefixed with '~'
+        return zlib.crc32(icao24.lower().encode()) % shards
+
+
+def split(lines: List[str], shards: int) -> List[List[str]]:
+    """Split SBS1 messages by shard without parsing them
+
+    Arguments:
+        lines {List[str]} -- SBS1 messages
+        shards {int} -- Number of shards
+
+    Returns:
+        List[List[str]] -- The messages for each shard, in arrival order
+    """
+    parts = [[] for _ in range(shards)]
+    for line in lines:
+        fields = line.split(',', 5)
+        if len(fields) > 4:
+            parts[shardOf(fields[4], shards)].append(line)
+        else:
+            # Malformed, whoever gets it will discard it
+            parts[0].append(line)
+    return parts
+
+
+def _serve(worker, inbound: SharedRing, outbound: SharedRing):
+    """Main loop of a worker process
+
+    The worker is any object with `processBatch(lines, now)`, `configure(config)`
+    and `report()` methods, and optionally `close()` to call before it stops.
+    """
+    processed = 0
+    next_report = 0.0
+    while True:
+        got = 0
+        record = inbound.read()
+        while record is not None:
+            kind = record[:1]
+            if kind == MESSAGES:
+                (now,) = _TIME.unpack_from(record, 1)
+                lines = record[1 + _TIME.size:].decode("utf-8").split("\n")
+                worker.processBatch(lines, now)
+                processed += len(lines)
+                got += 1
+            elif kind == CONFIG:
+                worker.configure(json.loads(record[1:]))
+                got += 1
+            elif kind == STOP:
+                if hasattr(worker, "close"):
+                    worker.close()
+                return
+            record = inbound.read()
+        if got or time.monotonic() > next_report:
+            report = worker.report()
+            report["processed"] = processed
+            # If the coordinator is behind on reports, it gets the next one
+            outbound.write(REPORT + json.dumps(report, default=str).encode("utf-8"))
+            next_report = time.monotonic() + REPORT_INTERVAL
+        if not got:
+            time.sleep(POLL_INTERVAL)
+
+
+class ShardPool(object):
+    """
+    Worker processes, each with a ring buffer of messages going in and a ring
+    buffer of reports coming out
+    """
+    __shards: int = 0
+
+    def __init__(self, shards: int, worker_factory: Callable[[], Any], ring_size: int = RING_SIZE):
+        """Start the worker processes
+
+        Workers are forked, so they inherit everything loaded by the parent, like
+        the aircraft database.
+
+        Arguments:
+            shards {int} -- Number of worker processes
+            worker_factory {Callable} -- Creates the worker object in each process
+
+        Keyword Arguments:
+            ring_size {int} -- Bytes of shared memory for each ring buffer (default: {RING_SIZE})
+        """
+        self.__shards = shards
+        self.__inbound = [SharedRing(ring_size) for _ in range(shards)]
+        self.__outbound = [SharedRing(ring_size) for _ in range(shards)]
+        self.__dispatched = [0] * shards
+        self.__reports = [None] * shards
+        context = multiprocessing.get_context("fork")
+        self.__processes = []
+        for i in range(shards):
+            p = context.Process(target=self.__start, args=(worker_factory, i), name="shard-%d" % i, daemon=True)
+            p.start()
+            self.__processes.append(p)
+        logging.info("[SHARDS]\tStarted {} worker processes".format(shards))
+
+    def __start(self, worker_factory, index: int):
+        _serve(worker_factory(), self.__inbound[index], self.__outbound[index])
+
+    def shards(self) -> int:
+        return self.__shards
+
+    def __send(self, index: int, record: bytes):
+        # A full ring means the worker is behind, which back-pressures into the ingest queue
+        while not self.__inbound[index].write(record):
+            if not self.__processes[index].is_alive():
+                raise RuntimeError("Shard worker %d died" % index)
+            time.sleep(POLL_INTERVAL)
+
+    def dispatch(self, lines: List[str], now: float):
+        """Send SBS1 messages to the workers that own their aircraft
+
+        Arguments:
+            lines {List[str]} -- SBS1 messages
+            now {float} -- Time the messages were received (seconds since the epoch)
+        """
+        stamp = _TIME.pack(now)
+        for (index, part) in enumerate(split(lines, self.__shards)):
+            for i in range(0, len(part), DISPATCH_CHUNK):
+                chunk = part[i:i + DISPATCH_CHUNK]
+                self.__send(index, MESSAGES + stamp + "\n".join(chunk).encode("utf-8"))
+                self.__dispatched[index] += len(chunk)
+
+    def configure(self, config: Dict[str, Any]):
+        """Send a configuration snapshot to every worker"""
+        record = CONFIG + json.dumps(config).encode("utf-8")
+        for index in range(self.__shards):
+            self.__send(index, record)
+
+    def reports(self) -> List[Optional[Dict[str, Any]]]:
+        """The latest report of each worker, None for workers that have not reported yet
+
+        The rows of all of a worker's observations are only in some of its
+        reports, the last ones it sent are kept in the later reports.
+        """
+        for index in range(self.__shards):
+            record = self.__outbound[index].read()
+            while record is not None:
+                report = json.loads(record[1:])
+                previous = self.__reports[index]
+                if ROWS not in report and previous is not None and ROWS in previous:
+                    report[ROWS] = previous[ROWS]
+                self.__reports[index] = report
+                record = self.__outbound[index].read()
+        return list(self.__reports)
+
+    def drain(self, timeout: float) -> bool:
+        """Wait until the workers have processed every message dispatched to them
+
+        Arguments:
+            timeout {float} -- Maximum number of seconds to wait
+
+        Returns:
+            bool -- False if the workers did not catch up in time
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            reports = self.reports()
+            if all(r is not None and r["processed"] >= d for (r, d) in zip(reports, self.__dispatched)):
+                return True
+            time.sleep(POLL_INTERVAL)
+        return False
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        for index in range(self.__shards):
+            if self.__processes[index].is_alive():
+                self.__send(index, STOP)
+        for p in self.__processes:
+            p.join(timeout=5)
+        for ring in self.__inbound + self.__outbound:
+            ring.close(unlink=True)
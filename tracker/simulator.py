@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Score the photographs a selection policy and camera would take of recorded traffic
+
+Recorded SBS-1 messages are replayed through the tracker on their own clock,
+much faster than real time, and a camera is pointed with the pointing math of
+axis-ptz. The camera is modeled by its pan and tilt rates, the time it takes
+to settle after a slew, its field of view at the zoom used and its capture
+period. Every frame it would take is checked for the aircraft being in the
+field of view, and for each aircraft that was trackable the frames on target
+are counted. A trackable aircraft that did not get a single one is a missed
+opportunity.
+
+Which aircraft to photograph is up to a policy, a function of a Step that
+returns an icao24 (or None). Policies are pluggable: the built-in ones are in
+POLICIES, and --policy module:function loads any other.
+
+    tracker     -- what FlightTracker selects, to evaluate changes to its logic
+    closest     -- the closest trackable aircraft, looked at every second
+    lookahead   -- give every aircraft a few frames, earliest to leave first
+    pinned      -- the aircraft given with --pin whenever it is known, the tracker otherwise
+
+The axis-ptz modules are imported from ../axis-ptz, so this has to run from a
+checkout of the repository rather than from the tracker image. The sun
+exclusion is left out, as the position of the sun is computed for the wall
+clock and not for the time of the recording.
+"""
+
+from typing import *
+import argparse
+import calendar
+import importlib
+import importlib.util
+import logging
+import math
+import os
+import sys
+import time
+import pandas as pd
+import flighttracker
+import preposition
+import replay
+
+# Directory of the camera controller, next to the tracker's
+AXIS_PTZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "axis-ptz")
+# Modules of the camera controller with the same name as one of the tracker's
+SHARED_MODULES = ("utils", "sun", "config_store")
+# Seconds between camera moves, the move period of axis-ptz
+STEP = 0.1
+# Seconds between looking at which aircraft are trackable and asking the policy which to photograph
+SELECT_INTERVAL = 1.0
+# Messages per second for recordings without timestamps, like the synthetic ones
+MESSAGE_RATE = 1000.0
+# Frames on target an aircraft gets from the lookahead policy before it moves on
+DWELL_FRAMES = 5
+
+
+class CameraModel(NamedTuple):
+    """How fast the camera moves and what it sees"""
+    pan_rate: float = 90.0  # [deg/s]
+    tilt_rate: float = 90.0  # [deg/s]
+    settle: float = 0.3  # [s] After a slew, before frames are sharp
+    fov: float = 5.0  # [deg] Horizontal field of view at the zoom used
+    aspect: float = 16.0 / 9.0  # Width over height of the frames
+    capture_period: float = 1.0  # [s]
+    lead: float = 0.25  # [s] How far ahead of the aircraft the camera is pointed
+
+
+class Step(NamedTuple):
+    """What a policy gets to decide on"""
+    now: float
+    tracker: Any  # FlightTracker
+    candidates: List[Any]  # Trackable observations
+    current: Optional[str]  # Aircraft being photographed
+    pan: float  # [deg] Where the camera points
+    tilt: float  # [deg]
+    frames: Dict[str, int]  # Frames on target so far, by icao24
+    model: CameraModel
+    pointing: "Pointing"
+
+
+def loadCamera(path: str = AXIS_PTZ):
+    """Import camera.py of axis-ptz as ptz_camera
+
+    Its utils, sun and config_store modules are imported with it, and taken out
+    of sys.modules again so the tracker keeps its own modules of the same name.
+
+    Keyword Arguments:
+        path {str} -- Directory of axis-ptz (default: {AXIS_PTZ})
+
+    Returns:
+        module -- The camera module
+    """
+    saved = {name: sys.modules.pop(name) for name in SHARED_MODULES if name in sys.modules}
+    sys.path.insert(0, path)
+    try:
+        spec = importlib.util.spec_from_file_location("ptz_camera", os.path.join(path, "camera.py"))
+        camera = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(camera)
+    finally:
+        sys.path.remove(path)
+        for name in SHARED_MODULES:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+    return camera
+
+
+class Pointing(object):
+    """
+    Pan and tilt from the axis-ptz pointing math, for a camera at a fixed position
+    """
+
+    def __init__(self, camera, latitude: float, longitude: float, altitude: float, yaw: float = 0.0, pitch: float = 0.0, roll: float = 0.0):
+        """Set up the camera module for a tripod
+
+        Arguments:
+            camera {module} -- The axis-ptz camera module, see loadCamera()
+            latitude {float} -- Latitude of the camera
+            longitude {float} -- Longitude of the camera
+            altitude {float} -- Altitude of the camera in meters
+
+        Keyword Arguments:
+            yaw {float} -- Yaw of the camera housing in degrees (default: {0.0})
+            pitch {float} -- Pitch of the camera housing in degrees (default: {0.0})
+            roll {float} -- Roll of the camera housing in degrees (default: {0.0})
+        """
+        self.__camera = camera
+        # The age of a position is part of the lead given to aircraft()
+        camera.include_age = False
+        camera.config_store.update(camera_latitude=latitude, camera_longitude=longitude, camera_altitude=altitude, camera_yaw=yaw, camera_pitch=pitch, camera_roll=roll)
+        (self.__E_XYZ_to_ENz, self.__e_E_XYZ, self.__e_N_XYZ, self.__e_z_XYZ) = camera.utils.compute_E(float(longitude), float(latitude))
+        self.__r_XYZ_t = camera.utils.compute_r_XYZ(float(longitude), float(latitude), float(altitude))
+        (_, _, _, self.__E_XYZ_to_uvw, _, _, _) = camera.compute_rotations(self.__e_E_XYZ, self.__e_N_XYZ, self.__e_z_XYZ, yaw, pitch, roll, 0.0, 0.0)
+        self.__rotation = (yaw, pitch, roll)
+
+    def aircraft(self, observation, when: float, lead: float = 0.0) -> Tuple[float, float]:
+        """Pan and tilt to an aircraft, as camera.py points at the plane on the flight topic
+
+        Arguments:
+            observation {Observation} -- The aircraft
+            when {float} -- Time to point at it (seconds since the epoch)
+
+        Keyword Arguments:
+            lead {float} -- Seconds past `when` to point at (default: {0.0})
+
+        Returns:
+            Tuple[float, float] -- Pan and tilt in degrees
+        """
+        camera = self.__camera
+        camera.currentPlane = {
+            "lat": float(observation.getLat()),
+            "lon": float(observation.getLon()),
+            "latLonTime": observation.getLatLonTime(),
+            "altitude": float(observation.getAltitude()),
+            "track": observation.getTrack(),
+            "groundSpeed": observation.getGroundSpeed(),
+            "verticalRate": observation.getVerticalRate() or 0.0,
+        }
+        camera.config_store.update(camera_lead=when - observation.getLatLonTime() + lead)
+        camera.calculateCameraPositionB(self.__r_XYZ_t, self.__E_XYZ_to_ENz, self.__e_E_XYZ, self.__e_N_XYZ, self.__e_z_XYZ, *self.__rotation, self.__E_XYZ_to_uvw)
+        return (camera.cameraPan, camera.cameraTilt)
+
+    def point(self, point: Dict[str, float]) -> Tuple[float, float]:
+        """Pan and tilt to a point with a lat, lon and altitude, as camera.py parks at a pre-position"""
+        return self.__camera.calculateCameraPositionPreposition(self.__r_XYZ_t, self.__E_XYZ_to_uvw, point)
+
+
+def pointable(observation) -> bool:
+    """Is enough known about an aircraft to point the camera at it"""
+    return observation is not None and None not in (observation.getLat(), observation.getLon(), observation.getAltitude(), observation.getTrack(), observation.getGroundSpeed())
+
+
+def panDifference(pan1: float, pan2: float) -> float:
+    """Shortest pan from pan1 to pan2, in degrees"""
+    return (pan2 - pan1 + 180.0) % 360.0 - 180.0
+
+
+def slewTime(model: CameraModel, pan: float, tilt: float, target: Tuple[float, float]) -> float:
+    """Seconds for the camera to point at a target and settle, both axes moving at once"""
+    seconds = max(abs(panDifference(pan, target[0])) / model.pan_rate, abs(target[1] - tilt) / model.tilt_rate)
+    return seconds + model.settle if seconds > STEP else seconds
+
+
+def messageTimes(messages: List[str], rate: float = MESSAGE_RATE, start: float = None) -> List[float]:
+    """When each message was received, from the generated date and time of the SBS-1 messages
+
+    Recordings whose timestamps do not advance, like the synthetic ones, are
+    taken to have been received at `rate` messages per second. Messages out of
+    order are taken to have arrived with the one before them.
+
+    Arguments:
+        messages {List[str]} -- SBS-1 messages
+
+    Keyword Arguments:
+        rate {float} -- Messages per second when there are no timestamps (default: {MESSAGE_RATE})
+        start {float} -- Time of the first message then (default: {now})
+
+    Returns:
+        List[float] -- Seconds since the epoch
+    """
+    days = {}
+    times = []
+    last = None
+    for m in messages:
+        parts = m.split(",", 8)
+        try:
+            day = days.get(parts[6])
+            if day is None:
+                day = days[parts[6]] = calendar.timegm(time.strptime(parts[6], "%Y/%m/%d"))
+            (hours, minutes, seconds) = parts[7].split(":")
+            stamp = day + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            last = stamp if last is None else max(last, stamp)
+        except (IndexError, ValueError):
+            pass
+        times.append(last)
+    known = [t for t in times if t is not None]
+    if not known or known[-1] - known[0] < len(messages) / rate / 2:
+        start = time.time() if start is None else start
+        return [start + i / rate for i in range(len(messages))]
+    return [t if t is not None else known[0] for t in times]
+
+
+def trackerPolicy(step: Step) -> Optional[str]:
+    """What FlightTracker selects"""
+    return step.tracker.getTracking()
+
+
+def closestPolicy(step: Step) -> Optional[str]:
+    """The closest trackable aircraft"""
+    if not step.candidates:
+        return None
+    return min(step.candidates, key=lambda o: o.getDistance()).getIcao24()
+
+
+def lookaheadPolicy(step: Step) -> Optional[str]:
+    """Give every aircraft DWELL_FRAMES frames, starting with the one that will leave first
+
+    The aircraft being photographed is kept until it has its frames. Then the
+    aircraft with the fewest frames that can still be reached in time for its
+    frames before it leaves is next, the earliest to leave first.
+    """
+    by_icao24 = {o.getIcao24(): o for o in step.candidates}
+    if step.current in by_icao24 and step.frames.get(step.current, 0) < DWELL_FRAMES:
+        return step.current
+    flown = preposition.fly(step.candidates, flighttracker.config_store.get(), step.now, ruleset=flighttracker.trackabilityRules())
+    if flown is None:
+        return step.current if step.current in by_icao24 else None
+    dwell = DWELL_FRAMES * step.model.capture_period
+    best = None
+    for (icao24, ok) in zip(flown["icao24"], flown["ok"]):
+        # Seconds until it leaves the trackable limits, as far as it is flown
+        remaining = flown["steps"][ok.argmin()] if not ok.all() else flown["steps"][-1]
+        target = step.pointing.aircraft(by_icao24[icao24], step.now, step.model.lead)
+        reach = slewTime(step.model, step.pan, step.tilt, target)
+        if remaining - reach < dwell:
+            continue
+        key = (step.frames.get(icao24, 0), remaining, reach)
+        if best is None or key < best[0]:
+            best = (key, icao24)
+    if best is not None:
+        return best[1]
+    return step.current if step.current in by_icao24 else closestPolicy(step)
+
+
+def pinnedPolicy(icao24: str) -> Callable[[Step], Optional[str]]:
+    """A policy that photographs one aircraft whenever it is known, and leaves the rest to the tracker"""
+    icao24 = icao24.lower()
+
+    def policy(step: Step) -> Optional[str]:
+        if pointable(step.tracker.getObservation(icao24)):
+            return icao24
+        return step.tracker.getTracking()
+    return policy
+
+
+POLICIES = {"tracker": trackerPolicy, "closest": closestPolicy, "lookahead": lookaheadPolicy}
+
+
+def loadPolicy(name: str, pin: str = None) -> Callable[[Step], Optional[str]]:
+    """A built-in policy, "pinned" with the aircraft to pin, or module:function"""
+    if name == "pinned":
+        if not pin:
+            raise ValueError("The pinned policy needs an aircraft to pin")
+        return pinnedPolicy(pin)
+    if name in POLICIES:
+        return POLICIES[name]
+    if ":" not in name:
+        raise ValueError("Unknown policy {}, use one of {} or module:function".format(name, ", ".join(list(POLICIES) + ["pinned"])))
+    (module, function) = name.split(":", 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def simulate(tracker: flighttracker.FlightTracker, messages: List[str], times: List[float], policy: Callable[[Step], Optional[str]], model: CameraModel, pointing: Pointing) -> Dict[str, Any]:
+    """Replay messages on their own clock and score the frames the camera takes
+
+    Arguments:
+        tracker {FlightTracker} -- A new tracker, not sharded
+        messages {List[str]} -- SBS-1 messages
+        times {List[float]} -- When each message was received, see messageTimes()
+        policy {Callable[[Step], Optional[str]]} -- Picks the aircraft to photograph
+        model {CameraModel} -- The camera
+        pointing {Pointing} -- Pan and tilt to aircraft and points
+
+    Returns:
+        Dict[str, Any] -- Simulated and wall clock seconds, and per aircraft ("aircraft") the seconds it was
+                          trackable, the frames taken of it and how many of those had it in view ("on_target")
+    """
+    (half_width, half_height) = (model.fov / 2.0, model.fov / model.aspect / 2.0)
+    aircraft = {}
+    frames = {}
+    (pan, tilt) = (0.0, 0.0)
+    sharp = 0.0  # When the camera has settled after the last slew
+    current = None
+    next_select = next_capture = next_preposition = now = times[0]
+    i = 0
+    started = time.perf_counter()
+    while i < len(messages):
+        j = i
+        while j < len(messages) and times[j] <= now:
+            j += 1
+        tracker.processBatch(messages[i:j], now)
+        i = j
+
+        if now >= next_select:
+            candidates = tracker.getTrackableObservations()
+            for o in candidates:
+                aircraft.setdefault(o.getIcao24(), {"trackable": 0.0, "frames": 0, "on_target": 0})["trackable"] += SELECT_INTERVAL
+            selected = policy(Step(now, tracker, candidates, current, pan, tilt, frames, model, pointing))
+            if selected != current:
+                next_capture = now
+            current = selected
+            next_select = now + SELECT_INTERVAL
+
+        observation = tracker.getObservation(current) if current else None
+        if pointable(observation):
+            target = pointing.aircraft(observation, now, model.lead)
+        else:
+            observation = None
+            if now >= next_preposition:
+                # Park where the next aircraft is expected, as camera.py does while idle
+                upcoming = tracker.getPreposition(now)
+                target = pointing.point(upcoming) if upcoming else (pan, tilt)
+                next_preposition = now + flighttracker.PREPOSITION_INTERVAL
+            else:
+                target = (pan, tilt)
+
+        # Both axes move at their own rate, for one move period
+        (dpan, dtilt) = (panDifference(pan, target[0]), target[1] - tilt)
+        (max_pan, max_tilt) = (model.pan_rate * STEP, model.tilt_rate * STEP)
+        if abs(dpan) > max_pan or abs(dtilt) > max_tilt:
+            sharp = now + STEP + model.settle
+        pan = (pan + max(-max_pan, min(max_pan, dpan)) + 180.0) % 360.0 - 180.0
+        tilt += max(-max_tilt, min(max_tilt, dtilt))
+        now += STEP
+
+        if observation is not None and now >= next_capture:
+            scores = aircraft.setdefault(current, {"trackable": 0.0, "frames": 0, "on_target": 0})
+            scores["frames"] += 1
+            if now >= sharp:
+                (actual_pan, actual_tilt) = pointing.aircraft(observation, now)
+                if abs(panDifference(pan, actual_pan)) * math.cos(math.radians(actual_tilt)) <= half_width and abs(actual_tilt - tilt) <= half_height:
+                    scores["on_target"] += 1
+                    frames[current] = frames.get(current, 0) + 1
+            next_capture += model.capture_period
+            if next_capture <= now:
+                next_capture = now + model.capture_period
+    return {"seconds": now - times[0], "wall": time.perf_counter() - started, "aircraft": aircraft}
+
+
+def summary(result: Dict[str, Any], capture_period: float) -> Dict[str, Any]:
+    """Totals of a simulate() result
+
+    Arguments:
+        result {Dict[str, Any]} -- What simulate() returned
+        capture_period {float} -- Seconds between frames, an aircraft trackable for less is not a missed opportunity
+
+    Returns:
+        Dict[str, Any] -- Aircraft that were trackable, photographed on target and missed, frames taken and on
+                          target, the fraction of frames on target and how much faster than real time it ran
+    """
+    scores = result["aircraft"].values()
+    frames = sum(s["frames"] for s in scores)
+    on_target = sum(s["on_target"] for s in scores)
+    return {
+        "trackable": sum(1 for s in scores if s["trackable"] > 0),
+        "photographed": sum(1 for s in scores if s["on_target"] > 0),
+        "missed": sum(1 for s in scores if s["trackable"] >= capture_period and s["on_target"] == 0),
+        "frames": frames,
+        "on_target": on_target,
+        "on_target_fraction": on_target / frames if frames else 0.0,
+        "frames_per_aircraft": on_target / max(1, sum(1 for s in scores if s["on_target"] > 0)),
+        "speedup": result["seconds"] / result["wall"] if result["wall"] else float("inf"),
+    }
+
+
+def main():
+    defaults = CameraModel()
+    parser = argparse.ArgumentParser(description='Score the photographs selection policies and a camera would take of recorded SBS-1 messages')
+    parser.add_argument('log', nargs='?', help="File with one SBS-1 message per line, omit to generate a synthetic air picture")
+    parser.add_argument('-l', '--lat', type=float, help="Latitude of camera", default=38.9)
+    parser.add_argument('-L', '--lon', type=float, help="Longitude of camera", default=-77.0)
+    parser.add_argument('-a', '--alt', type=float, help="altitude of camera in METERS!", default=0)
+    parser.add_argument('-M', '--min-elevation', type=int, help="minimum elevation for camera", default=0)
+    parser.add_argument('--max-distance', type=int, help="max distance to track planes at, in meters", default=None)
+    parser.add_argument('--policy', nargs='+', help="policies to compare: %s, pinned (with --pin) or module:function (default all built-in)" % ", ".join(POLICIES), default=list(POLICIES))
+    parser.add_argument('--pin', help="icao24 of the aircraft for the pinned policy")
+    parser.add_argument('--pan-rate', type=float, help="camera pan speed in deg/s (default %g)" % defaults.pan_rate, default=defaults.pan_rate)
+    parser.add_argument('--tilt-rate', type=float, help="camera tilt speed in deg/s (default %g)" % defaults.tilt_rate, default=defaults.tilt_rate)
+    parser.add_argument('--settle', type=float, help="seconds after a slew before frames are sharp (default %g)" % defaults.settle, default=defaults.settle)
+    parser.add_argument('--fov', type=float, help="horizontal field of view in degrees at the zoom used (default %g)" % defaults.fov, default=defaults.fov)
+    parser.add_argument('--capture-period', type=float, help="seconds between frames (default %g)" % defaults.capture_period, default=defaults.capture_period)
+    parser.add_argument('-c', '--camera-lead', type=float, help="how many seconds ahead of a plane's predicted location should the camera be positioned", default=defaults.lead)
+    parser.add_argument('--yaw', type=float, help="yaw of the camera housing in degrees", default=0.0)
+    parser.add_argument('--pitch', type=float, help="pitch of the camera housing in degrees", default=0.0)
+    parser.add_argument('--roll', type=float, help="roll of the camera housing in degrees", default=0.0)
+    parser.add_argument('--rate', type=float, help="messages per second for recordings without timestamps (default %g)" % MESSAGE_RATE, default=MESSAGE_RATE)
+    parser.add_argument('--aircraft', type=int, help="aircraft in the synthetic air picture (default 100)", default=100)
+    parser.add_argument('--spread', type=float, help="degrees around the camera the synthetic aircraft start in (default 0.5)", default=0.5)
+    parser.add_argument('--messages', type=int, help="messages in the synthetic air picture (default 600000)", default=600000)
+    parser.add_argument('--aircraft-db', help="aircraft database CSV, omit to use an empty database")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+    camera = loadCamera()
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    if args.aircraft_db:
+        flighttracker.planes = pd.read_csv(args.aircraft_db)
+    else:
+        flighttracker.planes = pd.DataFrame(columns=replay.AIRCRAFT_DB_COLUMNS)
+    flighttracker.config_store.update(camera_latitude=args.lat, camera_longitude=args.lon, camera_altitude=args.alt, camera_lead=args.camera_lead, min_elevation=args.min_elevation, max_distance=args.max_distance)
+    model = CameraModel(pan_rate=args.pan_rate, tilt_rate=args.tilt_rate, settle=args.settle, fov=args.fov, capture_period=args.capture_period, lead=args.camera_lead)
+    pointing = Pointing(camera, args.lat, args.lon, args.alt, args.yaw, args.pitch, args.roll)
+
+    if args.log:
+        with open(args.log) as f:
+            messages = [line for line in f.read().splitlines() if line]
+    else:
+        messages = replay.synthetic_messages(args.lat, args.lon, args.aircraft, args.messages, spread=args.spread)
+    times = messageTimes(messages, args.rate)
+    print("%d messages over %.0fs, pan %g deg/s, tilt %g deg/s, settle %gs, field of view %g deg, a frame every %gs" % (len(messages), times[-1] - times[0], model.pan_rate, model.tilt_rate, model.settle, model.fov, model.capture_period))
+    print("policy                trackable  photographed  missed  frames  on target  fraction  frames/aircraft  speedup")
+    for name in args.policy:
+        policy = loadPolicy(name, args.pin)
+        tracker = flighttracker.FlightTracker("simulator", "simulator", None, "skyscan/flight/json")
+        totals = summary(simulate(tracker, messages, times, policy, model, pointing), model.capture_period)
+        print("%-20s  %9d  %12d  %6d  %6d  %9d  %8.2f  %15.1f  %6.0fx" % (name[:20], totals["trackable"], totals["photographed"], totals["missed"], totals["frames"], totals["on_target"], totals["on_target_fraction"], totals["frames_per_aircraft"], totals["speedup"]))
+
+
+if __name__ == "__main__":
+    main()
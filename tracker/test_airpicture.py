@@ -0,0 +1,47 @@
+"""Unit tests for airpicture.py"""
+
+import json
+
+import airpicture
+
+
+def observation(icao24, lat, **fields):
+    return dict({"icao24": icao24, "lat": lat, "lon": -77.0, "squawk": None, "altitude": 1234.5678, "distance": 5000.0, "geometryStale": False}, **fields)
+
+
+def test_snapshots_and_deltas():
+    sent = []
+    publisher = airpicture.PlanePublisher(sent.append, snapshot_interval=10.0)
+    follower = airpicture.AirPicture()
+
+    first = publisher.update([observation("a", 38.0), observation("b", 38.5)], 100.0)
+    assert first["type"] == "snapshot"
+    assert first["aircraft"]["a"] == {"lat": 38.0, "lon": -77.0, "altitude": 1235.0}
+
+    # Moving less than the rounding is not a change
+    second = publisher.update([observation("a", 38.000001, squawk="1200"), observation("c", 39.0)], 101.0)
+    assert second["type"] == "delta"
+    assert (second["changed"], list(second["added"]), second["removed"]) == ({"a": {"squawk": "1200"}}, ["c"], ["b"])
+    third = publisher.update([observation("a", 38.1), observation("c", 39.0)], 102.0)
+    assert third["changed"] == {"a": {"lat": 38.1, "squawk": None}}
+
+    for payload in sent:
+        assert follower.apply(json.loads(payload))
+    assert follower.aircraft == {"a": {"lat": 38.1, "lon": -77.0, "altitude": 1235.0}, "c": {"lat": 39.0, "lon": -77.0, "altitude": 1235.0}}
+
+    assert publisher.update([], 110.0)["type"] == "snapshot"
+    assert publisher.stats()["snapshots"] == 2 and publisher.stats()["deltas"] == 2
+
+
+def test_missed_delta_waits_for_snapshot():
+    sent = []
+    publisher = airpicture.PlanePublisher(sent.append, snapshot_interval=10.0)
+    for now in range(100, 111):
+        publisher.update([observation("a", 38.0 + now / 1000.0)], float(now))
+    messages = [json.loads(payload) for payload in sent]
+    follower = airpicture.AirPicture()
+    assert not follower.apply(messages[1])  # Joined in between snapshots
+    assert follower.apply(messages[0])
+    assert not follower.apply(messages[2])  # Missed messages[1]
+    assert not follower.apply(messages[3])
+    assert follower.apply(messages[10]) and follower.aircraft["a"]["lat"] == 38.11
@@ -0,0 +1,85 @@
+"""Unit tests for archive.py"""
+
+import os
+
+import numpy as np
+
+import archive
+
+# 2021-05-13 14:00 UTC
+HOUR = 1620914400.0
+# The same, in hours since the epoch
+HOURS = 450254
+
+
+class Plane(object):
+    """Just what the archive reads from an Observation"""
+
+    def __init__(self, icao24, lat, lon, type="Boeing 737-824"):
+        (self.icao24, self.lat, self.lon, self.type) = (icao24, lat, lon, type)
+
+    def getIcao24(self): return self.icao24
+    def getLat(self): return self.lat
+    def getLon(self): return self.lon
+    def getAltitude(self): return 3000.0
+    def getGroundSpeed(self): return 200.0
+    def getTrack(self): return None
+    def getVerticalRate(self): return 0.0
+    def getCallsign(self): return "TST1"
+    def getSquawk(self): return None
+    def getRegistration(self): return "N1"
+    def getType(self): return self.type
+    def getOperator(self): return "Test"
+
+
+def fill(root):
+    """Two aircraft for two hours, one passing over the camera at 38.0, -77.0 and one 50 km north of it"""
+    writer = archive.ArchiveWriter(root, flush_rows=100)
+    for n in range(720):
+        now = HOUR + n * 10.0
+        writer.append(Plane("abc123", 37.9 + n / 3600.0, -77.0), now)
+        writer.append(Plane("DEF456", 38.45, -77.0, type="Airbus A320"), now + 1.0)
+    writer.append(Plane("", 38.0, -77.0), now)  # No address, not archived
+    writer.close()
+
+
+def test_parts(tmp_path):
+    root = str(tmp_path)
+    fill(root)
+    hours = sorted(os.listdir(os.path.join(root, "2021-05-13")))
+    assert hours == ["14", "15"]
+    parts = list(archive.parts(root))
+    assert len(parts) > 2 and all(hour in (HOURS, HOURS + 1) for (hour, part) in parts)
+    columns = archive.load(parts[0][1], ["icao24", "time", "track"])
+    assert (np.diff(columns["icao24"].astype(np.int64)) >= 0).all()
+    assert np.isnan(columns["track"]).all()
+    assert list(archive.parts(root, HOUR + 3600)) == [(hour, part) for (hour, part) in parts if hour == HOURS + 1]
+    assert archive.icao24Text(archive.icao24Number("abc123")) == "abc123"
+
+
+def test_queries(tmp_path):
+    root = str(tmp_path)
+    fill(root)
+    found = archive.near(root, 38.0, -77.0, 5000.0)
+    assert list(found) == ["abc123"]
+    assert found["abc123"]["closest"] < 100.0
+    # 5 km is 0.045 degrees, 161 positions either side of the closest
+    assert (found["abc123"]["first"], found["abc123"]["last"]) == (HOUR + 199 * 10.0, HOUR + 521 * 10.0)
+    assert archive.near(root, 38.0, -77.0, 5000.0, start=HOUR + 5300) == {}
+    assert archive.near(root, 38.0, -77.0, 5000.0, start=HOUR + 4000)["abc123"]["positions"] == 122
+    assert archive.hourlyCounts(root) == [(HOURS, 2, 720), (HOURS + 1, 2, 720)]
+    assert archive.topTypes(root) == [("Airbus A320", 1), ("Boeing 737-824", 1)]
+    assert archive.topTypes(root, top=1) == [("Airbus A320", 1)]
+    points = archive.track(root, "def456", start=HOUR + 3600)
+    assert len(points["time"]) == 360 and (np.diff(points["time"]) > 0).all()
+
+
+def test_compact(tmp_path):
+    root = str(tmp_path)
+    fill(root)
+    counts = archive.hourlyCounts(root)
+    assert archive.compact(root, before=HOUR + 3600) == 1
+    assert archive.compact(root, before=HOUR + 3600) == 0
+    assert len(list(archive.parts(root, HOUR, HOUR + 3599))) == 1
+    assert archive.hourlyCounts(root) == counts
+    assert len(archive.track(root, "abc123")["time"]) == 720
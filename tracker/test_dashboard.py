@@ -0,0 +1,42 @@
+"""Unit tests for dashboard.py"""
+
+import asyncio
+import gzip
+import json
+
+from starlette.requests import Request
+
+import dashboard
+
+
+def get(endpoint, query="", gzipped=False):
+    headers = [(b"accept-encoding", b"gzip")] if gzipped else []
+    request = Request({"type": "http", "method": "GET", "path": "/", "query_string": query.encode(), "headers": headers})
+    return asyncio.run(endpoint(request))
+
+
+def snapshot(version, count):
+    observations = tuple(dashboard.observationFields({"_Observation__icao24": "%06x" % i, "_Observation__distance": float(i), "_Observation__manufacturer": float("nan"), "_Observation__geometryStale": False}) for i in range(count))
+    return dashboard.Snapshot(version=version, time=1000.0, tracking="000001", observations=observations)
+
+
+def test_observations():
+    current = [snapshot(1, 300)]
+    app = dashboard.Dashboard(lambda: current[0])
+
+    page = json.loads(get(app.observations, "offset=10&limit=5&fields=icao24,manufacturer").body)
+    assert (page["total"], page["offset"], page["limit"], page["tracking"]) == (300, 10, 5, "000001")
+    assert page["observations"] == [{"icao24": "%06x" % i, "manufacturer": None} for i in range(10, 15)]
+    page = json.loads(get(app.observations, "limit=5000").body)
+    assert (page["limit"], len(page["observations"])) == (dashboard.MAX_LIMIT, 300)
+
+    response = get(app.observations, gzipped=True)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "geometryStale" not in json.loads(gzip.decompress(response.body))["observations"][0]
+
+    assert get(app.observations, "fields=nope").status_code == 400
+    assert get(app.observations, "limit=x").status_code == 400
+
+    # Answers come from the latest snapshot, not a cached one
+    current[0] = snapshot(2, 3)
+    assert json.loads(get(app.observations).body)["total"] == 3
@@ -0,0 +1,52 @@
+"""Unit tests for envelope.py"""
+
+import random
+
+import envelope
+import utils
+from config_store import ConfigStore, TrackerConfig
+
+
+def within_limits(config, lat, lon, alt):
+    """The exact distance, altitude and elevation checks of isTrackable."""
+    distance3d = utils.coordinate_distance_3d(config.camera_latitude, config.camera_longitude, config.camera_altitude, lat, lon, alt)
+    distance2d = utils.coordinate_distance(config.camera_latitude, config.camera_longitude, lat, lon)
+    if config.max_altitude is not None and alt > config.max_altitude:
+        return False
+    if config.min_altitude is not None and alt < config.min_altitude:
+        return False
+    if config.max_distance is not None and distance3d > config.max_distance:
+        return False
+    return utils.elevation(distance2d, config.camera_altitude, alt) >= config.min_elevation
+
+
+def test_never_rejects_trackable():
+    """The envelope may only reject aircraft that the exact checks reject."""
+    rng = random.Random(0)
+    rejected = 0
+    for _ in range(200):
+        config = TrackerConfig(
+            camera_latitude=rng.uniform(-85, 85), camera_longitude=rng.uniform(-180, 180), camera_altitude=rng.uniform(0, 2000),
+            min_elevation=rng.choice([0, 5, 30]), min_altitude=rng.choice([None, 0, 1000]), max_altitude=rng.choice([None, 8000, 12000]),
+            max_distance=rng.choice([None, 5000, 50000, 300000]))
+        box = envelope.Envelope(config)
+        for _ in range(200):
+            scale = rng.choice([0.01, 0.1, 1, 5])
+            lat = max(-90, min(90, config.camera_latitude + rng.uniform(-scale, scale)))
+            lon = (config.camera_longitude + rng.uniform(-scale, scale) + 180) % 360 - 180
+            alt = rng.uniform(0, 13000)
+            if not box.contains(lat, lon, alt):
+                rejected += 1
+                assert not within_limits(config, lat, lon, alt)
+    assert rejected > 0
+
+
+def test_for_config_rebuilds_on_version(monkeypatch):
+    """forConfig() keeps the envelope until the config version changes."""
+    # Versions from a private store, and the cache put back afterwards, as the tracker's config versions share it
+    monkeypatch.setattr(envelope, "_current", None)
+    store = ConfigStore(TrackerConfig(min_elevation=0, max_distance=10000))
+    config = store.update(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0)
+    assert envelope.forConfig(config) is envelope.forConfig(store.get())
+    moved = envelope.forConfig(store.update(camera_latitude=39.0))
+    assert moved.latitude == 39.0
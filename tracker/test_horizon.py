@@ -0,0 +1,63 @@
+"""Unit tests for horizon.py"""
+
+import math
+
+import numpy as np
+
+import horizon
+
+
+def test_profile(tmp_path):
+    """Unit test for loadProfile()."""
+    path = tmp_path / "profile.txt"
+    path.write_text("# azimuth elevation\n0 10\n90, 30\n270 10\n")
+    mask = horizon.loadProfile(str(path))
+    assert mask.shape == (horizon.BINS,)
+    assert mask[0] == 10
+    assert mask[450] == 20
+    assert mask[900] == 30
+    assert mask[3150] == 10
+
+
+def wallGrid(tmp_path):
+    """A 50m wall 500m east of the middle of an ASCII grid, and the latitude and longitude of the middle"""
+    cellsize = 0.0005
+    rows = cols = 61
+    heights = np.zeros((rows, cols))
+    lon = -77.0 + cols / 2 * cellsize
+    lat = 38.0 + rows / 2 * cellsize
+    wall = int(round(500 / (horizon.EARTH_RADIUS * math.pi / 180 * math.cos(math.radians(lat))) / cellsize)) + cols // 2
+    heights[:, wall] = 50
+    path = tmp_path / "dem.asc"
+    with open(path, "w") as f:
+        f.write("ncols %d\nnrows %d\nxllcorner -77.0\nyllcorner 38.0\ncellsize %f\nNODATA_value -9999\n" % (cols, rows, cellsize))
+        np.savetxt(f, heights)
+    return (path, lat, lon)
+
+
+def test_grid(tmp_path):
+    """A 50m wall 500m east of the camera, built from an ASCII grid and then from the cache."""
+    (path, lat, lon) = wallGrid(tmp_path)
+    mask = horizon.HorizonMask(str(path), str(tmp_path), max_range=1000)
+    east = mask.minElevation(90.0, lat, lon, 0)
+    assert 4 < east < 6
+    assert mask.minElevation(270.0, lat, lon, 0) <= 0
+    assert len(list(tmp_path.glob("horizon-*.npy"))) == 1
+    cached = horizon.HorizonMask(str(path), str(tmp_path), max_range=1000)
+    assert cached.minElevation(90.0, lat, lon, 0) == east
+
+
+def test_moved(tmp_path):
+    """GPS jitter keeps the mask, a move builds it again in the background and replaces the cached one."""
+    (path, lat, lon) = wallGrid(tmp_path)
+    mask = horizon.HorizonMask(str(path), str(tmp_path), max_range=1000)
+    built = mask.mask(lat, lon, 0)
+    meters_per_lon = horizon.EARTH_RADIUS * math.pi / 180 * math.cos(math.radians(lat))
+    assert mask.mask(lat, lon + 2 / meters_per_lon, 1) is built
+    assert mask.wait(0)
+    # 250m closer to the wall, the old mask is used until the new one is built
+    moved = lon + 250 / meters_per_lon
+    assert mask.mask(lat, moved, 0) is built
+    assert mask.wait(10)
+    assert 10 < mask.minElevation(90.0, lat, moved, 0) < 14
+    assert len(list(tmp_path.glob("horizon-*.npy"))) == 1
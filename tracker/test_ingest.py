@@ -0,0 +1,52 @@
+"""Unit tests for ingest.py"""
+
+import time
+
+import pandas as pd
+
+import flighttracker
+import ingest
+import replay
+
+
+def test_drop_oldest():
+    """Unit test for the drop-oldest policy."""
+    q = ingest.IngestQueue(2, ingest.DROP_OLDEST)
+    q.put(["MSG,1,a", "MSG,3,b", "MSG,4,c"])
+    assert q.get(0)[0] == ["MSG,3,b", "MSG,4,c"]
+    assert q.stats()["dropped"] == 1
+    assert q.get(0) == ([], [])
+
+
+def test_drop_non_position():
+    """Unit test for the drop-non-position policy."""
+    q = ingest.IngestQueue(2, ingest.DROP_NON_POSITION)
+    q.put(["MSG,1,a", "MSG,4,b", "MSG,4,c", "MSG,3,d"])
+    assert q.get(0)[0] == ["MSG,4,b", "MSG,3,d"]
+    assert q.stats()["dropped"] == 2
+
+
+def test_received():
+    """Messages keep the time they were received at, not the time they are taken."""
+    q = ingest.IngestQueue(10)
+    before = time.time()
+    q.put(["MSG,3,a"])
+    time.sleep(0.05)
+    q.put(["MSG,3,b", "MSG,4,c"])
+    time.sleep(0.1)
+    (msgs, received) = q.get(0)
+    assert msgs == ["MSG,3,a", "MSG,3,b", "MSG,4,c"]
+    assert before - 0.01 <= received[0] < received[1] == received[2] <= time.time() - 0.09
+
+
+def test_stamped_when_received():
+    """The tracker stamps observations with the time their message was received, also when shedding load."""
+    flighttracker.planes = pd.DataFrame(columns=replay.AIRCRAFT_DB_COLUMNS)
+    position = "MSG,3,111,11111,{},111111,2021/05/13,14:13:42.250,2021/05/13,14:13:42.250,,10000,,,38.01000,-77.01000,,,0,0,0,0"
+    tracker = flighttracker.FlightTracker("simulator", "simulator", None, "skyscan/flight/json", overload_threshold=2)
+    tracker.processBatch([position.format("A1B2C3")], 1000.0, [990.0])
+    assert tracker.getObservation("a1b2c3").getLatLonTime() == 990.0
+    backlog = [position.format(icao24) for icao24 in ("A1B2C3", "D4E5F6", "A1B2C3")]
+    tracker.processBatch(backlog, 1001.0, [995.0, 996.0, 997.0])
+    assert tracker.getObservation("a1b2c3").getLatLonTime() == 997.0
+    assert tracker.getObservation("d4e5f6").getLatLonTime() == 996.0
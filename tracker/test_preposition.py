@@ -0,0 +1,63 @@
+"""Unit tests for preposition.py"""
+
+import math
+
+import preposition
+import rules
+from config_store import TrackerConfig
+
+
+class FakeObservation(object):
+    """Just the getters preposition.predict() uses."""
+
+    def __init__(self, icao24, lat, lon, altitude, time, speed, track):
+        self.state = (icao24, lat, lon, altitude, time, speed, track)
+
+    def getIcao24(self): return self.state[0]
+    def getLat(self): return self.state[1]
+    def getLon(self): return self.state[2]
+    def getAltitude(self): return self.state[3]
+    def getLatLonTime(self): return self.state[4]
+    def getGroundSpeed(self): return self.state[5]
+    def getTrack(self): return self.state[6]
+    def getVerticalRate(self): return 0.0
+    def getOnGround(self): return False
+    def getSquawk(self): return "7700" if self.state[0] == "d4e5f6" else "1200"
+
+
+def test_predict():
+    """A plane 30 km south flying north enters a 10 degree minimum elevation about 13 km later."""
+    config = TrackerConfig(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0, min_elevation=10)
+    south = 38.0 - 30000 / preposition.METERS_PER_DEGREE
+    inbound = FakeObservation("a1b2c3", south, -77.0, 3000.0, 1000.0, 250.0, 0.0)
+    outbound = FakeObservation("d4e5f6", south, -77.0, 3000.0, 1000.0, 250.0, 180.0)
+    entry = preposition.predict([outbound, inbound], config, 1000.0)
+    expected = (30000 - 3000 / math.tan(math.radians(10))) / 250.0
+    assert entry["icao24"] == "a1b2c3"
+    assert expected <= entry["time"] - 1000.0 < expected + preposition.STEP
+    assert abs(entry["azimuth"] - 180.0) < 0.1
+    assert entry["elevation"] >= 10
+    assert preposition.predict([outbound], config, 1000.0) is None
+
+
+def ruleset(config):
+    # Not through rules.forConfig(), whose cache the tracker's config versions share
+    return rules.RuleSet(config.version, rules.builtin(config) + rules.parse(config.rules))
+
+
+def test_predict_rules():
+    """Aircraft the declared rules reject are not waited for, wherever they fly."""
+    south = 38.0 - 30000 / preposition.METERS_PER_DEGREE
+    inbound = FakeObservation("a1b2c3", south, -77.0, 3000.0, 1000.0, 250.0, 0.0)
+    denied = FakeObservation("d4e5f6", south, -77.0, 3000.0, 1000.0, 250.0, 0.0)
+    declared = ({"field": "squawk", "deny": ["7700"]},)
+    config = TrackerConfig(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0, min_elevation=10, rules=declared, version=1)
+    assert preposition.predict([denied], config, 1000.0, ruleset=ruleset(config)) is None
+    free = preposition.predict([denied, inbound], config, 1000.0)
+    entry = preposition.predict([denied, inbound], config, 1000.0, ruleset=ruleset(config))
+    assert entry["icao24"] == "a1b2c3" and entry["time"] == free["time"]
+    # A geofence south of the camera moves the entry to where the aircraft leaves it
+    declared += ({"geofence": [[37.0, -78.0], [37.95, -78.0], [37.95, -76.0], [37.0, -76.0]], "exclude": True},)
+    config = TrackerConfig(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0, min_elevation=10, rules=declared, version=2)
+    entry = preposition.predict([denied, inbound], config, 1000.0, ruleset=ruleset(config))
+    assert entry["lat"] >= 37.95 and entry["time"] > free["time"]
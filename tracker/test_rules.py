@@ -0,0 +1,106 @@
+"""Unit tests for rules.py"""
+
+import random
+
+import numpy as np
+import pytest
+
+import rules
+from config_store import ConfigStore, TrackerConfig
+
+GETTERS = {getter: field for (field, getter) in rules.FIELDS.items()}
+
+
+class FakeObservation(object):
+    """Answers the getters in rules.FIELDS from a dict."""
+
+    def __init__(self, **values):
+        self.values = values
+
+    def __getattr__(self, name):
+        if name not in GETTERS:
+            raise AttributeError(name)
+        return lambda: self.values.get(GETTERS[name], True if name == "isInEnvelope" else None)
+
+
+def ruleset(config):
+    # Not through rules.forConfig(), whose cache the tracker's config versions share
+    return rules.RuleSet(config.version, rules.builtin(config) + rules.parse(config.rules))
+
+
+def random_observation():
+    def maybe(value):
+        return None if random.random() < 0.1 else value
+    return FakeObservation(
+        lat=maybe(random.uniform(37.5, 38.5)), lon=maybe(random.uniform(-77.5, -76.5)),
+        altitude=maybe(random.uniform(0, 15000)), groundSpeed=maybe(200.0), track=maybe(90.0),
+        onGround=random.choice([None, False, True]), distance=maybe(random.uniform(0, 80000)),
+        elevation=maybe(random.uniform(-5, 90)), squawk=random.choice([None, "1200", "7700"]),
+        operator=random.choice([None, "United Airlines", "Delta Air Lines"]), envelope=random.random() < 0.8)
+
+
+def test_scalar_and_vector_agree():
+    """The compiled rules, the rules one by one and the numpy evaluation give the same answers."""
+    random.seed(1)
+    declared = [
+        {"field": "squawk", "deny": ["7700"]},
+        {"field": "operator", "allow": ["UNITED AIRLINES"]},
+        {"field": "elevation", "max": 80},
+        {"geofence": [[37.8, -77.2], [38.2, -77.2], [38.2, -76.8], [37.8, -76.8]]},
+    ]
+    compiled = ruleset(TrackerConfig(min_altitude=1000, max_altitude=12000, max_distance=50000, min_elevation=10, rules=tuple(declared)))
+    observations = [random_observation() for _ in range(2000)]
+
+    scalar = np.array([compiled.rejection(o) is None for o in observations])
+    by_rule = np.array([all(met for (_, met) in compiled.explain(o)) and o.isInEnvelope() for o in observations])
+    assert (scalar == by_rule).all()
+    assert (scalar == compiled.evaluate(observations)).all()
+    assert 0 < scalar.sum() < len(observations)
+
+
+def test_rejections_are_counted():
+    compiled = ruleset(TrackerConfig(max_altitude=1000))
+    before = rules.rejections().get("Max Alt", 0)
+    high = FakeObservation(lat=38.0, lon=-77.0, altitude=2000.0, groundSpeed=200.0, track=90.0, distance=1.0, elevation=45.0)
+    assert compiled.rejection(high, count=True) == "Max Alt"
+    compiled.evaluate([high, high], count=True)
+    assert rules.rejections()["Max Alt"] == before + 3
+
+
+def test_for_config_compiles_on_version(monkeypatch):
+    """forConfig() keeps the rules until the config version changes."""
+    monkeypatch.setattr(rules, "_current", None)
+    store = ConfigStore(TrackerConfig(max_altitude=1000))
+    config = store.update(min_elevation=10)
+    assert rules.forConfig(config) is rules.forConfig(store.get())
+    raised = rules.forConfig(store.update(max_altitude=2000))
+    assert raised.version == store.version()
+    high = FakeObservation(lat=38.0, lon=-77.0, altitude=1500.0, groundSpeed=200.0, track=90.0, distance=1.0, elevation=45.0)
+    assert rules.forConfig(config).rejection(high) == "Max Alt"
+    assert raised.rejection(high) is None
+
+
+def test_parse():
+    (geofence, band) = rules.parse([{"geofence": [[0, 0], [0, 1], [1, 1]], "exclude": True, "name": "Airport"}, {"field": "altitude", "max": 100}])
+    assert (geofence.name, geofence.exclude) == ("Airport", True)
+    assert (band.name, band.low, band.high) == ("altitude band", None, 100.0)
+    for bad in ({"field": "nope", "max": 1}, {"field": "operator", "min": 1}, {"field": "altitude"}, {"geofence": [[0, 0], [1, 1]]}):
+        with pytest.raises(ValueError):
+            rules.parse([bad])
+
+
+def test_unlocated_observation():
+    """A real aircraft heard from before its position is rejected, not an error."""
+    import pandas as pd
+    import flighttracker
+    import replay
+    import sbs1
+    flighttracker.planes = pd.DataFrame(columns=replay.AIRCRAFT_DB_COLUMNS)
+    config = TrackerConfig(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0.0, min_elevation=10, max_distance=50000)
+    ident = "MSG,1,111,11111,A1B2C3,111111,2021/05/13,14:13:42.000,2021/05/13,14:13:42.000,UAL1  ,,,,,,,,,,,"
+    velocity = "MSG,4,111,11111,D4E5F6,111111,2021/05/13,14:13:42.500,2021/05/13,14:13:42.500,,,250,90,,,-64,,,,,0"
+    observations = [flighttracker.Observation(sbs1.parse(line), 0.0) for line in (ident, velocity)]
+    assert not any(o.isInEnvelope() for o in observations)
+    compiled = ruleset(config)
+    assert not compiled.evaluate(observations).any()
+    assert all(compiled.rejection(o) is not None for o in observations)
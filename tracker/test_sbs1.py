@@ -0,0 +1,43 @@
+"""Unit tests for sbs1.py"""
+
+from datetime import datetime
+
+import sbs1
+
+
+IDENT = "MSG,1,111,11111,A1B2C3,111111,2021/05/13,14:13:42.000,2021/05/13,14:13:42.000,UAL1  ,,,,,,,,,,,"
+POSITION = "MSG,3,111,11111,A1B2C3,111111,2021/05/13,14:13:42.250,2021/05/13,14:13:42.250,,10000,,,38.01000,-77.01000,,,0,0,0,0"
+VELOCITY = "MSG,4,111,11111,A1B2C3,111111,2021/05/13,14:13:42.500,2021/05/13,14:13:42.500,,,250,90,,,-64,,,,,0"
+SURVEILLANCE = "MSG,5,111,11111,A1B2C3,111111,2021/05/13,14:13:42.750,2021/05/13,14:13:42.750,,10000,,,,,,,0,,0,0"
+
+
+def test_parse():
+    """Unit test for parse()."""
+    msg = sbs1.parse(POSITION)
+    assert msg["transmissionType"] == sbs1.ES_AIRBORNE_POS
+    assert msg["icao24"] == "A1B2C3"
+    assert msg["generatedDate"] == datetime(2021, 5, 13, 14, 13, 42, 250000)
+    assert msg["altitude"] == 10000 * 0.3048
+    assert msg["lat"] == 38.01
+    assert msg["lon"] == -77.01
+    assert msg["onGround"] is False
+    assert msg["groundSpeed"] is None
+
+    msg = sbs1.parse(VELOCITY)
+    assert msg["groundSpeed"] == 250 * 0.514444
+    assert msg["verticalRate"] == -64 * 0.00508
+    # Junk around a number is skipped
+    assert sbs1.parse(VELOCITY.replace(",90,", ",90.0,"))["track"] == 90
+
+
+def test_coalesce():
+    """Unit test for coalesce()."""
+    later_position = POSITION.replace("38.01000", "38.02000")
+    other_plane = POSITION.replace("A1B2C3", "D4E5F6")
+    msgs = [POSITION, IDENT, VELOCITY, SURVEILLANCE, other_plane, later_position, "garbage"]
+
+    kept, dropped = sbs1.coalesce(msgs)
+
+    # The latest message of each kind per aircraft survives, in arrival order
+    assert kept == [IDENT, VELOCITY, other_plane, later_position]
+    assert dropped == {sbs1.ES_AIRBORNE_POS: 1, sbs1.SURVEILLANCE_ALT: 1, 0: 1}
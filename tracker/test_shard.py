@@ -0,0 +1,79 @@
+"""Unit tests for shard.py"""
+
+import time
+
+import shard
+
+
+def test_ring_wraps():
+    """Unit test for SharedRing records that wrap around the end of the buffer."""
+    ring = shard.SharedRing(16 + 64)
+    try:
+        for i in range(20):
+            record = ("record %d" % i).encode() * 3
+            assert ring.write(record)
+            assert ring.read() == record
+        assert ring.read() is None
+        assert ring.write(b"x" * 40)
+        assert not ring.write(b"x" * 40)
+    finally:
+        ring.close(unlink=True)
+
+
+def test_split():
+    """Unit test for split()."""
+    lines = ["MSG,3,111,11111,A1B2C3,111111", "MSG,3,111,11111,a1b2c3,111111", "MSG,3,111,11111,~1B2C3,111111", "garbage"]
+    parts = shard.split(lines, 4)
+    assert parts[0xA1B2C3 % 4][:2] == lines[:2]
+    assert sum(len(p) for p in parts) == len(lines)
+    assert shard.shardOf("A1B2C3", 4) == shard.shardOf("a1b2c3", 4)
+
+
+def test_rejections_counted_as_in_process():
+    """A shard counts rejections per message like the in-process tracker, not per report."""
+    import pandas as pd
+    import flighttracker
+    import replay
+    import rules
+    flighttracker.planes = pd.DataFrame(columns=replay.AIRCRAFT_DB_COLUMNS)
+    position = "MSG,3,111,11111,A1B2C3,111111,2021/05/13,14:13:42.250,2021/05/13,14:13:42.250,,10000,,,38.01000,-77.01000,,,0,0,0,0"
+    ident = "MSG,1,111,11111,A1B2C3,111111,2021/05/13,14:13:42.000,2021/05/13,14:13:42.000,UAL1  ,,,,,,,,,,,"
+    lines = [position, ident, position, position]
+
+    before = sum(rules.rejections().values())
+    tracker = flighttracker.FlightTracker("simulator", "simulator", None, "skyscan/flight/json")
+    tracker.processBatch(lines, 1000.0)
+    in_process = sum(rules.rejections().values()) - before
+
+    before = sum(rules.rejections().values())
+    worker = flighttracker.ShardWorker()
+    worker.processBatch(lines, 1000.0)
+    worker.report()
+    worker.report()
+    assert sum(rules.rejections().values()) - before == in_process == 3
+
+
+def test_all_observations_reach_the_coordinator():
+    """The dashboard and the plane topic get every aircraft of every shard, not only their candidates."""
+    import pandas as pd
+    import flighttracker
+    import replay
+    flighttracker.planes = pd.DataFrame(columns=replay.AIRCRAFT_DB_COLUMNS)
+    flighttracker.config_store.update(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0.0)
+    position = "MSG,3,111,11111,{},111111,2021/05/13,14:13:42.250,2021/05/13,14:13:42.250,,10000,,,{:.5f},-77.01000,,,0,0,0,0"
+    velocity = "MSG,4,111,11111,{},111111,2021/05/13,14:13:42.500,2021/05/13,14:13:42.500,,,250,90,,,-64,,,,,0"
+    lines = []
+    for n in range(3 * flighttracker.SHARD_CANDIDATES):
+        icao24 = "A1B2%02d" % n
+        lines += [position.format(icao24, 38.0 + 0.01 * n), velocity.format(icao24)]
+    tracker = flighttracker.FlightTracker("simulator", "simulator", None, "skyscan/flight/json", shards=2)
+    tracker.startShards()
+    try:
+        tracker.processBatch(lines, 1000.0)
+        assert tracker.drainShards(10.0)
+        # The rows come once a snapshot interval
+        time.sleep(flighttracker.SNAPSHOT_INTERVAL + shard.REPORT_INTERVAL)
+        tracker.drainShards(10.0)
+        assert len(tracker.getObservations()) == 3 * flighttracker.SHARD_CANDIDATES
+    finally:
+        tracker.stopShards()
@@ -0,0 +1,57 @@
+"""Unit tests for simulator.py"""
+
+import math
+
+import pandas as pd
+import pytest
+
+import flighttracker
+import replay
+import simulator
+
+
+def message(transmission, icao24, stamp, altitude="", speed="", track="", lat="", lon=""):
+    fields = ["", str(altitude), str(speed), str(track), str(lat), str(lon), "", "", "0", "0", "0", "0"]
+    return ",".join(["MSG", str(transmission), "111", "11111", icao24, "111111", "2021/05/13", stamp, "2021/05/13", stamp] + fields)
+
+
+def flyby(seconds):
+    """A plane flying (almost, a track of 0 counts as unknown) north at 200 m/s, passing 5 km east of the camera at 3000 m, twice a second"""
+    messages = []
+    for n in range(seconds * 2):
+        north = -100 * seconds / 2 + 100 * n
+        stamp = "14:%02d:%06.3f" % (n // 120, (n % 120) / 2.0)
+        messages.append(message(4, "ABC123", stamp, speed=200 / 0.514444, track=1))
+        messages.append(message(3, "ABC123", stamp, altitude=round(3000 / 0.3048), lat="%.6f" % (38.0 + north / 111195.0), lon="%.6f" % (-77.0 + 5000 / (111195.0 * math.cos(math.radians(38.0))))))
+    return messages
+
+
+def test_message_times():
+    times = simulator.messageTimes(flyby(10))
+    assert (times[0], times[1], times[2]) == (times[0], times[0], times[0] + 0.5)
+    assert times[-1] - times[0] == 9.5
+    synthetic = replay.synthetic_messages(38.0, -77.0, 5, 100)
+    assert simulator.messageTimes(synthetic, rate=50.0, start=1000.0)[-1] == pytest.approx(1000.0 + 99 / 50.0)
+
+
+def test_slew_time():
+    model = simulator.CameraModel(pan_rate=90.0, tilt_rate=45.0, settle=0.5)
+    assert simulator.panDifference(170.0, -170.0) == 20.0
+    assert simulator.slewTime(model, 170.0, 0.0, (-100.0, 45.0)) == 1.0 + 0.5
+    assert simulator.slewTime(model, 0.0, 0.0, (1.0, 1.0)) == pytest.approx(1.0 / 45.0)
+
+
+def test_flyby_is_photographed():
+    pytest.importorskip("quaternion")  # axis-ptz is imported for its pointing math, which needs numpy-quaternion
+    camera = simulator.loadCamera()
+    flighttracker.planes = pd.DataFrame(columns=replay.AIRCRAFT_DB_COLUMNS)
+    flighttracker.config_store.update(camera_latitude=38.0, camera_longitude=-77.0, camera_altitude=0.0, camera_lead=0.25, min_elevation=10, max_distance=None)
+    pointing = simulator.Pointing(camera, 38.0, -77.0, 0.0)
+    messages = flyby(60)
+    tracker = flighttracker.FlightTracker("simulator", "simulator", None, "skyscan/flight/json")
+    result = simulator.simulate(tracker, messages, simulator.messageTimes(messages), simulator.closestPolicy, simulator.CameraModel(), pointing)
+    scores = result["aircraft"]["abc123"]
+    assert scores["trackable"] > 10
+    # All but the frames taken while slewing onto it from where the camera started
+    assert scores["frames"] - 2 <= scores["on_target"] <= scores["frames"]
+    assert simulator.summary(result, 1.0)["missed"] == 0
@@ -1,9 +1,22 @@
 from typing import *
 import logging
 import math
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 
 
+def epoch_to_utc(t: float) -> datetime:
+    """Convert a timestamp to a naive UTC datetime, for serialization
+
+    Arguments:
+        t {float} -- Seconds since the epoch
+
+    Returns:
+        datetime -- UTC date and time without timezone information
+    """
+    if t is None:
+        return None
+    return datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None)
+
 def deg2rad(deg: float) -> float:
     """Convert degrees to radians
 
@@ -127,15 +140,17 @@ def coordinate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> f
     return d
 
 
-def calc_travel(lat: float, lon: float, utc_start: datetime, speed_mps: float, heading: float, lead_s: float) -> Tuple[float, float]:
+def calc_travel(lat: float, lon: float, utc_start: float, speed_mps: float, heading: float, lead_s: float, now: float) -> Tuple[float, float]:
     """Calculate travel from lat, lon starting at a certain time with given speed and heading
 
     Arguments:
         lat {float} -- Starting latitude
         lon {float} -- Starting longitude
-        utc_start {datetime} -- Start time
+        utc_start {float} -- Start time (seconds since the epoch)
         speed_kts {float} -- Speed in knots
         heading {float} -- Heading in degress
+        lead_s {float} -- Additional seconds of travel past now
+        now {float} -- Current time (seconds since the epoch)
 
     Returns:
         Tuple[float, float] -- The new lat/lon as a tuple
@@ -145,8 +160,7 @@ def calc_travel(lat: float, lon: float, utc_start: datetime, speed_mps: float, h
     if speed_mps==None:
         speed_mps=0
 
-    age = datetime.utcnow() - utc_start
-    age_s = age.total_seconds() + lead_s
+    age_s = now - utc_start + lead_s
 
     R = 6378.1 # Radius of the Earth
     brng = math.radians(heading) # Bearing is 90 degrees converted to radians.
@@ -163,18 +177,20 @@ def calc_travel(lat: float, lon: float, utc_start: datetime, speed_mps: float, h
 
     return (lat2, lon2)
 
-def calc_travel_3d(lat: float, lon: float, alt: float, lat_lon_time: datetime, altitude_time: datetime, speed_mps: float, heading: float, climb_rate: float, lead_s: float) -> Tuple[float, float]:
+def calc_travel_3d(lat: float, lon: float, alt: float, lat_lon_time: float, altitude_time: float, speed_mps: float, heading: float, climb_rate: float, lead_s: float, now: float) -> Tuple[float, float]:
     """Extrapolate the 3D position of the aircraft
 
     Arguments:
         lat {float} -- Starting latitude (degrees)
         lon {float} -- Starting longitude (degrees)
         alt {float} -- Starting altitude (meters)
-        lat_lon_time {datetime} -- Last time lat / lon was updated
-        altitude_time {datetime} -- Last time altitude was updated
+        lat_lon_time {float} -- Last time lat / lon was updated (seconds since the epoch)
+        altitude_time {float} -- Last time altitude was updated (seconds since the epoch)
         speed_mps {float} -- Speed (meters per second)
         heading {float} -- Heading (degrees)
         climb_rate {float} -- climb rate (meters per second) 
+        lead_s {float} -- Additional seconds of travel past now
+        now {float} -- Current time (seconds since the epoch)
         
     Returns:
         Tuple[float, float, float] -- The new latitude (deg)/longitude (deg)/alt (meters) as a tuple
@@ -183,11 +199,8 @@ def calc_travel_3d(lat: float, lon: float, alt: float, lat_lon_time: datetime, a
         heading=0
     if speed_mps==None:
         speed_mps=0
-    lat_lon_age = datetime.utcnow() - lat_lon_time
-    lat_lon_age_s = lat_lon_age.total_seconds() + lead_s
-
-    alt_age = datetime.utcnow() - altitude_time
-    alt_age_s = alt_age.total_seconds() + lead_s
+    lat_lon_age_s = now - lat_lon_time + lead_s
+    alt_age_s = now - altitude_time + lead_s
 
     R = 6378.1 # Radius of the Earth
     brng = math.radians(heading) # Bearing is 90 degrees converted to radians.